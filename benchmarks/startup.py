@@ -0,0 +1,95 @@
+# ---------------------------------------------------
+# startup.py:  time-to-first-command benchmark of bywaf.py
+# ---------------------------------------------------
+
+"""
+Starts "bywaf.py --script" on a one-command script RUNS times, and the bare
+Python interpreter as many times, then reports the median time until
+bywaf's first command printed its output and until bywaf exited.
+
+Exits with status 1 if the median time to the first command, less that of
+the bare interpreter, is over the budget: run it in CI so that new imports
+and initialisation on the startup path are caught as they are added.
+
+usage: python benchmarks/startup.py [--runs N] [--budget MS] [--python EXE]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+BYWAF = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bywaf.py')
+
+# default number of runs, and most milliseconds bywaf may take to run its
+# first command on top of the bare interpreter's startup
+DEFAULT_RUNS = 20
+DEFAULT_BUDGET_MS = 50
+
+# printed by the script's only command
+MARKER = b'BENCHMARK_MARKER => 1'
+
+
+def run(argv, cwd, marker=None):
+    """run a command with no input; return the seconds until marker was
+    printed (None without one), and until the command exited"""
+    started = time.time()
+    first = None
+    process = subprocess.Popen(argv, cwd=cwd, stdin=open(os.devnull), stdout=subprocess.PIPE)
+    for line in iter(process.stdout.readline, b''):
+        if first is None and marker is not None and marker in line:
+            first = time.time() - started
+    process.wait()
+    if process.returncode:
+        raise SystemExit('{} exited with status {}'.format(' '.join(argv), process.returncode))
+    if marker is not None and first is None:
+        raise SystemExit('{} never ran its first command'.format(' '.join(argv)))
+    return first, time.time() - started
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup time of bywaf.py')
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS, help='number of runs')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET_MS,
+                        help='most milliseconds to the first command, over the bare interpreter')
+    parser.add_argument('--python', default=sys.executable, help='interpreter to run bywaf.py with')
+    args = parser.parse_args()
+
+    # run in a scratch directory, so that no history, host database or journal is picked up
+    workdir = tempfile.mkdtemp(prefix='bywaf-startup-')
+    try:
+        script = os.path.join(workdir, 'startup.bywaf')
+        with open(script, 'w') as f:
+            f.write('gset BENCHMARK_MARKER 1\n')
+
+        bare = [run([args.python, '-c', 'pass'], workdir)[1] for i in range(args.runs)]
+        bywaf = [run([args.python, BYWAF, '--script', script], workdir, MARKER) for i in range(args.runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    bare_ms = median(bare) * 1000
+    first_ms = median([first for first, total in bywaf]) * 1000
+    total_ms = median([total for first, total in bywaf]) * 1000
+    overhead_ms = first_ms - bare_ms
+
+    print('bare interpreter:      {:8.1f} ms'.format(bare_ms))
+    print('bywaf first command:   {:8.1f} ms'.format(first_ms))
+    print('bywaf exit:            {:8.1f} ms'.format(total_ms))
+    print('bywaf overhead:        {:8.1f} ms  (budget {:.0f} ms)'.format(overhead_ms, args.budget))
+
+    if overhead_ms > args.budget:
+        print('over budget')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
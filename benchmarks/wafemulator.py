@@ -0,0 +1,334 @@
+# ---------------------------------------------------
+# wafemulator.py:  local WAF emulators and a wafw00f detection benchmark
+# ---------------------------------------------------
+
+"""
+Starts one local HTTP server per WAF vendor wafw00f can identify, each
+answering the way that vendor does (ModSecurity's 501 to attacks,
+WebKnight's 999, F5 ASM's TS... cookies, NetScaler's scrambled Cneonction
+header, ISA Server's reason phrase, ...), plus two controls: "none", a plain
+web server, and "generic", a WAF no signature knows which answers attacks
+with 403.  Every response can be delayed by an injected latency.
+
+Then identifies each emulator RUNS times with wafw00f's scantarget() (the
+identification of the identwaf plugin and of wafw00f --bulk), and reports
+per emulator and overall the requests sent per identification, the
+identifications per second, the p50 and p99 time of an identification and
+whether wafw00f found the right WAF.  Exits with status 1 if it did not
+for any emulator: run it before and after a change to the detection engine
+to show what the change does to its speed, and that it did not break it.
+
+With --serve, only starts the emulators and prints their urls, e.g. to
+point bywaf's identwaf at them.
+
+usage: python benchmarks/wafemulator.py [--runs N] [--latency MS] [--workers N]
+                                        [--concurrency N] [--findall] [--vendor NAME ...]
+       python benchmarks/wafemulator.py --serve [--port PORT] [--latency MS]
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WAFW00F = os.path.join(REPO, 'plugins', 'external', 'wafw00f.py')
+
+# default number of identifications per emulator, and of hosts identified at once
+DEFAULT_RUNS = 20
+DEFAULT_WORKERS = 1
+
+# the controls: a web server without a WAF, and one behind a WAF which only
+# wafw00f's generic detection can find
+NONE = 'none'
+GENERIC = 'generic'
+
+ISA_SERVER_REASON = ('Forbidden ( The server denied the specified Uniform Resource Locator (URL). '
+                     'Contact the server administrator.  )')
+
+# the probes an emulator tells apart, most specific first.  A request is
+# answered as the first of them which it is and the emulator answers to
+PROBES = ['invalidhost', 'protectedfolder', 'attacks', 'atsignquery', 'urlscanheaders', 'longtransferencoding']
+
+# what is in the paths of wafw00f's attack probes
+ATTACK_STRINGS = ['<script>', '../', 'cmd.exe', '/Admin_Files/']
+
+# emulator : behaviour.  "server" is the Server header and "headers" are
+# other headers, sent with every response; a probe name maps to how that
+# probe is answered instead of with a 200: a status, a reason phrase, more
+# headers, an HTTP version, or dropping the connection
+EMULATIONS = {
+    NONE: {},
+    GENERIC: dict(attacks=dict(status=403)),
+    'Profense': dict(server='Profense'),
+    'NetContinuum': dict(headers=[('Set-Cookie', 'NCI__SessionId=0123456789; path=/')]),
+    'Barracuda': dict(headers=[('Set-Cookie', 'barra_counter_session=0123456789; path=/')]),
+    'HyperGuard': dict(headers=[('Set-Cookie', 'WODSESSION=0123456789; path=/')]),
+    'BinarySec': dict(server='BinarySec/3.2.2'),
+    'Teros': dict(headers=[('Set-Cookie', 'st8id=0123456789; path=/')]),
+    'F5 Trafficshield': dict(server='F5-TrafficShield'),
+    'F5 ASM': dict(headers=[('Set-Cookie', 'TS01a2b3=0123456789; path=/')]),
+    'Airlock': dict(headers=[('Set-Cookie', 'AL_SESS=0123456789; path=/')]),
+    'Citrix NetScaler': dict(attacks=dict(headers=[('Cneonction', 'close')])),
+    'ModSecurity': dict(attacks=dict(status=501, reason='Method Not Implemented')),
+    'IBM Web Application Security': dict(protectedfolder=dict(drop=True)),
+    'IBM DataPower': dict(headers=[('X-Backside-Transport', 'OK OK')]),
+    'DenyALL': dict(attacks=dict(status=200, reason='Condition Intercepted')),
+    'dotDefender': dict(attacks=dict(status=403, headers=[('X-dotDefender-denied', '1')])),
+    'webApp.secure': dict(atsignquery=dict(status=403)),
+    'BIG-IP': dict(attacks=dict(headers=[('X-Cnection', 'close')])),
+    'URLScan': dict(urlscanheaders=dict(status=404)),
+    'WebKnight': dict(attacks=dict(status=999, reason='No Hacking')),
+    'SecureIIS': dict(longtransferencoding=dict(status=404)),
+    'Imperva': dict(attacks=dict(version='HTTP/1.0')),
+    'ISA Server': dict(invalidhost=dict(status=403, reason=ISA_SERVER_REASON)),
+}
+
+# Server header of the emulators which do not set one
+DEFAULT_SERVER = 'Apache'
+
+BODY = b'<html><body>hello</body></html>'
+
+
+class EmulatorHandler(BaseHTTPRequestHandler):
+    """answers requests as the server's emulation says"""
+
+    protocol_version = 'HTTP/1.1'
+
+    # send a response in one write, or the peer's delayed ACKs hold every
+    # header line back
+    wbufsize = -1
+
+    def answer(self):
+        emulation = self.server.emulation
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        answer = {}
+        probes = self.probes()
+        for probe in PROBES:
+            if probe in emulation and probe in probes:
+                answer = emulation[probe]
+                break
+
+        if answer.get('drop'):
+            # no response at all, as when a WAF resets the connection
+            self.close_connection = True
+            return
+        if 'version' in answer:
+            self.protocol_version = answer['version']
+            self.close_connection = True
+        self.send_response(answer.get('status', 200), answer.get('reason'))
+        for name, value in emulation.get('headers', []) + answer.get('headers', []):
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(BODY)
+
+    do_GET = do_HEAD = do_POST = answer
+
+    # wafw00f's unknownmethod probe
+    do_OHYEA = answer
+
+    def probes(self):
+        """return the names of the probes of PROBES this request is"""
+        path = unquote(self.path)
+        host = (self.headers.get('Host') or '').split(':')[0]
+        probes = []
+        if host != self.server.server_address[0]:
+            probes.append('invalidhost')
+        if '/Admin_Files/' in path:
+            probes.append('protectedfolder')
+        if [attack for attack in ATTACK_STRINGS if attack in path]:
+            probes.append('attacks')
+        if '@@' in path:
+            probes.append('atsignquery')
+        if self.headers.get('Translate') is not None:
+            probes.append('urlscanheaders')
+        if len(self.headers.get('Transfer-Encoding') or '') > 1024:
+            probes.append('longtransferencoding')
+        return probes
+
+    def version_string(self):
+        return self.server.emulation.get('server', DEFAULT_SERVER)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class EmulatorServer(ThreadingMixIn, HTTPServer):
+    """an HTTP server answering as one WAF vendor"""
+
+    daemon_threads = True
+
+    # a ProbeEngine opens several connections at once
+    request_queue_size = 128
+
+    def __init__(self, vendor, port=0, latency=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), EmulatorHandler)
+        self.vendor = vendor
+        self.emulation = EMULATIONS[vendor]
+        self.latency = latency
+
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address)
+
+
+def start_emulators(vendors, port=0, latency=0):
+    """start an emulator for each vendor on consecutive ports from port (any
+    free port if 0), each serving from a thread; return them"""
+    emulators = []
+    for i, vendor in enumerate(vendors):
+        emulator = EmulatorServer(vendor, port and port + i, latency)
+        thread = threading.Thread(target=emulator.serve_forever)
+        thread.daemon = True
+        thread.start()
+        emulators.append(emulator)
+    return emulators
+
+
+def load_wafw00f():
+    # wafw00f changes to the directory of sys.argv[0] when it is loaded
+    sys.path.insert(0, REPO)
+    from pluginregistry import PluginRegistry
+    cwd = os.getcwd()
+    try:
+        return PluginRegistry().load(WAFW00F, 'wafw00f')
+    finally:
+        os.chdir(cwd)
+
+
+def identify(wafw00f, emulator, options):
+    """identify one emulator; return its vendor, scantarget()'s record and
+    the seconds it took"""
+    started = time.time()
+    record = wafw00f.scantarget(emulator.url(), **options)
+    return emulator.vendor, record, time.time() - started
+
+
+def misdetection(vendor, record):
+    """return what wafw00f wrongly found behind an emulator, None if it was right"""
+    if 'error' in record:
+        return 'error: {}'.format(record['error'])
+    wafnames = record['knowledge']['wafname']
+    generic = record['knowledge']['generic']['found']
+    if vendor == NONE:
+        right = not wafnames and not generic
+    elif vendor == GENERIC:
+        right = not wafnames and generic
+    else:
+        right = wafnames == [vendor]
+    if right:
+        return None
+    return ', '.join(wafnames) or (generic and GENERIC) or NONE
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the speed and accuracy of wafw00f against local WAF emulators')
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS, help='identifications per emulator')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every response')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='hosts identified at once')
+    parser.add_argument('--concurrency', type=int,
+                        help="probes kept in flight at once, 1 sends them one at a time (default: wafw00f's)")
+    parser.add_argument('--findall', action='store_true', help='run every detection, not only up to the first match')
+    parser.add_argument('--vendor', action='append', help='emulate only this vendor (repeatable)')
+    parser.add_argument('--serve', action='store_true', help='only run the emulators and print their urls')
+    parser.add_argument('--port', type=int, default=0, help='port of the first emulator, the others following')
+    args = parser.parse_args()
+
+    for vendor in args.vendor or []:
+        if vendor not in EMULATIONS:
+            parser.error('no emulation of {}; there are: {}'.format(vendor, ', '.join(sorted(EMULATIONS))))
+
+    if args.serve:
+        vendors = args.vendor or sorted(EMULATIONS)
+        for emulator in start_emulators(vendors, args.port, args.latency / 1000.0):
+            print('{:30} {}'.format(emulator.vendor, emulator.url()))
+        sys.stdout.flush()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            return 0
+
+    logging.basicConfig(level=logging.ERROR)
+    wafw00f = load_wafw00f()
+    import concurrent.futures
+
+    vendors = args.vendor
+    if not vendors:
+        vendors = [NONE, GENERIC] + list(wafw00f.WafW00F.wafdetectionsprio)
+        missing = [vendor for vendor in vendors if vendor not in EMULATIONS]
+        if missing:
+            print('no emulation of: {}'.format(', '.join(missing)))
+            vendors = [vendor for vendor in vendors if vendor in EMULATIONS]
+    emulators = start_emulators(vendors, args.port, args.latency / 1000.0)
+
+    concurrency = args.concurrency or wafw00f.DEFAULT_PROBE_WORKERS
+    options = dict(findall=args.findall)
+    if concurrency > 1:
+        options['engine'] = wafw00f.ProbeEngine(concurrency)
+
+    executor = concurrent.futures.ThreadPoolExecutor(args.workers)
+    started = time.time()
+    futures = [executor.submit(identify, wafw00f, emulator, options)
+               for i in range(args.runs) for emulator in emulators]
+    results = [future.result() for future in futures]
+    elapsed = time.time() - started
+    executor.shutdown()
+    if 'engine' in options:
+        options['engine'].shutdown()
+    # close the idle keep-alive connections, which the emulators' threads wait on
+    wafw00f.connectionpool.clear()
+    for emulator in emulators:
+        emulator.shutdown()
+        emulator.server_close()
+
+    print('{:30} {:>8} {:>8} {:>9} {:>9}  {}'.format('emulator', 'ok', 'req/id', 'p50 ms', 'p99 ms', 'misdetected as'))
+    failed = 0
+    for vendor in vendors:
+        mine = [(record, seconds) for v, record, seconds in results if v == vendor]
+        wrong = [misdetection(vendor, record) for record, seconds in mine]
+        wrong = [found for found in wrong if found is not None]
+        requests = [record.get('requests', 0) for record, seconds in mine]
+        times = [seconds * 1000 for record, seconds in mine]
+        failed += len(wrong)
+        print('{:30} {:>8} {:8.1f} {:9.1f} {:9.1f}  {}'.format(
+            vendor, '{}/{}'.format(len(mine) - len(wrong), len(mine)), float(sum(requests)) / len(requests),
+            percentile(times, 50), percentile(times, 99), ', '.join(sorted(set(wrong)))))
+
+    requests = [record.get('requests', 0) for vendor, record, seconds in results]
+    times = [seconds * 1000 for vendor, record, seconds in results]
+    print('')
+    print('identifications:           {:8d}  ({} workers, {} probes in flight, {:.0f} ms latency)'.format(
+        len(results), args.workers, concurrency, args.latency))
+    print('identifications/second:    {:8.1f}'.format(len(results) / elapsed))
+    print('requests/identification:   {:8.1f}'.format(float(sum(requests)) / len(requests)))
+    print('p50 identification:        {:8.1f} ms'.format(percentile(times, 50)))
+    print('p99 identification:        {:8.1f} ms'.format(percentile(times, 99)))
+    print('misdetections:             {:8d}'.format(failed))
+
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,35 +6,83 @@
 
 """ Bywaf. """
 
-# standard Python libraries
-import readline
-import argparse
+# standard Python libraries.  readline and argparse are imported where they
+# are needed, and so are Bywaf's own modules (but for the plugin registry),
+# so that one-shot runs start fast
 from cmd import Cmd
 import sys
 import string
-import concurrent.futures
-import imp # for loading other modules
 import os.path
 import os
+import json
+import time
+import types
+import codecs
+import threading
 from functools import partial
 
 
 # our library
-from hostdb import HostDatabase
+from pluginregistry import PluginRegistry
 
 # global constants
 DEFAULT_MAX_CONCURRENT_JOBS = 10
 
+# backgrounded jobs run on worker threads ("thread") or in child processes ("process")
+DEFAULT_JOB_BACKEND = 'thread'
+
+# retention of finished jobs: most jobs kept, and most bytes of results
+# held in memory before older ones are spilled to disk (0 means no limit)
+DEFAULT_JOBS_MAX_COUNT = 10000
+DEFAULT_JOBS_MAX_RESULT_BYTES = 64*1024*1024
+DEFAULT_JOBS_MAX_AGE = 0
+
+# seconds a backgrounded job may run before it is killed (0 means no deadline)
+DEFAULT_JOB_TIMEOUT = 0
+
+# bytes of a job's output held in memory before it is spilled to disk, and
+# most bytes of output kept per job (the oldest output is dropped past it)
+DEFAULT_JOB_OUTPUT_MEMORY = 64*1024
+DEFAULT_JOB_OUTPUT_MAX_BYTES = 64*1024*1024
+
+# probe pacing (see scheduler.py):  probes per second and burst size per
+# target host, and probes per second overall (0 means no limit)
+DEFAULT_PROBE_RATE_PER_HOST = 10
+DEFAULT_PROBE_BURST_PER_HOST = 10
+DEFAULT_PROBE_RATE_GLOBAL = 200
+
+# records buffered between two stages of a pipeline (see pipeline.py)
+DEFAULT_PIPELINE_QUEUE_SIZE = 1000
+
+# seconds between two writes of the metrics file (see metrics.py)
+DEFAULT_METRICS_INTERVAL = 15
+
+# file names of the host database and of the job journal
+DEFAULT_HOSTDB_FILENAME = "bywaf-hostdb.db"
+DEFAULT_JOURNAL_FILENAME = "bywaf-journal.jsonl"
+
+# lines of job output shown per page by the result command, and bytes read at a time
+OUTPUT_PAGE_LINES = 40
+OUTPUT_READ_SIZE = 4096
+
+# internal commands which "script -j" runs in order: the lines before them
+# are finished first, and the lines after them only start once they are done
+SCRIPT_BARRIERS = ('use', 'set', 'gset', 'wait', 'script', 'kill', 'd')
+
 # path to the root of the plugins directory
 DEFAULT_PLUGIN_PATH = "./"
 
 # history file name
 DEFAULT_HISTORY_FILENAME = "bywaf-history.txt"
 
+# the UNIX socket of a Bywaf daemon (bywaf.py --daemon, see daemon.py)
+DEFAULT_SOCKET_FILENAME = "bywaf.sock"
+
 # Interactive shell class
 class WAFterpreter(Cmd):
     
-   def __init__(self, completekey='tab', stdin=None, stdout=None):
+   def __init__(self, completekey='tab', stdin=None, stdout=None, hostdb_filename=DEFAULT_HOSTDB_FILENAME,
+                journal_filename=DEFAULT_JOURNAL_FILENAME):
       Cmd.__init__(self, completekey, stdin, stdout)
      
       # base wafterpreter constants
@@ -46,19 +94,53 @@ class WAFterpreter(Cmd):
       # currently loaded plugins, loaded & selected with he "use" command.
       # is a dictionary of { "plugin_name" : loaded_module_object }
       self.plugins = {}  
+
+      # plugin modules stay loaded once used, so that switching back to one is
+      # instant and keeps its options.  They are reloaded when their file changes
+      self.plugin_registry = PluginRegistry()
+
+      # the plugins selected with "use" are loaded from command_registry, helper
+      # modules which plugins load themselves from plugin_registry.  In daemon mode
+      # every client has a command registry of its own (see DaemonSession)
+      self.command_registry = self.plugin_registry
       
       # dictionary of global variable names and values
       self.global_options = {} 
-      
-      # jobs are spawned using this object's "submit()"
-#      self.job_executor = concurrent.futures.ProcessPoolExecutor(DEFAULT_MAX_CONCURRENT_JOBS)      
-      self.job_executor = concurrent.futures.ThreadPoolExecutor(DEFAULT_MAX_CONCURRENT_JOBS)
-
-      # running counter, increments with every job; used as Job ID
-      self.job_counter = 0 
-      
-      # job pool (list of runnign and completed Futures objects)      
-      self.jobs = []  
+      self.global_options['MAX_CONCURRENT_JOBS'] = str(DEFAULT_MAX_CONCURRENT_JOBS)
+      self.global_options['JOB_BACKEND'] = DEFAULT_JOB_BACKEND
+      self.global_options['JOBS_MAX_COUNT'] = str(DEFAULT_JOBS_MAX_COUNT)
+      self.global_options['JOBS_MAX_RESULT_BYTES'] = str(DEFAULT_JOBS_MAX_RESULT_BYTES)
+      self.global_options['JOBS_MAX_AGE'] = str(DEFAULT_JOBS_MAX_AGE)
+      self.global_options['JOB_TIMEOUT'] = str(DEFAULT_JOB_TIMEOUT)
+      self.global_options['JOB_OUTPUT_MEMORY'] = str(DEFAULT_JOB_OUTPUT_MEMORY)
+      self.global_options['JOB_OUTPUT_MAX_BYTES'] = str(DEFAULT_JOB_OUTPUT_MAX_BYTES)
+      self.global_options['PROBE_RATE_PER_HOST'] = str(DEFAULT_PROBE_RATE_PER_HOST)
+      self.global_options['PROBE_BURST_PER_HOST'] = str(DEFAULT_PROBE_BURST_PER_HOST)
+      self.global_options['PROBE_RATE_GLOBAL'] = str(DEFAULT_PROBE_RATE_GLOBAL)
+      self.global_options['PIPELINE_QUEUE_SIZE'] = str(DEFAULT_PIPELINE_QUEUE_SIZE)
+      self.global_options['METRICS_FILE'] = ''
+      self.global_options['METRICS_INTERVAL'] = str(DEFAULT_METRICS_INTERVAL)
+
+      # the job executor (see job_executor), job registry (see jobs), journal (see
+      # journal), host database (see hostdb), probe scheduler (see scheduler) and
+      # metrics (see metrics) are only set up when first used, so that Bywaf
+      # starts fast.  setup_lock guards their setting up
+      self._job_executor = None
+      self._jobs = None
+      self._journal = None
+      self._hostdb = None
+      self._scheduler = None
+      self._metrics = None
+      self.setup_lock = threading.RLock()
+      self.hostdb_lock = threading.Lock()
+      # absolute, as plugins may change the current directory before they are opened
+      self.hostdb_filename = os.path.abspath(hostdb_filename)
+      self.journal_filename = os.path.abspath(journal_filename)
+
+      # the journal entries of running jobs, by cancellation token, and whether
+      # the user was told about the jobs the journal found unfinished
+      self.journaled = {}
+      self.unfinished_notified = False
 
       # currently-selected plugin's name and object (reference to a job in self.jobs)
       self.current_plugin = None
@@ -67,8 +149,21 @@ class WAFterpreter(Cmd):
       # list of newly-finished backgrounded plugin command jobs
       self.finished_jobs = []
 
-      # create host information database
-      self.hostdb = HostDatabase()
+      # in batch mode (see run_batch()), commands are run without prompts or
+      # notifications, and failures are counted for the exit status
+      self.batch_mode = False
+      self.batch_quit = False
+      self.command_errors = 0
+      self.job_failures = 0
+
+      # the thread writing METRICS_FILE, if it is set
+      self.metrics_writer = None
+
+      # in daemon mode, the backgrounded plugin commands running, by plugin, command
+      # line and option values, so that a client backgrounding a command which is
+      # already running attaches to it (see DaemonSession.background())
+      self.running_commands = {}
+      self.running_commands_lock = threading.Lock()
       
       
    # ----------- Overriden Methods ------------------------------------------------------
@@ -97,6 +192,7 @@ class WAFterpreter(Cmd):
 
    # override exit from command loop to say goodbye
    def postloop(self):
+        self.close()
         print('Goodbye')
         
    # override Cmd.getnames() to return dir(), and not 
@@ -135,7 +231,7 @@ class WAFterpreter(Cmd):
         # set the backgrounding flag if the line ends with &
         if line.endswith('&'):
             exec_in_background = True
-            line = _line[:-1]
+            line = line[:-1]
 
         # extract command and its arguments from the line
         cmd, arg, line = self.parseline(line)
@@ -153,9 +249,10 @@ class WAFterpreter(Cmd):
         # else, process the command
         else:
             try:
-                func = getattr(self, 'do_' + cmd)
-            except AttributeError:
-                print('command "{}" not found'.format(cmd))
+                cmd, func, arg = self.parse_command(line)
+            except ValueError as e:
+                print(e)
+                self.command_errors += 1
                 return # return self.default(line)
       
             # list of commands for the currently-selected plugin
@@ -163,30 +260,26 @@ class WAFterpreter(Cmd):
             if self.current_plugin: 
                 command_names = self.current_plugin.commands
 
+            # time the command (for a backgrounded one, its submission) for "stats"
+            from metrics import cpu_time
+            started = time.time()
+            cpu_started = cpu_time()
+
             # if user requested it, background the job
             # do not do this for internal commands                
             if exec_in_background: #and self.current_plugin and cmd in command_names:
-                print('backgrounding job {}'.format(self.job_counter))
                 
-                # background the job
-                job = self.job_executor.submit(func, arg)
-                
-                job.job_id = self.job_counter
-                job.name = self.current_plugin_name + '/' + cmd
-                job.command_line = line
-                job.add_done_callback(self.finished_job_callback)
-                
-                job.Canceled = False
-
-                # add job to the list of running jobs
-                self.jobs.append(job)
-                self.job_counter += 1
+                self.background(func, arg, cmd, line)
                 ret = 0 # 0 keeps WAFterpreter going, 1 quits it
 
             # else, just run the job (returning 1 causes Bywaf to exit)
             else:
                 func(arg)                
                 ret = 0 # 0 keeps WAFterpreter going, 1 quits it
+
+            command_seconds, command_cpu_seconds = self.command_metrics()
+            command_seconds.observe(time.time() - started, cmd)
+            command_cpu_seconds.inc(cpu_time() - cpu_started, cmd)
                 
             return ret
     
@@ -196,6 +289,87 @@ class WAFterpreter(Cmd):
    #
    #-----------------------------------------------------------------------------------   
 
+   # jobs are spawned using this object's "submit()".  Unlike a
+   # ThreadPoolExecutor, it can kill running jobs (see do_kill()), and
+   # it is resized and switched between backends on the fly (see do_gset()).
+   # It is started when the first job is backgrounded, and from then on what
+   # jobs print is captured into their own output buffer instead of landing
+   # in the middle of the prompt
+   @property
+   def job_executor(self):
+       with self.setup_lock:
+           if self._job_executor is None:
+               from jobs import JobExecutor, route_output
+               route_output()
+               self._job_executor = JobExecutor(int(self.global_options['MAX_CONCURRENT_JOBS']),
+                                                self.global_options['JOB_BACKEND'], metrics=self.metrics)
+           return self._job_executor
+
+   # job registry (running and completed jobs, indexed by job ID and by state),
+   # set up with the retention limits of the global options
+   @property
+   def jobs(self):
+       with self.setup_lock:
+           if self._jobs is None:
+               from jobs import JobRegistry
+               limit = lambda name: int(self.global_options[name]) or None
+               self._jobs = JobRegistry(max_jobs=limit('JOBS_MAX_COUNT'), max_age=limit('JOBS_MAX_AGE'),
+                                        max_result_bytes=limit('JOBS_MAX_RESULT_BYTES'))
+           return self._jobs
+
+   # backgrounded jobs are recorded in a journal which survives a crash, so that
+   # unfinished ones can be resumed from their last checkpoint ("jobs resume").
+   # It is opened, and compacted, when a job is first journaled or the unfinished
+   # ones are first asked for
+   @property
+   def journal(self):
+       with self.setup_lock:
+           if self._journal is None:
+               from journal import Journal
+               self._journal = Journal(self.journal_filename)
+           return self._journal
+
+   # the host information database, shared by all plugins.  Writes go through
+   # a write-behind queue so that jobs never wait on the disk.  It is opened
+   # when first used, possibly by several jobs at once
+   @property
+   def hostdb(self):
+       with self.hostdb_lock:
+           if self._hostdb is None:
+               from hostdb import HostDatabase, WriteBehindHostDatabase
+               self._hostdb = WriteBehindHostDatabase(HostDatabase(self.hostdb_filename), metrics=self.metrics)
+           return self._hostdb
+
+   # every probe sent by plugins goes through this scheduler, which paces them
+   # per target host and overall (as the PROBE_* global options say), and
+   # shares the bandwidth between jobs
+   @property
+   def scheduler(self):
+       with self.setup_lock:
+           if self._scheduler is None:
+               from scheduler import ProbeScheduler
+               self._scheduler = ProbeScheduler(self.parse_rate(self.global_options['PROBE_RATE_PER_HOST']),
+                                                self.parse_rate(self.global_options['PROBE_BURST_PER_HOST']),
+                                                self.parse_rate(self.global_options['PROBE_RATE_GLOBAL']))
+           return self._scheduler
+
+   # timings and counts of the hot paths (commands, jobs, probes, host database
+   # writes), shown by "stats" and written to METRICS_FILE if it is set
+   @property
+   def metrics(self):
+       with self.setup_lock:
+           if self._metrics is None:
+               from metrics import MetricsRegistry
+               self._metrics = MetricsRegistry()
+           return self._metrics
+
+   # return the metrics of the commands run:  wall-clock and CPU seconds, by command
+   def command_metrics(self):
+       return (self.metrics.histogram('bywaf_command_seconds', 'Wall-clock seconds of the commands run',
+                                      ('command',)),
+               self.metrics.counter('bywaf_command_cpu_seconds_total', 'CPU seconds used by the commands run',
+                                    ('command',)))
+
    
    # utility method to autocomplete filenames.
    # Code adapted from http://stackoverflow.com/questions/16826172/filename-tab-completion-in-cmd-cmd-of-python
@@ -265,51 +439,513 @@ class WAFterpreter(Cmd):
                self.current_plugin.options[name] = value, _defaultvalue, _required, _descr
 
            
-   # return a Futures object given its job ID as a string or int
-   def get_job(self, _job_id):
-
-       job = None 
-       job_id = int(_job_id) 
+   # return the command name, function and argument of a command line.  A line
+   # whose stand-alone | split it into commands only (see split_pipeline()) is a
+   # pipeline, unless it is meant for the shell; any other | belongs to the
+   # command's argument.  Raises ValueError if the command cannot be run
+   def parse_command(self, line):
+       cmd, arg, line = self.parseline(line)
+       if cmd != 'shell':
+           stages = self.split_pipeline(line)
+           if len(stages) > 1 and all(hasattr(self, 'do_' + str(self.parseline(stage)[0])) for stage in stages):
+               return cmd, self.run_pipeline, self.parse_pipeline(stages)
+       try:
+           return cmd, getattr(self, 'do_' + cmd), arg
+       except AttributeError:
+           raise ValueError('command "{}" not found'.format(cmd))
+
+   # background a command and add it to the registry of jobs, recording it in
+   # the journal.  Commands may ask for a backend of their own (see
+   # get_job_backend()).  entry is the journal entry of an unfinished job
+   # being resumed (see resume_job()).  A quiet job is neither announced
+   # nor notified when it finishes
+   def background(self, func, arg, cmd, line, entry=None, quiet=False):
+       from jobs import CancellationToken
+       if entry is None:
+           self.notify_unfinished_jobs()
+           entry = self.journal.start(line, getattr(self.current_plugin, 'plugin_path', None),
+                                      self.get_option_values())
+       else:
+           self.journal.resume(entry)
+       token = CancellationToken()
+       self.journaled[token] = entry
+       future = self.job_executor.submit(ChildCommand(self, func, arg, line, entry),
+                                         timeout=self.get_job_timeout(),
+                                         backend=self.get_job_backend(func, arg),
+                                         output=self.new_job_output(), token=token)
+       job = self.jobs.add(self.current_plugin_name + '/' + cmd, line, future)
+       job.notify = not quiet
+       if not quiet:
+           print('backgrounding job {}'.format(job.job_id))
+       future.add_done_callback(lambda f: self.finished_job_callback(job))
+       return job
 
-       # build a dict of jobs indexed by job_id
-       jobs = dict(zip((j.job_id for j in self.jobs), (j for j in self.jobs)))
+   # return the backend a backgrounded command asks for through its job_backend
+   # attribute, None for the JOB_BACKEND global option's.  Commands which send
+   # probes (with a true sends_probes attribute), and pipelines with such a
+   # stage, run on a thread: a child process would pace them with a probe
+   # scheduler of its own, ignoring the probes of every other job
+   def get_job_backend(self, func, arg):
+       from jobs import THREAD
+       funcs = [stage[0] for stage in arg] if func == self.run_pipeline else [func]
+       if any(getattr(f, 'sends_probes', False) for f in funcs):
+           return THREAD
+       return getattr(func, 'job_backend', None)
+
+   # tell the user, once, about the jobs an earlier session left unfinished in
+   # the journal.  Called as the first job is journaled; silent in batch mode
+   def notify_unfinished_jobs(self):
+       if self.unfinished_notified or self.batch_mode:
+           return
+       self.unfinished_notified = True
+       unfinished = len(self.journal.unfinished())
+       if unfinished:
+           print('{} unfinished jobs in the journal:  "jobs unfinished" lists them, "jobs resume" restarts them'.format(unfinished))
+       elif self.journal.shared:
+           print('The journal is in use by another Bywaf session:  its unfinished jobs are left to that one')
+
+   # return the current plugin's option values, as { name : value }
+   def get_option_values(self):
+       if not self.current_plugin:
+           return {}
+       return dict((name, option[0]) for name, option in self.current_plugin.options.items())
+
+   # record the progress of the backgrounded job calling this method in the journal,
+   # so that it is resumed from there should it not finish.  state is anything JSON
+   # can encode, e.g. the number of targets done.  Checkpoints are written at most
+   # once a second unless force is set.  Does nothing in the foreground
+   def checkpoint(self, state, force=False):
+       from jobs import current_token
+       entry = self.journaled.get(current_token())
+       if entry is not None:
+           self.journal.checkpoint(entry, state, force)
+
+   # return the state last checkpointed by the backgrounded job calling this method,
+   # None if there is none (i.e. the job is not being resumed)
+   def get_checkpoint(self):
+       from jobs import current_token
+       entry = self.journaled.get(current_token())
+       if entry is None:
+           return None
+       return entry.checkpoint
+
+   # run an unfinished job of the journal again: select its plugin, restore the
+   # plugin's options as they were and background its command line.  Commands
+   # find their last checkpoint with get_checkpoint()
+   def resume_job(self, entry):
+       if entry.plugin_path and getattr(self.current_plugin, 'plugin_path', None) != entry.plugin_path:
+           self.do_use(entry.plugin_path)
+           if getattr(self.current_plugin, 'plugin_path', None) != entry.plugin_path:
+               return
+       for name, value in entry.options.items():
+           if name in self.current_plugin.options:
+               self.set_option(name, value)
+       try:
+           cmd, func, arg = self.parse_command(entry.command_line)
+       except ValueError as e:
+           print('Could not resume {}: {}'.format(entry.key, e))
+           return
+       print('resuming {}: {}'.format(entry.key, entry.command_line))
+       self.background(func, arg, cmd, entry.command_line, entry)
+
+   # return the cancellation token (see jobs.CancellationToken) of the backgrounded job
+   # calling this method, None when called from a command running in the foreground.
+   # Long-running plugin commands call its check() method between units of work
+   def get_cancellation_token(self):
+       from jobs import current_token
+       return current_token()
+
+   # return the deadline of newly-backgrounded jobs, in seconds (None for no deadline)
+   def get_job_timeout(self):
+       try:
+           return float(self.global_options['JOB_TIMEOUT']) or None
+       except (KeyError, ValueError):
+           return None
+
+   # split a line at its stand-alone | (with blanks on both sides, outside
+   # quotes), e.g. "command1 args | command2 args", into the lines of its
+   # stages.  A line without one is a stage of its own
+   def split_pipeline(self, line):
+       stages = []
+       quote = None
+       start = 0
+       for index, char in enumerate(line):
+           if quote:
+               if char == quote:
+                   quote = None
+           elif char in '"\'':
+               quote = char
+           elif (char == '|' and 0 < index < len(line) - 1
+                 and line[index - 1].isspace() and line[index + 1].isspace()):
+               stages.append(line[start:index].strip())
+               start = index + 1
+       stages.append(line[start:].strip())
+       return stages
+
+   # turn the lines of a pipeline's stages (see split_pipeline()) into a list of
+   # (function, args) stages.  Raises ValueError if a stage cannot be run
+   def parse_pipeline(self, stage_lines):
+       from pipeline import accepts_records
+       stages = []
+       for position, stage_line in enumerate(stage_lines):
+           cmd, arg, stage_line = self.parseline(stage_line)
+           if not cmd:
+               raise ValueError('empty command in pipeline')
+           try:
+               func = getattr(self, 'do_' + cmd)
+           except AttributeError:
+               raise ValueError('command "{}" not found'.format(cmd))
+           if position > 0 and not accepts_records(func):
+               raise ValueError('command "{}" does not read records from a pipeline'.format(cmd))
+           stages.append((func, arg))
+       return stages
+
+   # run the stages of a pipeline concurrently (see pipeline.Pipeline), printing
+   # the records coming out of the last one as they come
+   def run_pipeline(self, stages):
+       from pipeline import Pipeline
+       Pipeline(stages, int(self.global_options['PIPELINE_QUEUE_SIZE'])).run(self.print_record)
+
+   # print a record coming out of a pipeline: dictionaries and lists as JSON
+   def print_record(self, record):
+       if isinstance(record, (dict, list, tuple)):
+           print(json.dumps(record, sort_keys=True, default=str))
+       else:
+           print(record)
+
+   # return a new output buffer (see jobs.OutputBuffer) for a backgrounded job
+   def new_job_output(self):
+       from jobs import OutputBuffer
+       return OutputBuffer(int(self.global_options['JOB_OUTPUT_MEMORY']),
+                           int(self.global_options['JOB_OUTPUT_MAX_BYTES']))
+
+   # utility method to print a job's output a page at a time, reading only a
+   # page's worth of it at once.  Asks before every page when used interactively
+   def page_output(self, output):
+       offset = 0
+       lines = 0
+       decoder = codecs.getincrementaldecoder('utf-8')('replace')
+       interactive = self.use_rawinput and sys.stdin.isatty()
+       while True:
+           if output.first_offset() > offset:
+               print('[{} bytes of earlier output dropped]'.format(output.first_offset() - offset))
+           data, offset = output.read(offset, OUTPUT_READ_SIZE)
+           if not data:
+               return
+           self.write_output(data, decoder)
+           lines += data.count(b'\n')
+           if interactive and lines >= OUTPUT_PAGE_LINES and offset < output.size:
+               sys.stdout.write('-- More -- (Enter to continue, q to stop) ')
+               sys.stdout.flush()
+               if sys.stdin.readline().strip().lower().startswith('q'):
+                   return
+               lines = 0
 
-       # try and return the job, None if it was not there
+   # utility method to print a job's output as it is printed, until the job ends or
+   # the user hits Ctrl-C
+   def follow_output(self, output):
+       offset = 0
+       decoder = codecs.getincrementaldecoder('utf-8')('replace')
        try:
-           job = jobs[job_id]
-       except KeyError:
-           pass
-       
-       return job
+           # wake up regularly, so that Ctrl-C gets through
+           while output.wait(offset, timeout=0.5):
+               data, offset = output.read(offset, OUTPUT_READ_SIZE)
+               self.write_output(data, decoder)
+       except KeyboardInterrupt:
+           print('')
+
+   # write raw job output to standard output
+   def write_output(self, data, decoder):
+       if str is bytes:  # python 2 writes the bytes as they are
+           sys.stdout.write(data)
+       else:
+           sys.stdout.write(decoder.decode(data))
+       sys.stdout.flush()
+
+   # return a job (see jobs.Job) given its job ID as a string or int, None if it was not there
+   def get_job(self, _job_id):
+       return self.jobs.get(int(_job_id))
    
-   # update list of newly-finished jobs 
+   # move a finished job out of the running state and update list of newly-finished jobs 
    def finished_job_callback(self, finished_job):
-       self.finished_jobs.append(finished_job)
+       from jobs import FAILED
+       # record the job's end in the journal: it will not be resumed
+       entry = self.journaled.pop(finished_job.token, None)
+       if entry is not None:
+           future = finished_job.future
+           error = future.exception() if not future.cancelled() else Exception('job was cancelled')
+           self.journal.finish(entry, None if error else future.result(), error)
+       if self._scheduler is not None:
+           finished_job.probe_stats = self._scheduler.forget(finished_job.token)
+       self.jobs.finish(finished_job)
+       if finished_job.state == FAILED:
+           self.job_failures += 1
+
+       # nobody is notified in batch mode, so do not keep the job around for it
+       if not self.batch_mode and finished_job.notify:
+           self.finished_jobs.append(finished_job)
+
+   # wait until running jobs (all of them, or those with the given IDs) are over,
+   # or until no more than max_running of them are still running.  Returns False
+   # if the wait was interrupted with Ctrl-C
+   def wait_jobs(self, job_ids=None, max_running=0):
+       import concurrent.futures
+       from jobs import RUNNING
+       try:
+           while True:
+               futures = []
+               for job_id in list(self.jobs.ids(RUNNING) if job_ids is None else job_ids):
+                   job = self.jobs.get(job_id)
+                   future = job and job.future
+                   if future is not None:
+                       futures.append(future)
+               if len(futures) <= max_running:
+                   return True
+               # a finished job leaves the running state once its callback returns
+               if concurrent.futures.wait(futures, timeout=0.5,
+                                          return_when=concurrent.futures.FIRST_COMPLETED).done:
+                   time.sleep(0.01)
+       except KeyboardInterrupt:
+           return False
+
+   # run command lines one at a time, as they are read, without prompts or
+   # notifications.  A command raising an exception is reported and counted,
+   # and the lines after it are still run.  Stops early if a command quits
+   def run_lines(self, lines, source='<batch>'):
+       for number, line in enumerate(lines, 1):
+           try:
+               if self.onecmd(line):
+                   self.batch_quit = True
+           except Exception as e:
+               self.command_errors += 1
+               sys.stderr.write('{}:{}: {}: {}\n'.format(source, number, line.strip(), e))
+           if self.batch_quit:
+               return
+
+   # run the lines of a script concurrently, as jobs of their own, up to max_running
+   # at once.  The commands in SCRIPT_BARRIERS are barriers: they wait for the lines
+   # before them, then run in the foreground before any line after them starts, so
+   # that "use", "set" and "gset" apply to the lines they were meant for.  Prints a
+   # summary of every line's outcome once the script is over
+   def run_parallel_script(self, lines, max_running):
+       outcomes = []  # (line number, line, job or None, error)
+       running = []   # IDs of the jobs of this script which may still be running
+       interrupted = False
+
+       for number, line in enumerate(lines, 1):
+           line = line.strip()
+           if line.endswith('&'):
+               line = line[:-1].strip()
+           if not line or line.startswith('#'):
+               continue
+
+           cmd, arg = self.parseline(line)[:2]
+           if cmd in SCRIPT_BARRIERS or cmd in ('EOF', 'quit', 'exit'):
+               if not self.wait_jobs(running):
+                   interrupted = True
+                   break
+               running = []
+               if cmd in ('EOF', 'quit', 'exit'):
+                   break
+
+               # a bare "wait" only waits for the lines before it
+               if cmd == 'wait' and not arg:
+                   outcomes.append((number, line, None, None))
+                   continue
+               errors = self.command_errors
+               try:
+                   self.onecmd(line)
+               except Exception as e:
+                   self.command_errors += 1
+                   outcomes.append((number, line, None, str(e)))
+                   continue
+               outcomes.append((number, line, None, 'failed' if self.command_errors > errors else None))
+               continue
+
+           try:
+               cmd, func, arg = self.parse_command(line)
+           except ValueError as e:
+               self.command_errors += 1
+               outcomes.append((number, line, None, str(e)))
+               continue
+
+           # wait for a free slot
+           if not self.wait_jobs(running, max_running - 1):
+               interrupted = True
+               break
+           job = self.background(func, arg, cmd, line, quiet=True)
+           running = [j for j in running if self.jobs.get(j) and self.jobs.get(j).running()] + [job.job_id]
+           outcomes.append((number, line, job, None))
+
+       if not interrupted:
+           interrupted = not self.wait_jobs(running)
+       self.show_script_summary(outcomes)
+       if interrupted:
+           print('Interrupted: the lines after the last one shown were not run, running jobs carry on')
+
+   # print the outcome of every line run by run_parallel_script()
+   def show_script_summary(self, outcomes):
+       from jobs import FAILED
+       format_string = "{:>6.6} {:>6.6} {:<10.10} {:<30.30} {}"
+       print(format_string.format("Line", "Job", "Status", "Command", "Error"))
+       print(format_string.format(*["-"*30]*5))
+       counts = {}
+       for number, line, job, error in outcomes:
+           job_id, status = '', 'Completed'
+           if job is not None:
+               job_id = str(job.job_id)
+               if job.running():
+                   status = 'Running'
+               elif job.state == FAILED:
+                   status, error = 'Failed', job.exception
+           elif error is not None:
+               status = 'Failed'
+           counts[status] = counts.get(status, 0) + 1
+           print(format_string.format(str(number), job_id, status, line, error or ''))
+       print('{} lines: {}'.format(len(outcomes), ', '.join('{} {}'.format(counts[status], status.lower())
+                                                             for status in ('Completed', 'Failed', 'Running')
+                                                             if status in counts) or 'none run'))
+
+   # run a script headless (bywaf.py --batch): its lines are streamed through
+   # run_lines(), so a script of any length runs in constant memory, then the
+   # backgrounded jobs are waited for.  Returns the exit status: 0 if every
+   # command ran and every backgrounded job succeeded, 1 otherwise, and 130
+   # if interrupted with Ctrl-C
+   def run_batch(self, lines, source='<batch>'):
+       self.batch_mode = True
+       self.use_rawinput = False
+       try:
+           self.run_lines(lines, source)
+       except KeyboardInterrupt:
+           return 130
+       if not self.wait_jobs():
+           return 130
+       if self.command_errors or self.job_failures:
+           sys.stderr.write('{} commands failed, {} jobs failed\n'.format(self.command_errors, self.job_failures))
+           return 1
+       return 0
+
+   # flush and close the host database, job registry and journal on exit,
+   # and write the metrics file a last time
+   def close(self):
+       if self._hostdb is not None:
+           self._hostdb.flush()
+       if self._jobs is not None:
+           self._jobs.close()
+       if self._journal is not None:
+           self._journal.close()
+       if self.metrics_writer is not None:
+           self.metrics_writer.stop()
+           self.metrics_writer = None
+
+   # complete job IDs of the jobs in the given state
+   def complete_job_ids(self, text, state=None):
+       return [str(i)+' ' for i in self.jobs.ids(state) if str(i).startswith(text)]
+
+   # apply a new job retention limit (0 meaning no limit).  Called by do_gset()
+   def set_job_retention(self, name, value):
+       try:
+           limit = int(value) or None
+       except ValueError:
+           raise ValueError('must be a number')
+       if self._jobs is not None:
+           setattr(self._jobs, name, limit)
+           self._jobs.apply_retention()
+
+   # global option setter callbacks, called by do_gset() as gset_<OPTION NAME>(value).
+   # A callback raises ValueError to reject a value
+   def gset_MAX_CONCURRENT_JOBS(self, value):
+       try:
+           max_workers = int(value)
+       except ValueError:
+           raise ValueError('must be a number')
+       if max_workers < 1:
+           raise ValueError('must be at least 1')
+       if self._job_executor is not None:
+           self._job_executor.resize(max_workers)
+
+   def gset_PROBE_RATE_PER_HOST(self, value):
+       rate = self.parse_rate(value)
+       if self._scheduler is not None:
+           self._scheduler.configure(host_rate=rate)
+
+   def gset_PROBE_BURST_PER_HOST(self, value):
+       burst = self.parse_rate(value)
+       if self._scheduler is not None:
+           self._scheduler.configure(host_burst=burst)
+
+   def gset_PROBE_RATE_GLOBAL(self, value):
+       rate = self.parse_rate(value)
+       if self._scheduler is not None:
+           self._scheduler.configure(global_rate=rate)
+
+   # parse a probe rate (0 meaning no limit)
+   def parse_rate(self, value):
+       try:
+           rate = float(value)
+       except ValueError:
+           raise ValueError('must be a number')
+       if rate < 0:
+           raise ValueError('must not be negative')
+       return rate
+
+   def gset_PIPELINE_QUEUE_SIZE(self, value):
+       if not value.isdigit() or int(value) < 1:
+           raise ValueError('must be a positive number')
+
+   def gset_JOB_OUTPUT_MEMORY(self, value):
+       if not value.isdigit():
+           raise ValueError('must be a number')
+
+   def gset_JOB_OUTPUT_MAX_BYTES(self, value):
+       if not value.isdigit():
+           raise ValueError('must be a number')
+
+   def gset_JOB_BACKEND(self, value):
+       from jobs import BACKENDS
+       if value not in BACKENDS:
+           raise ValueError('must be one of {}'.format(', '.join(BACKENDS)))
+       if self._job_executor is not None:
+           self._job_executor.set_backend(value)
+
+   def gset_JOBS_MAX_COUNT(self, value):
+       self.set_job_retention('max_jobs', value)
+
+   def gset_JOBS_MAX_AGE(self, value):
+       self.set_job_retention('max_age', value)
+
+   def gset_JOBS_MAX_RESULT_BYTES(self, value):
+       self.set_job_retention('max_result_bytes', value)
+
+   # write the metrics to a file (none if empty) every METRICS_INTERVAL seconds
+   def gset_METRICS_FILE(self, value):
+       self.start_metrics_writer(value, self.global_options['METRICS_INTERVAL'])
+
+   def gset_METRICS_INTERVAL(self, value):
+       try:
+           if float(value) <= 0:
+               raise ValueError
+       except ValueError:
+           raise ValueError('must be a positive number')
+       self.start_metrics_writer(self.global_options['METRICS_FILE'], value)
+
+   # (re)start the thread writing the metrics file, or stop it if filename is empty
+   def start_metrics_writer(self, filename, interval):
+       if self.metrics_writer is not None:
+           self.metrics_writer.stop()
+           self.metrics_writer = None
+       if filename:
+           from metrics import MetricsWriter
+           self.metrics_writer = MetricsWriter(self.metrics, filename, float(interval))
        
-   # physically load a module (called from do_import)
-   # implementation adapted from http://stackoverflow.com/questions/301134/dynamic-module-import-in-python   
+   # physically load a module (called from do_use).  Modules already loaded
+   # are returned as they are, unless their file changed (see pluginregistry)
    def _load_module(self, filepath):
        
-       py_mod = None
-       
-       # extract module's name and extension from filepath
-       mod_name,file_ext = os.path.splitext(os.path.split(filepath)[-1])
+       # extract module's name from filepath
+       mod_name = os.path.splitext(os.path.split(filepath)[-1])[0]
        
-       # if it is a precompiled module, use the precompiled loader
-       if file_ext.lower() == '.pyc':
-           try:
-               py_mod = imp.load_compiled(mod_name, filepath)
-           except Exception as e:
-               raise Exception('Could not load precompiled plugin module: {}'.format(e))
-           
-       # else just try to load it with the standard loader
-       else:
-           
-           py_mod = imp.load_source(mod_name, filepath)
-           try:
-               pass
-           except Exception as e:
-               raise Exception('Could not load plugin module: {}'.format(e))
+       py_mod = self.command_registry.load(filepath, mod_name)
                                               
        # verify that this module has the necessary Bywaf infrastructure
        if not hasattr(py_mod, "options"):
@@ -328,20 +964,24 @@ class WAFterpreter(Cmd):
    # retrieve command history
    # code adapted from pymotw.com/2/readline/
    def get_history_items(self):
+       import readline
        return [ readline.get_history_item(i)
                 for i in xrange(1, readline.get_current_history_length() + 1)
                 ]
 
    # try to write history to disk.  It is the caller's responsibility to handle exceptions
    def save_history(self, filename):
+       import readline
        readline.write_history_file(filename)
 
    # read history in, if it exists  It is the caller's responsibility to handle exceptions                
    def load_history(self, filename):
+       import readline
        readline.read_history_file(filename)
 
    # clear command history
    def clear_history(self):
+       import readline
        readline.clear_history()
 
 
@@ -360,48 +1000,48 @@ class WAFterpreter(Cmd):
            print('Could not load module {}: {}'.format(filepath,e))
            return
 
-       # if this plugin has already been loaded, notify user.
-       # this will revert any changes they made to the options
-       if self.current_plugin_name == new_module_name:
-           print('Import:  Overwriting already loaded module "{}"'.format(new_module_name))
-
-       # give the new module access to other modules
-       new_module.app = self           
-           
-       # remove currently selected plugin's functions from the Cmd command list
+       # a plugin used before is switched to as it is, options included.  A
+       # plugin loaded for the first time (or anew, because its file changed)
+       # is set up once, keeping the option values set in its previous version
+       if self.plugins.get(new_module_name) is not new_module:
+           old_module = self.plugins.get(new_module_name)
+           if old_module is not None and getattr(old_module, 'plugin_path', None) == filepath:
+               print('Reloaded changed module "{}"'.format(new_module_name))
+               for name, option in old_module.options.items():
+                   if name in new_module.options:
+                       new_module.options[name] = (option[0],) + tuple(new_module.options[name][1:])
+
+           # give the new module access to other modules
+           new_module.app = self           
+
+           # register with our list of modules (i.e., insert into our dictionary of modules)
+           self.plugins[new_module_name] = new_module
+
+           # store command list
+           new_module_dir = dir(new_module)
+           # IMPORTANT: these will pop up when we prompt 'show',
+           # these are NOT all the functions and do not include help_ and complete_
+           # as these are utility functions
+           new_module.commands = [f for f in new_module_dir if f.startswith('do_')]
+
+           # the commands and their utility functions, registered whenever the plugin is selected
+           new_module.command_handlers = dict((name, getattr(new_module, name)) for name in new_module_dir
+                                              if name.startswith(('do_', 'complete_', 'help_')))
+
+           # give plugin a link to its own path
+           new_module.plugin_path = filepath
+
+       # swap the currently selected plugin's functions in the Cmd command list for the new one's
        if self.current_plugin:
-           for _command in self.current_plugin.commands:
-               command = _command.__name__
-               if hasattr(self, command):  delattr(self, command)
-               if hasattr(self, 'help_'+command):  delattr(self, 'help_'+command[5:])
-               if hasattr(self, 'complete_'+command):  delattr(self, 'complete_'+command[10:])
-
-       # register with our list of modules (i.e., insert into our dictionary of modules)
-       self.plugins[new_module_name] = new_module
-       
-       # store command list
-       new_module_dir = dir(new_module)
-       # IMPORTANT: these will pop up when we prompt 'show',
-       # these are NOT all the functions and do not include help_ and complete_
-       # as these are utility functions
-       commands = [f for f in new_module_dir if f.startswith('do_')]
-       self.plugins[new_module_name].commands = commands
-
-       # give plugin a link to its own path
-       self.plugins[new_module_name].plugin_path = filepath
+           for attr in self.current_plugin.command_handlers:
+               self.__dict__.pop(attr, None)
+       self.__dict__.update(new_module.command_handlers)
        
        # set current plugin
        # and change the prompt to reflect the plugin's name
        self.set_prompt(new_module_name)
        self.current_plugin_name = new_module_name
        self.current_plugin = new_module
-       
-       # register the utility functions
-       for command_name in [command for command in new_module_dir if command.startswith('complete_') or command.startswith('help_')]:
-           # register the command
-           # it is a tuple of the form (function, string)
-           command_func = getattr(new_module, command_name)
-           setattr(self, command_name, command_func)
 
    def complete_use(self,text,line,begin_idx,end_idx):
        return self.filename_completer(text, line, begin_idx, end_idx, root_dir=self.global_options['PLUGIN_PATH'])
@@ -421,21 +1061,22 @@ class WAFterpreter(Cmd):
        for job_id in job_ids:
          job = self.get_job( job_id )
          
-         # ...and try to end them
-         try:
-             # this doesn't cancel the job, it just stops a job from starting
-#             result = job.cancel() 
-
-             job.Canceled = True
-             print("result is {}".format(result))
-         except:
+         if not job:
              print('Job ID {} not found'.format(job_id))
+             continue
+
+         # ...and try to end them.  This frees the job's executor thread
+         # straight away, even if the job does not check its cancellation token
+         future = job.future
+         if future is None or self._job_executor is None or not self._job_executor.kill(future):
+             print('Job {} is not running'.format(job_id))
+         else:
+             print('Job {} killed'.format(job_id))
 
              
    def complete_kill(self,text,line,begin_idx,end_idx):
-       job_ids  = [str(j.job_id) for j in self.jobs if not j.done()]
-       opts = [x+' ' for x in job_ids if x.startswith(text)]
-       return opts
+       from jobs import RUNNING
+       return self.complete_job_ids(text, RUNNING)
 
    def do_d(self, args):
        """remove one or more completed jobs from the jobs queue"""
@@ -447,68 +1088,94 @@ class WAFterpreter(Cmd):
            return
 
        for job_id in job_ids:
-         # loop through jobs list looking for a job with a matching job_id ,
-         for (i,item) in enumerate(self.jobs):
-           
-             # match found, so remove it.  Fail if this job is currently running.
-             if item.job_id == job_id:
-                 if item.running():
-                     print('Job {} is still running!'.format(job_id))
-                     break
-
-                 # remove from job queue
-                 del self.jobs[i]
-                 break
-         else:
-             print('Job ID {} not found'.format(job_id))
+           # remove the job from the registry.  Fail if this job is currently running.
+           try:
+               if not self.jobs.remove(job_id):
+                   print('Job {} is still running!'.format(job_id))
+           except KeyError:
+               print('Job ID {} not found'.format(job_id))
 
-   # completion function for the kill command: return only running jobs
+   # completion function for the d command: return only completed jobs
    def complete_d(self,text,line,begin_idx,end_idx):
-       job_ids  = [str(j.job_id) for j in self.jobs if j.done()]
-       opts = [x+' ' for x in job_ids if x.startswith(text)]
-       return opts                        
+       from jobs import DONE, FAILED
+       return self.complete_job_ids(text, DONE) + self.complete_job_ids(text, FAILED)
            
-   def do_result(self, _job_id):
-       """show the result of a job given its ID number"""
+   def do_result(self, args):
+       """show the output and result of a job given its ID number.  'result -f <JOBID>' follows a running job's output"""
        
+       params = args.split()
+       follow = '-f' in params
+       if follow:
+           params.remove('-f')
+
        try:
-           job_id = int(_job_id)
+           job_id = int(params[0])
        except:
-           print('usage: result <JOBID> or just <JOBID>')
+           print('usage: result [-f] <JOBID> or just <JOBID>')
            return
        
-       jobs = dict(zip((j.job_id for j in self.jobs), (j for j in self.jobs)))
+       job = self.jobs.get(job_id)
 
-       # verify that job ID is valid
-       if job_id in jobs.keys():
-           
-           job = jobs[job_id]
-
-           # print job result if it is available, else notify user and return empty
-           if job.running():
-               print('Job {} still running'.format(job_id))
-               return
-
-           # else return the job's result
-           else:
-               result_text =  job.result()
-               print(result_text)
-           
        # if job ID is not valid, print error and return
-       else:
+       if not job:
            print('Job ID {} not found'.format(job_id))
+           return
+
+       # show what the job printed, following it if asked to
+       if job.output is not None:
+           if follow:
+               self.follow_output(job.output)
+           else:
+               self.page_output(job.output)
+
+       # print job result if it is available, else notify user and return empty
+       if job.running():
+           print('Job {} still running'.format(job_id))
+           return
+
+       # else show the job's result
+       try:
+           result =  job.result()
+       except Exception as e:
+           print('Job {} failed: {}'.format(job_id, e))
+           return
+       if result is not None:
+           print(result)
            
-   # completion function for the do_result command: return only completed jobs
+   # completion function for the do_result command: return the IDs of all jobs
    def complete_result(self,text,line,begin_idx,end_idx):
-       job_ids  = [str(j.job_id) for j in self.jobs if j.done()]
-       opts = [x+' ' for x in job_ids if x.startswith(text)]
-       return opts                                   
+       return self.complete_job_ids(text)
+
+   def do_script(self, args):
+       """Load a script file.  'script -j N <FILE>' runs up to N of its lines at once"""
+
+       # script -j N <FILE>
+       scriptfilename = args.strip()
+       max_running = None
+       if scriptfilename.startswith('-j'):
+           try:
+               _, max_running, scriptfilename = scriptfilename.split(None, 2)
+               max_running = int(max_running)
+               if max_running < 1:
+                   raise ValueError
+           except ValueError:
+               print('usage: script [-j N] <FILE>')
+               self.command_errors += 1
+               return
 
-   def do_script(self, scriptfilename):
-       """Load a script file"""
        try:
            with open(scriptfilename) as scriptfile:
 
+               # run the lines of a parallel script as they are read
+               if max_running:
+                   self.run_parallel_script(scriptfile, max_running)
+                   return
+
+               # in batch mode, run the lines as they are read
+               if self.batch_mode:
+                   self.run_lines(scriptfile, scriptfilename)
+                   return
+
                # loop over every input lines...
                for line in scriptfile:
                    # ...adding it to the command queue in turn.  
@@ -517,47 +1184,281 @@ class WAFterpreter(Cmd):
                    
        except IOError as e: 
            print('Could not load script file: {}'.format(e))
+           self.command_errors += 1
+
+   def do_wait(self, args):
+       """wait for running jobs to finish: all of them, or those whose IDs are given.  Ctrl-C stops waiting"""
+
+       try:
+           job_ids = [int(i) for i in args.split()]
+       except ValueError:
+           print('usage: wait [<JOB> ...  <JOBN>]')
+           return
+
+       found = [job_id for job_id in job_ids if self.jobs.get(job_id)]
+       for job_id in set(job_ids) - set(found):
+           print('Job ID {} not found'.format(job_id))
+       if job_ids and not found:
+           return
+       self.wait_jobs(found or None)
+
+   def complete_wait(self,text,line,begin_idx,end_idx):
+       from jobs import RUNNING
+       return self.complete_job_ids(text, RUNNING)
 
    def complete_script(self,text,line,begin_idx,end_idx):
        return self.filename_completer(text, line, begin_idx, end_idx, root_dir=self.global_options['PLUGIN_PATH'])
 
    # fix: change printing to new style (with appends to a list and printing only at the end)
    def do_jobs(self, args):
-       """list the status of running and completed jobs"""
+       """list the status of running and completed jobs.  Takes an optional state: running, done or failed.
+       'jobs unfinished' lists the jobs of the journal which never finished, 'jobs resume [KEY ...]' restarts them"""
+       from jobs import RUNNING, DONE, FAILED, STATES, PROCESS
        
+       params = args.split()
+       if params and params[0] == 'unfinished':
+           self.show_unfinished_jobs()
+           return
+       if params and params[0] == 'resume':
+           self.resume_jobs(params[1:])
+           return
+
+       state = args.strip() or None
+       if state and state not in STATES:
+           print('usage: jobs [{}|unfinished|resume [KEY ...]]'.format('|'.join(STATES)))
+           return
+
        # total number of jobs in the queue or completed
-       total_jobs = len(self.jobs)
+       total_jobs = self.jobs.count()
        
        # return if there is nothing to show
        if total_jobs == 0:
            print('No jobs completed or currently running.')
            return
        
-       # loop over futures objects and tally results
-       jobs_completed = len([j for j in self.jobs if j.done()])
-       print('{} jobs total:  {} complete, {} running\n'.format(total_jobs, jobs_completed, total_jobs-jobs_completed))
+       # tally results from the registry's and the probe scheduler's counters
+       print('{} jobs total:  {} complete, {} failed, {} running'.format(
+           total_jobs, self.jobs.count(DONE), self.jobs.count(FAILED), self.jobs.count(RUNNING)))
+       probes = self.scheduler.total
+       print('{} probes queued, {} sent, average wait {:.0f} ms\n'.format(
+           probes.waiting, probes.sent, probes.average_wait()*1000))
        
        # construct the format string:  left-aligned, space-padded, minimum.maximum
-       format_string = "{:<4.4} {:<20.20} {:<15.15}"
+       format_string = "{:<6.6} {:<20.20} {:<10.10} {:>8.8} {:>8.8} {:>10.10}"
        
        # print the header
-       print(format_string.format("ID", "Command", "Status"))
-       print(format_string.format(*["-"*20]*3))
-       
-       # loop through the jobs and display each
-       for j in self.jobs:
-           status = ''
-           if j.done():
-               status = 'Completed'
-           elif j.running():
-               status = 'Running'
-               
-           print(format_string.format( str(j.job_id), j.command_line, status ))
+       print(format_string.format("ID", "Command", "Status", "Queued", "Sent", "Wait (ms)"))
+       print(format_string.format(*["-"*20]*6))
+       
+       # loop through the jobs (or those in the requested state) and display each.
+       # Process-backed jobs are flagged: their probes bypass the probe scheduler
+       status_names = {RUNNING: 'Running', DONE: 'Completed', FAILED: 'Failed'}
+       unpaced = False
+       for job_id in self.jobs.ids(state):
+           j = self.jobs.get(job_id)
+           if j:
+               stats = j.probe_stats
+               if j.running():
+                   stats = self.scheduler.job_stats(j.token)
+               queued, sent, wait = '', '', ''
+               if stats:
+                   queued, sent, wait = str(stats.waiting), str(stats.sent), '{:.0f}'.format(stats.average_wait()*1000)
+               status = status_names[j.state]
+               if j.backend == PROCESS:
+                   status += '*'
+                   unpaced = True
+               print(format_string.format( str(j.job_id), j.command_line, status, queued, sent, wait ))
+       if unpaced:
+           print('\n* run in a child process:  its probes, if any, are not rate-limited')
+
+   def do_stats(self, args):
+       """show the timings and counts recorded for commands, jobs, probes and host database writes.
+       'stats PREFIX' only shows the metrics whose name starts with PREFIX, 'stats prometheus' prints
+       them in the Prometheus text format and 'stats reset' zeros them"""
+
+       arg = args.strip()
+       if arg == 'reset':
+           self.metrics.reset()
+           print('Metrics reset')
+           return
+       if arg == 'prometheus':
+           sys.stdout.write(self.metrics.exposition())
+           return
+
+       metrics = [m for m in self.metrics if m.name.startswith(arg)]
+       histograms = [(m, labels, series) for m in metrics if m.kind == 'histogram' for labels, series in m.items()]
+       counters = [m for m in metrics if m.kind == 'counter' and m.items()]
+       if not histograms and not counters:
+           print('No metrics recorded yet.')
+           return
+
+       # construct the format string:  left-aligned, space-padded, minimum.maximum
+       if histograms:
+           format_string = '{:<28.28} {:<36.36} {:>8.8} {:>9.9} {:>9.9} {:>9.9}'
+           print(format_string.format('Timing', 'Labels', 'Count', 'Avg (ms)', 'p50 (ms)', 'p99 (ms)'))
+           print(format_string.format(*["-"*36]*6))
+           for m, labels, series in histograms:
+               counts, total, count = series
+               print(format_string.format(m.name, self.format_labels(m.labels, labels), str(count),
+                                          '{:.1f}'.format(total / count * 1000),
+                                          '{:.1f}'.format(m.quantile(0.5, series) * 1000),
+                                          '{:.1f}'.format(m.quantile(0.99, series) * 1000)))
+           print('')
+
+       if counters:
+           format_string = '{:<36.36} {:<36.36} {:>14.14}'
+           print(format_string.format('Counter', 'Labels', 'Value'))
+           print(format_string.format(*["-"*36]*3))
+           for m in counters:
+               for labels, value in m.items():
+                   value = '{:.3f}'.format(value) if isinstance(value, float) else str(value)
+                   print(format_string.format(m.name, self.format_labels(m.labels, labels), value))
+
+               # for counts of hits and misses, show the hit ratio too
+               if m.labels == ('result',):
+                   hits, misses = m.value('hit'), m.value('miss')
+                   if hits + misses:
+                       print(format_string.format(m.name, 'hit ratio', '{:.1%}'.format(float(hits) / (hits + misses))))
+
+   def do_profile(self, args):
+       """run a command under cProfile and show its hotspots: 'profile [--mem] [--sort KEY] <COMMAND LINE>'.
+       --mem also traces memory (Python 3) and shows the peak and what is still allocated at the end.
+       Backgrounded ('profile ... &'), the report is the job's result, shown by 'result <JOBID>'"""
+       from profiling import profile_call, sort_keys, ProfileError, DEFAULT_SORT, DEFAULT_LINES
+
+       usage = 'usage: profile [--mem] [--sort {}] <COMMAND LINE>'.format('|'.join(sort_keys()))
+       params = args.split()
+       memory, sort = False, DEFAULT_SORT
+       while params and params[0].startswith('--'):
+           option = params.pop(0)
+           if option == '--mem':
+               memory = True
+           elif option == '--sort' and params and params[0] in sort_keys():
+               sort = params.pop(0)
+           else:
+               print(usage)
+               return
+       line = ' '.join(params)
+       if not line:
+           print(usage)
+           return
+
+       try:
+           cmd, func, arg = self.parse_command(line)
+           if cmd == 'profile':
+               raise ValueError('profile cannot profile itself')
+       except ValueError as e:
+           print(e)
+           self.command_errors += 1
+           return
+
+       # a command streaming records (e.g. the first stage of a pipeline) only
+       # does its work as they are read, so read them all within the profile
+       def run():
+           result = func(arg)
+           if isinstance(result, types.GeneratorType):
+               for record in result:
+                   self.print_record(record)
+               return None
+           return result
+
+       try:
+           report = profile_call(run, line, memory, sort, DEFAULT_LINES)
+       except ValueError as e:
+           print('profile: {}'.format(e))
+           self.command_errors += 1
+           return
+       except ProfileError as e:
+           # a backgrounded job fails, its report being its error
+           if self.get_cancellation_token() is not None:
+               raise
+           report = e.report
+           self.command_errors += 1
+
+       if self.get_cancellation_token() is not None:
+           return report
+       print(report)
+
+   def complete_profile(self,text,line,begin_idx,end_idx):
+       from profiling import sort_keys
+       words = line[:begin_idx].split()[1:]
+       if words and words[-1] == '--sort':
+           return [key+' ' for key in sort_keys() if key.startswith(text)]
+       if all(word.startswith('--') for word in words):
+           options = [o+' ' for o in ('--mem', '--sort') if o.startswith(text) and text.startswith('-')]
+           return options or self.completenames(text, line, begin_idx, end_idx)
+       return []
+
+   def complete_stats(self,text,line,begin_idx,end_idx):
+       names = ['reset', 'prometheus'] + [m.name for m in self.metrics]
+       return [name+' ' for name in names if name.startswith(text)]
+
+   # label names and values of a metric series, as "name=value,..."
+   def format_labels(self, names, values):
+       return ','.join('{}={}'.format(name, value) for name, value in zip(names, values))
+
+   def complete_jobs(self,text,line,begin_idx,end_idx):
+       from jobs import STATES
+       words = line.split()
+       if len(words) > 2 or (len(words) == 2 and not text):
+           if words[1] != 'resume':
+               return []
+           return [e.key+' ' for e in self.journal.unfinished() if e.key.startswith(text)]
+       return [s+' ' for s in STATES + ('unfinished', 'resume') if s.startswith(text)]
+
+   # list the jobs of the journal which never finished, and how far they got
+   def show_unfinished_jobs(self):
+       running = set(entry.key for entry in self.journaled.values())
+       entries = [entry for entry in self.journal.unfinished() if entry.key not in running]
+       if not entries:
+           print('No unfinished jobs in the journal.')
+           return
+
+       format_string = "{:<12.12} {:<19.19} {:<30.30} {}"
+       print(format_string.format("Key", "Started", "Command", "Checkpoint"))
+       print(format_string.format(*["-"*30]*4))
+       for entry in entries:
+           started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.started or 0))
+           checkpoint = '' if entry.checkpoint is None else json.dumps(entry.checkpoint, sort_keys=True)
+           print(format_string.format(entry.key, started, entry.command_line, checkpoint))
+
+   # resume the unfinished jobs of the journal with the given keys (all of them
+   # if no key is given), skipping those already running again
+   def resume_jobs(self, keys):
+       running = set(entry.key for entry in self.journaled.values())
+       entries = self.journal.unfinished()
+       if not entries:
+           print('No unfinished jobs in the journal.')
+           return
+       for key in set(keys) - set(entry.key for entry in entries):
+           print('Unfinished job {} not found'.format(key))
+       for entry in entries:
+           if keys and entry.key not in keys:
+               continue
+           if entry.key in running:
+               print('Job {} is already running'.format(entry.key))
+               continue
+           self.resume_job(entry)
         
    def do_gset(self, args):
        """set a global variable.  This command takes the form 'gset VARNAME VALUE'."""
 
-       (key,value)=string.split(args, maxsplit=1)
+       try:
+           (key,value) = args.split(None, 1)
+       except ValueError:
+           print('usage: gset VARNAME VALUE')
+           return
+       value = value.strip()
+
+       # defer first to the interpreter's setter callback for this option, if it exists
+       setter_func = getattr(self, 'gset_'+key, None)
+       if setter_func:
+           try:
+               setter_func(value)
+           except ValueError as e:
+               print('{} {}'.format(key, e))
+               return
+
        self.global_options[key] = value
        
        print('{} => {}'.format(key, value))
@@ -604,12 +1505,12 @@ class WAFterpreter(Cmd):
            return
 
        #set varibles to store options
-       name, value, next_name = ('', '', '', '')
+       name, value, next_name = ('', '', '')
 
        #is it only one 'set' ?
        if opt_count == 1:
            name,value = arg.split('=')
-           self.go_set(name, value)
+           self.set(name.strip(), value.strip())
 
        elif opt_count > 1:
            for i, param in enumerate(arg.split('=')):
@@ -820,6 +1721,201 @@ class WAFterpreter(Cmd):
            # re-use the filename completer, hard-code starting directory to '.'
            return self.filename_completer(text, line, begin_idx, end_idx, level=2, root_dir='.')
 
+
+# a backgrounded command, with what it takes to run its command line again
+# in a Bywaf of its own: the plugin, its option values, the global options
+# and the files of the host database and journal.  A process-backed job's
+# child gets it pickled, without the command's function (a plugin module
+# cannot be pickled) nor its parsed argument, and sets up that Bywaf to run
+# the line.  Elsewhere (and in a forked child) the function is called as it is
+class ChildCommand(object):
+
+   # global options left alone in the child: the interpreter writes the metrics file
+   PARENT_OPTIONS = ('METRICS_FILE',)
+
+   def __init__(self, app, func, arg, line, entry):
+       self.func = func
+       self.arg = arg
+       self.line = line
+       self.plugin_path = getattr(app.current_plugin, 'plugin_path', None)
+       self.options = app.get_option_values()
+       self.global_options = dict(app.global_options)
+       self.hostdb_filename = app.hostdb_filename
+       self.journal_filename = app.journal_filename
+       self.entry = entry
+
+   def __getstate__(self):
+       state = dict(self.__dict__)
+       state['func'] = state['arg'] = None
+       return state
+
+   def __call__(self):
+       if self.func is not None:
+           return self.func(self.arg)
+
+       app = WAFterpreter(hostdb_filename=self.hostdb_filename, journal_filename=self.journal_filename)
+       app.batch_mode = True
+       try:
+           for name, value in self.global_options.items():
+               if name in self.PARENT_OPTIONS or app.global_options.get(name) == value:
+                   continue
+               setter = getattr(app, 'gset_' + name, None)
+               if setter:
+                   setter(value)
+               app.global_options[name] = value
+           if self.plugin_path:
+               app.do_use(self.plugin_path)
+               if getattr(app.current_plugin, 'plugin_path', None) != self.plugin_path:
+                   raise RuntimeError('could not load plugin {}'.format(self.plugin_path))
+               for name, value in self.options.items():
+                   if name in app.current_plugin.options:
+                       app.set_option(name, value)
+
+           # checkpoints go to the parent's journal entry
+           if self.entry is not None:
+               from jobs import current_token
+               app.journaled[current_token()] = self.entry
+           cmd, func, arg = app.parse_command(self.line)
+           return func(arg)
+       finally:
+           # write the host database's queued rows before the child exits
+           app.close()
+
+
+# one client of a Bywaf daemon (see daemon.py).  A client has a plugin
+# selection and plugin options of its own, as with a Bywaf of its own, while
+# the job executor and registry, host database, probe scheduler, metrics,
+# journal and global options are those of the daemon's interpreter (core),
+# shared by every client.  What the session prints goes to stdout
+class DaemonSession(WAFterpreter):
+
+   def __init__(self, core, stdout):
+       Cmd.__init__(self, 'tab', None, stdout)
+       self.core = core
+       self.intro = ''
+       self.base_prompt = core.base_prompt
+       self.set_prompt('')
+       self.delegate_input_handler = None
+       self.use_rawinput = False
+
+       # plugins loaded with "use" are this client's own modules, compiled
+       # once for all clients; helper modules loaded by plugins are shared
+       self.plugins = {}
+       self.plugin_registry = core.plugin_registry
+       self.command_registry = PluginRegistry(core.plugin_registry.code)
+       self.current_plugin = None
+       self.current_plugin_name = ''
+
+       # shared with the daemon's interpreter (as are the members it sets up
+       # when first used, see the properties below)
+       self.global_options = core.global_options
+       self.journaled = core.journaled
+       self.running_commands = core.running_commands
+       self.running_commands_lock = core.running_commands_lock
+       self.hostdb_filename = core.hostdb_filename
+       self.journal_filename = core.journal_filename
+
+       self.unfinished_notified = False
+       self.finished_jobs = []
+       self.batch_mode = False
+       self.batch_quit = False
+       self.command_errors = 0
+       self.job_failures = 0
+
+   @property
+   def job_executor(self):
+       return self.core.job_executor
+
+   @property
+   def _job_executor(self):
+       return self.core._job_executor
+
+   @property
+   def _jobs(self):
+       return self.core._jobs
+
+   @property
+   def jobs(self):
+       return self.core.jobs
+
+   @property
+   def journal(self):
+       return self.core.journal
+
+   @property
+   def hostdb(self):
+       return self.core.hostdb
+
+   @property
+   def scheduler(self):
+       return self.core.scheduler
+
+   @property
+   def _scheduler(self):
+       return self.core._scheduler
+
+   @property
+   def metrics(self):
+       return self.core.metrics
+
+   def start_metrics_writer(self, filename, interval):
+       self.core.start_metrics_writer(filename, interval)
+
+   # background a command, unless the very same plugin command (same plugin,
+   # command line and option values) is already running for another client:
+   # then attach to that job, whose result and output are everybody's
+   def background(self, func, arg, cmd, line, entry=None, quiet=False):
+       if not self.current_plugin or 'do_' + cmd not in self.current_plugin.commands:
+           return WAFterpreter.background(self, func, arg, cmd, line, entry, quiet)
+       key = (self.current_plugin.plugin_path, line.strip(),
+              json.dumps(self.get_option_values(), sort_keys=True, default=str))
+       with self.running_commands_lock:
+           job = self.running_commands.get(key)
+           future = job and job.future
+           if future is not None and not future.done():
+               if not quiet:
+                   print('attaching to job {}, which is running the same command with the same options'.format(job.job_id))
+                   future.add_done_callback(lambda f: self.finished_jobs.append(job))
+               return job
+           job = WAFterpreter.background(self, func, arg, cmd, line, entry, quiet)
+           # a job lets its Future go once finished
+           future = job.future
+           if future is None:
+               return job
+           self.running_commands[key] = job
+       future.add_done_callback(lambda f: self.forget_running_command(key, job))
+       return job
+
+   def forget_running_command(self, key, job):
+       with self.running_commands_lock:
+           if self.running_commands.get(key) is job:
+               del self.running_commands[key]
+
+   # return the completions of the word between begidx and endidx of a command
+   # line, as Cmd.complete() does from readline's state
+   def complete_line(self, line, begidx, endidx):
+       stripped = len(line) - len(line.lstrip())
+       text = line[begidx:endidx]
+       line = line.lstrip()
+       begidx, endidx = begidx - stripped, endidx - stripped
+       if begidx > 0:
+           cmd = self.parseline(line)[0]
+           compfunc = getattr(self, 'complete_' + cmd, self.completedefault) if cmd else self.completedefault
+       else:
+           compfunc = self.completenames
+       try:
+           return list(compfunc(text, line, begidx, endidx) or [])
+       except Exception:
+           return []
+
+   # a client leaving leaves the shared state, and the jobs it started, as they are
+   def close(self):
+       self.finished_jobs = []
+
+   def postloop(self):
+       pass
+
+
 #prevents exceptions from bringing down the app
 #and offers options to handle the exception.
 def interpreter_loop():
@@ -868,14 +1964,32 @@ def interpreter_loop():
 if __name__=='__main__':
 
     # parse arguments
+    import argparse
     parser = argparse.ArgumentParser(description='Bypass web application firewalls')
     parser.add_argument('--input', dest='inputfilename', action='store', help='read input from a file')
     parser.add_argument('--script', dest='scriptfilename', action='store', help='execute a script and stay in wafterpreter')
+    parser.add_argument('--batch', dest='batchfilename', action='store', help='execute a script ("-" for standard input) headless, wait for its jobs and exit with its status')
     parser.add_argument('--out', dest='outfilename', action='store', help='redirect output to a file')
     parser.add_argument('--pluginpath', dest='plugin_path', action='store', help='specify the root plugin directory', default=DEFAULT_PLUGIN_PATH)
     parser.add_argument('--historyfilename', dest='history_filename', action='store', help='specify name of command history file', default=DEFAULT_HISTORY_FILENAME)
+    parser.add_argument('--hostdb', dest='hostdb_filename', action='store', help='specify name of the host database file', default=DEFAULT_HOSTDB_FILENAME)
+    parser.add_argument('--journal', dest='journal_filename', action='store', help='specify name of the job journal file', default=DEFAULT_JOURNAL_FILENAME)
+    parser.add_argument('--metrics', dest='metrics_filename', action='store', help='periodically write the metrics to a file, in the Prometheus text format')
+    parser.add_argument('--daemon', dest='daemon_socket', action='store', nargs='?', const=DEFAULT_SOCKET_FILENAME, help='serve clients on a UNIX socket (default %(const)s), sharing jobs, host database and limits between them')
+    parser.add_argument('--worker', dest='worker_address', action='store', help='identify the targets handed out by an identwaf coordinator at [HOST:]PORT, headless (the --script runs first, e.g. to set options)')
+    parser.add_argument('--connect', dest='connect_socket', action='store', nargs='?', const=DEFAULT_SOCKET_FILENAME, help='run commands in the daemon listening on a UNIX socket (default %(const)s)')
     args = parser.parse_args()
 
+    # a client only talks to the daemon, which does all the work
+    if args.connect_socket:
+        from daemon import run_client
+        sys.exit(run_client(args.connect_socket))
+
+    # a worker of a distributed scan (see distributed.py) runs a batch of two
+    # commands: select identwaf, and work for the coordinator
+    if args.worker_address:
+        args.batchfilename = '<worker>'
+
     # assign default input and output streams
     input = sys.stdin
     output = sys.stdout
@@ -897,14 +2011,24 @@ if __name__=='__main__':
         
 
     # initialize command interpreter 
-    wafterpreter = WAFterpreter(stdin=input, stdout=output)
-    
-    # automatically read history in, if it exists
+    wafterpreter = WAFterpreter(stdin=input, stdout=output, hostdb_filename=args.hostdb_filename,
+                                journal_filename=args.journal_filename)
+    wafterpreter.global_options['HOSTDB_FILENAME'] = args.hostdb_filename
+    wafterpreter.global_options['JOURNAL_FILENAME'] = args.journal_filename
+    if args.metrics_filename:
+        wafterpreter.gset_METRICS_FILE(args.metrics_filename)
+        wafterpreter.global_options['METRICS_FILE'] = args.metrics_filename
+
+    # automatically read history in, if it exists.  When not used interactively,
+    # commands are read straight from the input without readline
     wafterpreter.global_options['HISTORY_FILENAME'] = args.history_filename
-    try:
-        wafterpreter.load_history(wafterpreter.global_options['HISTORY_FILENAME'])#DEFAULT_HISTORY_FILENAME)
-    except IOError:
-        pass
+    if input.isatty() and not args.batchfilename:
+        try:
+            wafterpreter.load_history(wafterpreter.global_options['HISTORY_FILENAME'])#DEFAULT_HISTORY_FILENAME)
+        except IOError:
+            pass
+    else:
+        wafterpreter.use_rawinput = False
     
     # set default plugin root path...
     wafterpreter.global_options['PLUGIN_PATH'] = DEFAULT_PLUGIN_PATH
@@ -928,6 +2052,26 @@ if __name__=='__main__':
         print('Error: could not find plugin path or invalid plugin path specified: {}'.format(e))
         
 
+    # in batch mode, run the script (after the --script one, if any) headless
+    # and exit with its status
+    if args.batchfilename:
+        try:
+            if args.worker_address:
+                batchfile = ['use {}'.format(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          'plugins', 'external', 'identwaf.py')),
+                             'worker {}'.format(args.worker_address)]
+            else:
+                batchfile = sys.stdin if args.batchfilename == '-' else open(args.batchfilename)
+        except IOError as e:
+            print('Could not open batch file: {}'.format(e))
+            sys.exit(3)
+        wafterpreter.batch_mode = True
+        if args.scriptfilename:
+            wafterpreter.do_script(args.scriptfilename)
+        status = wafterpreter.run_batch(batchfile, args.batchfilename)
+        wafterpreter.close()
+        sys.exit(status)
+
     # execute a script if the user specified one
     if args.scriptfilename:
         try:
@@ -936,5 +2080,28 @@ if __name__=='__main__':
             print('Could not open script file: {}'.format(e))
             sys.exit(3)
 
+    # in daemon mode, serve clients (after running the --script, e.g. to set
+    # global options) until interrupted, then shut down as on "quit"
+    if args.daemon_socket:
+        from daemon import DaemonServer
+        import signal
+        try:
+            server = DaemonServer(args.daemon_socket, lambda stream: DaemonSession(wafterpreter, stream))
+        except (ValueError, EnvironmentError) as e:
+            print('Could not listen on {}: {}'.format(args.daemon_socket, e))
+            sys.exit(4)
+        def terminate(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, terminate)
+        print('Bywaf daemon listening on {}'.format(server.path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.close()
+        wafterpreter.close()
+        print('Goodbye')
+        sys.exit(0)
+
     # begin accepting commands
     interpreter_loop()
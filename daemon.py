@@ -0,0 +1,286 @@
+# ---------------------------------------------------
+# daemon.py:  Bywaf as a daemon serving clients on a UNIX socket
+# ---------------------------------------------------
+
+import os
+import sys
+import json
+import errno
+import socket
+import threading
+
+from jobs import enter_job_context, route_output
+
+# permissions of the socket: the owner and the owner's group (the team) may
+# connect.  Anyone who can connect runs commands as the daemon's user
+SOCKET_MODE = 0o660
+
+# bytes of a command's output gathered before they are sent to the client
+OUTPUT_CHUNK_SIZE = 4096
+
+# The protocol is JSON, one message per line, both ways.  A client sends
+#   {"command": LINE}                      run a command line
+#   {"complete": LINE, "begidx": B, "endidx": E}
+#                                          complete the word between B and E
+# and the daemon answers
+#   {"hello": "bywaf", "prompt": P}        once, when the client connects
+#   {"output": TEXT}                       what a command prints, as it prints it
+#   {"end": true, "failed": F, "prompt": P, "quit": Q}
+#                                          after every command; F tells whether
+#                                          it failed, Q whether the session ended
+#   {"completions": [...]}                 the answer to a "complete" message
+
+
+def send_message(sock, message):
+    """send one message of the protocol"""
+    sock.sendall((json.dumps(message) + '\n').encode('ascii'))
+
+
+def read_messages(rfile):
+    """yield the messages read from a socket's file, until it closes"""
+    for line in rfile:
+        line = line.strip()
+        if line:
+            yield json.loads(line.decode('utf-8'))
+
+
+def native(text):
+    """return text as a native string: python 2 works on bytes"""
+    if str is bytes and not isinstance(text, str):
+        return text.encode('utf-8')
+    return text
+
+
+class ClientStream(object):
+    """What a client's commands print, sent to the client as output messages.
+    Output is gathered up to OUTPUT_CHUNK_SIZE bytes, or until flushed.  Once
+    the client is gone, output is dropped and closed is set"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.chunks = []
+        self.size = 0
+        self.closed = False
+        # pipelines print from threads of their own
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        with self.lock:
+            if self.closed:
+                return
+            self.chunks.append(text)
+            self.size += len(text)
+            if self.size >= OUTPUT_CHUNK_SIZE:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def send(self, message):
+        """send a message after the output gathered so far"""
+        with self.lock:
+            self._flush()
+            self._send(message)
+
+    def _flush(self):
+        if self.chunks:
+            text = ''.join(self.chunks)
+            self.chunks = []
+            self.size = 0
+            self._send({'output': text})
+
+    def _send(self, message):
+        if self.closed:
+            return
+        try:
+            send_message(self.sock, message)
+        except (socket.error, IOError):
+            self.closed = True
+
+    def isatty(self):
+        return False
+
+
+class DaemonServer(object):
+    """Listens on a UNIX socket and serves every client that connects on a
+    thread of its own.  new_session(stream) returns the interpreter running a
+    client's commands (see bywaf.DaemonSession), printing to stream"""
+
+    def __init__(self, path, new_session):
+        self.path = os.path.abspath(path)
+        self.new_session = new_session
+        self.sock = self._listen()
+        # what clients' commands print is routed to them (see _serve_client())
+        route_output()
+
+    def _listen(self):
+        if os.path.exists(self.path):
+            # a socket left behind by a daemon which is gone is taken over,
+            # one a daemon is listening on is not
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error as e:
+                if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                    raise
+                os.unlink(self.path)
+            else:
+                raise ValueError('a daemon is already listening on {}'.format(self.path))
+            finally:
+                probe.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        os.chmod(self.path, SOCKET_MODE)
+        sock.listen(16)
+        return sock
+
+    def serve_forever(self):
+        """serve clients until interrupted (Ctrl-C or SIGTERM)"""
+        while True:
+            try:
+                conn = self.sock.accept()[0]
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            thread = threading.Thread(target=self._serve_client, args=(conn,), name='bywaf-client')
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _serve_client(self, conn):
+        stream = ClientStream(conn)
+        rfile = conn.makefile('rb')
+        # what the client's commands print goes to the client
+        enter_job_context((None, stream))
+        try:
+            session = self.new_session(stream)
+            stream.send({'hello': 'bywaf', 'prompt': session.prompt})
+            for message in read_messages(rfile):
+                if 'complete' in message:
+                    stream.send({'completions': session.complete_line(native(message['complete']),
+                                                                      message.get('begidx', 0),
+                                                                      message.get('endidx', 0))})
+                    continue
+                errors = session.command_errors
+                stop = self._run_command(session, native(message.get('command', '')))
+                # a script run without -j queues its lines, as the interpreter
+                # loop would run them: run them now, before the command ends
+                while session.cmdqueue and not stop:
+                    stop = self._run_command(session, session.cmdqueue.pop(0))
+                stream.send({'end': True, 'failed': session.command_errors > errors,
+                             'prompt': session.prompt, 'quit': bool(stop)})
+                if stop or stream.closed:
+                    break
+            session.close()
+        except (socket.error, IOError, ValueError):
+            pass
+        finally:
+            enter_job_context((None, None))
+            rfile.close()
+            conn.close()
+
+    def _run_command(self, session, line):
+        # run one command line of a client's session; returns whether the
+        # session is over
+        line = session.precmd(line)
+        try:
+            return session.postcmd(session.onecmd(line), line)
+        except Exception as e:
+            session.command_errors += 1
+            print('error: {}'.format(e))
+            return False
+
+
+def run_client(path, stdin=None, stdout=None):
+    """attach to the daemon listening on path and run the command lines read
+    from stdin there, printing what they print to stdout.  Used interactively,
+    shows the daemon's prompt and completes commands with readline.  Returns
+    the exit status: 0 if every command succeeded, 1 if one failed, 2 if the
+    daemon could not be reached"""
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sys.stderr.write('Could not connect to the daemon on {}: {}\n'.format(path, e))
+        return 2
+    rfile = sock.makefile('rb')
+    messages = read_messages(rfile)
+    try:
+        prompt = next(messages)['prompt']
+    except (StopIteration, KeyError, ValueError):
+        sys.stderr.write('No Bywaf daemon on {}\n'.format(path))
+        return 2
+
+    interactive = stdin.isatty()
+    if interactive:
+        _set_completer(sock, messages)
+    try:
+        read_line = raw_input
+    except NameError:  # python 3
+        read_line = input
+
+    failed = False
+    try:
+        while True:
+            if interactive:
+                try:
+                    line = read_line(prompt)
+                except EOFError:
+                    stdout.write('\n')
+                    break
+            else:
+                line = stdin.readline()
+                if not line:
+                    break
+            send_message(sock, {'command': line.rstrip('\n')})
+            for message in messages:
+                if 'output' in message:
+                    stdout.write(native(message['output']))
+                    stdout.flush()
+                elif message.get('end'):
+                    failed = failed or message.get('failed')
+                    prompt = message.get('prompt', prompt)
+                    break
+            else:
+                sys.stderr.write('The daemon closed the connection\n')
+                return 1
+            if message.get('quit'):
+                break
+    except KeyboardInterrupt:
+        # the command carries on in the daemon; only this client is gone
+        stdout.write('\n')
+    finally:
+        rfile.close()
+        sock.close()
+    return 1 if failed else 0
+
+
+def _set_completer(sock, messages):
+    # complete with readline, asking the daemon for the completions
+    try:
+        import readline
+    except ImportError:
+        return
+    completions = []
+
+    def complete(text, state):
+        if state == 0:
+            send_message(sock, {'complete': readline.get_line_buffer(),
+                                'begidx': readline.get_begidx(), 'endidx': readline.get_endidx()})
+            completions[:] = next(messages).get('completions', [])
+        return completions[state] if state < len(completions) else None
+
+    readline.set_completer(complete)
+    readline.parse_and_bind('tab: complete')
@@ -0,0 +1,427 @@
+# ---------------------------------------------------
+# distributed.py:  scans sharded across Bywaf processes
+# ---------------------------------------------------
+
+import time
+import socket
+import itertools
+import threading
+from collections import deque
+
+from daemon import send_message, read_messages
+
+# the coordinator's port, unless told otherwise
+DEFAULT_PORT = 8760
+
+# targets handed out per lease, and seconds a lease is held without news from
+# its worker before it is given to another one
+DEFAULT_LEASE_SIZE = 50
+DEFAULT_LEASE_TTL = 60
+
+# times a lease is handed out before its remaining targets are given up on,
+# so that a target crashing every worker does not hold the scan up for ever
+MAX_LEASE_ATTEMPTS = 3
+
+# seconds a worker waits before asking again while every lease is out, and
+# between two looks of the coordinator for expired leases
+IDLE_WAIT = 1.0
+REAP_INTERVAL = 1.0
+
+# seconds a worker keeps trying to reach a coordinator which is not up yet,
+# and a coordinator which is done waits for its workers to hear so and leave
+CONNECT_TIMEOUT = 30
+LINGER_TIMEOUT = 5
+
+# The protocol is JSON, one message per line, over TCP; every message of a
+# worker gets one answer from the coordinator:
+#   {"hello": NAME}                 -> {"ok": true, "lease_ttl": SECONDS}
+#   {"lease": true}                 -> {"lease": ID, "targets": [...]}, or
+#                                      {"wait": SECONDS} while every lease is
+#                                      out, or {"done": true} once all is done
+#   {"renew": ID}                   -> {"ok": true}, or {"lost": true} if the
+#                                      lease expired and went to another worker
+#   {"results": ID, "records": [...]}
+#                                   -> {"ok": true, "lost": LOST}
+#   {"complete": ID}                -> {"ok": true}
+# A record is a dictionary with a "target" key, e.g. what wafw00f's
+# scantarget() returns.  A worker which disconnects gives its leases back.
+
+
+def parse_address(address, default_host='127.0.0.1'):
+    """return (host, port) of "HOST:PORT" or "PORT".  Raises ValueError"""
+    host, sep, port = str(address).rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        raise ValueError('not an address: {}'.format(address))
+    return host or default_host, port
+
+
+class Lease(object):
+    """Targets handed out together, the hosts they are on, and the worker
+    (the set of lease IDs of its connection) holding them, until when"""
+
+    def __init__(self, lease_id, targets, hosts):
+        self.lease_id = lease_id
+        # target : times it is in the lease and has not been reported
+        self.pending = {}
+        for target in targets:
+            self.pending[target] = self.pending.get(target, 0) + 1
+        self.hosts = hosts
+        self.holder = None
+        self.deadline = None
+        self.attempts = 0
+
+    def targets(self):
+        return [target for target, count in self.pending.items() for i in range(count)]
+
+
+class Coordinator(object):
+    """Shards the targets of an iterable into leases of lease_size and hands
+    them out to the workers connecting to address.  merge(record) is called
+    once for every target reported (with an "error" record for the targets
+    given up on), from the threads serving the workers, one at a time.
+
+    Every worker paces its probes with a probe scheduler of its own, so the
+    targets of a host are held by one worker at a time: a lease sharing a
+    host with a lease held is not handed out until that one is given back.
+    host_of(target) names the host of a target (the target itself if None).
+
+    Targets are read as leases are handed out, so that a target list of
+    any length is never held whole.  A lease whose worker disconnects, or
+    does not renew it within lease_ttl seconds, is handed out again, first
+    thing; results for it which arrive late are still taken, once per
+    target.  run() returns once every target has been reported, or when
+    the token (see jobs.CancellationToken) is cancelled"""
+
+    def __init__(self, targets, merge, address=('127.0.0.1', DEFAULT_PORT), lease_size=DEFAULT_LEASE_SIZE,
+                 lease_ttl=DEFAULT_LEASE_TTL, token=None, host_of=None):
+        self.targets = iter(targets)
+        self.host_of = host_of or (lambda target: target)
+        self.merge = merge
+        self.lease_size = lease_size
+        self.lease_ttl = lease_ttl
+        self.token = token
+        # leases not finished (free or held), by ID, and the free ones in the
+        # order they are handed out
+        self.leases = {}
+        self.free = deque()
+        self.lease_ids = itertools.count()
+        # host : number of held leases with targets on it
+        self.held_hosts = {}
+        self.exhausted = False
+        # what went wrong reading the targets, raised by run()
+        self.failure = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        # workers connected, notified when one leaves
+        self.connected = 0
+        self.left = threading.Condition(self.lock)
+        self.stats = dict(workers=0, leases=0, reclaimed=0, targets=0, reported=0, errors=0, abandoned=0)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(64)
+        self.address = self.sock.getsockname()
+
+    def run(self):
+        """serve workers until every target has been reported, and return
+        the counts of workers, leases handed out and reclaimed, targets,
+        targets reported, errors among them and targets given up on.
+        Raises what reading the targets raised"""
+        self.sock.settimeout(REAP_INTERVAL)
+        try:
+            while not self.done.is_set():
+                if self.token is not None:
+                    self.token.check()
+                try:
+                    conn = self.sock.accept()[0]
+                except socket.timeout:
+                    with self.lock:
+                        self._reap()
+                    continue
+                conn.settimeout(None)
+                thread = threading.Thread(target=self._serve_worker, args=(conn,), name='bywaf-coordinator')
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.sock.close()
+        # the workers still connected are told that all is done when they next
+        # ask for a lease
+        deadline = time.time() + LINGER_TIMEOUT
+        with self.lock:
+            while self.connected and time.time() < deadline:
+                self.left.wait(deadline - time.time())
+            if self.failure is not None:
+                raise self.failure
+            return dict(self.stats)
+
+    def _serve_worker(self, conn):
+        # the IDs of the leases this worker holds
+        held = set()
+        rfile = conn.makefile('rb')
+        with self.lock:
+            self.connected += 1
+        try:
+            for message in read_messages(rfile):
+                send_message(conn, self.handle(message, held))
+        except (socket.error, IOError, ValueError):
+            pass
+        finally:
+            # a worker which went away gives its leases back at once
+            with self.lock:
+                for lease_id in list(held):
+                    self._reclaim(self.leases[lease_id])
+                self.connected -= 1
+                self.left.notify_all()
+            rfile.close()
+            conn.close()
+
+    def handle(self, message, held):
+        """return the answer to a worker's message (see the protocol above)"""
+        with self.lock:
+            if 'hello' in message:
+                self.stats['workers'] += 1
+                return {'ok': True, 'lease_ttl': self.lease_ttl}
+            if 'lease' in message:
+                return self._lease(held)
+            if 'renew' in message:
+                lease = self.leases.get(message['renew'])
+                if lease is None or lease.holder is not held:
+                    return {'lost': True}
+                lease.deadline = time.time() + self.lease_ttl
+                return {'ok': True}
+            if 'results' in message:
+                lease = self.leases.get(message['results'])
+                # held before its records are taken, which may finish it
+                holding = lease is not None and lease.holder is held
+                for record in message.get('records', []):
+                    self._report(lease, record)
+                if holding:
+                    lease.deadline = time.time() + self.lease_ttl
+                    return {'ok': True, 'lost': False}
+                return {'ok': True, 'lost': True}
+            if 'complete' in message:
+                lease = self.leases.get(message['complete'])
+                if lease is not None and lease.holder is held:
+                    # targets the worker did not report go to another one
+                    self._release(lease)
+                    self.free.appendleft(lease)
+                return {'ok': True}
+            return {'error': 'unknown message'}
+
+    def _lease(self, held):
+        self._reap()
+        lease = self._next_lease()
+        if lease is None:
+            if self.failure is not None or (self.exhausted and not self.leases):
+                self.done.set()
+                return {'done': True}
+            return {'wait': IDLE_WAIT}
+        lease.holder = held
+        lease.deadline = time.time() + self.lease_ttl
+        lease.attempts += 1
+        held.add(lease.lease_id)
+        for host in lease.hosts:
+            self.held_hosts[host] = self.held_hosts.get(host, 0) + 1
+        self.stats['leases'] += 1
+        return {'lease': lease.lease_id, 'targets': lease.targets()}
+
+    def _next_lease(self):
+        # the first free lease none of whose hosts is held, else a new one.
+        # Free leases waiting for a host are kept in order, and no new lease
+        # is read while there are as many of them as workers
+        lease = None
+        waiting = []
+        while self.free:
+            candidate = self.free.popleft()
+            if candidate.lease_id not in self.leases:
+                continue
+            if self._holds_host(candidate):
+                waiting.append(candidate)
+                continue
+            lease = candidate
+            break
+        self.free.extendleft(reversed(waiting))
+        if lease is not None:
+            return lease
+        if self.exhausted or len(waiting) >= max(self.connected, 1):
+            return None
+        try:
+            targets = list(itertools.islice(self.targets, self.lease_size))
+        except Exception as e:
+            # the workers are told that all is done, and run() raises
+            self.failure = e
+            self.done.set()
+            targets = []
+        if not targets:
+            self.exhausted = True
+            return None
+        self.stats['targets'] += len(targets)
+        lease = Lease(next(self.lease_ids), targets, set(self.host_of(target) for target in targets))
+        self.leases[lease.lease_id] = lease
+        if self._holds_host(lease):
+            self.free.append(lease)
+            return None
+        return lease
+
+    def _holds_host(self, lease):
+        return any(host in self.held_hosts for host in lease.hosts)
+
+    def _release(self, lease):
+        # the lease is no longer held by its worker
+        if lease.holder is None:
+            return
+        lease.holder.discard(lease.lease_id)
+        lease.holder = None
+        for host in lease.hosts:
+            self.held_hosts[host] -= 1
+            if not self.held_hosts[host]:
+                del self.held_hosts[host]
+
+    def _report(self, lease, record):
+        # take a target's record, unless it was reported already
+        target = record.get('target')
+        if lease is None or not lease.pending.get(target):
+            return
+        lease.pending[target] -= 1
+        if not lease.pending[target]:
+            del lease.pending[target]
+        self.stats['reported'] += 1
+        if 'error' in record:
+            self.stats['errors'] += 1
+        self.merge(record)
+        if not lease.pending:
+            self._finish(lease)
+
+    def _finish(self, lease):
+        del self.leases[lease.lease_id]
+        self._release(lease)
+        if self.exhausted and not self.leases:
+            self.done.set()
+
+    def _reap(self):
+        # take back the leases whose worker went quiet
+        now = time.time()
+        for lease in list(self.leases.values()):
+            if lease.holder is not None and lease.deadline < now:
+                self._reclaim(lease)
+
+    def _reclaim(self, lease):
+        self._release(lease)
+        self.stats['reclaimed'] += 1
+        if lease.attempts < MAX_LEASE_ATTEMPTS:
+            self.free.appendleft(lease)
+            return
+        # every worker given this lease died on it: give its targets up
+        for target in lease.targets():
+            self.stats['abandoned'] += 1
+            self.merge({'target': target, 'error': 'given up after {} leases'.format(lease.attempts)})
+        self._finish(lease)
+
+
+class Worker(object):
+    """Asks the coordinator at address for leases and identifies their
+    targets with scan(targets), an iterator of records (see Coordinator),
+    reporting each record as it comes, until the coordinator has no more.
+    A thread renews the lease being worked on; a lease found lost (given to
+    another worker) is dropped.  Stops early if the token is cancelled"""
+
+    def __init__(self, address, scan, name=None, token=None):
+        self.address = address
+        self.scan = scan
+        self.name = name or '{}:{}'.format(socket.gethostname(), id(self))
+        self.token = token
+        self.lock = threading.Lock()
+        self.stats = dict(leases=0, lost=0, records=0)
+
+    def run(self):
+        """work until the coordinator is done, and return the counts of
+        leases worked on, leases lost and records reported"""
+        self.conn = self._connect()
+        self.rfile = self.conn.makefile('rb')
+        self.messages = read_messages(self.rfile)
+        try:
+            lease_ttl = self.call({'hello': self.name}).get('lease_ttl', DEFAULT_LEASE_TTL)
+            while True:
+                self._check()
+                answer = self.call({'lease': True})
+                if answer.get('done'):
+                    break
+                if 'wait' in answer:
+                    self._sleep(answer['wait'])
+                    continue
+                self.work(answer['lease'], answer['targets'], lease_ttl)
+        finally:
+            self.rfile.close()
+            self.conn.close()
+        return dict(self.stats)
+
+    def work(self, lease_id, targets, lease_ttl):
+        """identify the targets of a lease, renewing it meanwhile"""
+        self.stats['leases'] += 1
+        lost = threading.Event()
+        working = threading.Event()
+
+        def renew():
+            while not working.wait(lease_ttl / 3.0):
+                try:
+                    if self.call({'renew': lease_id}).get('lost'):
+                        lost.set()
+                        return
+                except (socket.error, IOError):
+                    return
+        renewer = threading.Thread(target=renew, name='bywaf-lease-renewer')
+        renewer.daemon = True
+        renewer.start()
+        try:
+            records = self.scan(targets)
+            try:
+                for record in records:
+                    self.stats['records'] += 1
+                    if self.call({'results': lease_id, 'records': [record]}).get('lost'):
+                        lost.set()
+                    if lost.is_set():
+                        break
+            finally:
+                close = getattr(records, 'close', None)
+                if close is not None:
+                    close()
+        finally:
+            working.set()
+            renewer.join()
+        if lost.is_set():
+            self.stats['lost'] += 1
+        else:
+            self.call({'complete': lease_id})
+
+    def call(self, message):
+        """send a message to the coordinator and return its answer"""
+        with self.lock:
+            send_message(self.conn, message)
+            try:
+                return next(self.messages)
+            except StopIteration:
+                raise socket.error('the coordinator closed the connection')
+
+    def _connect(self):
+        # the coordinator may not be listening yet
+        deadline = time.time() + CONNECT_TIMEOUT
+        while True:
+            try:
+                return socket.create_connection(self.address)
+            except socket.error:
+                if time.time() >= deadline:
+                    raise
+            self._sleep(IDLE_WAIT)
+
+    def _check(self):
+        if self.token is not None:
+            self.token.check()
+
+    def _sleep(self, seconds):
+        if self.token is not None:
+            self.token.sleep(seconds)
+        else:
+            time.sleep(seconds)
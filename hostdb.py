@@ -1,20 +1,106 @@
-import sqlite
+import threading
+import atexit
+import time
+import sys
+
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+
+# default file name of the host database
+DEFAULT_HOSTDB_FILENAME = "bywaf-hostdb.db"
+
+# writes a WriteBehindHostDatabase accepts before add_*() calls block
+DEFAULT_MAX_QUEUED_WRITES = 100000
+
+# most rows a WriteBehindHostDatabase writes in one transaction
+DEFAULT_WRITE_BATCH_SIZE = 5000
+
+# attempts at writing a batch which failed (e.g. the database was locked by
+# another process), and the seconds waited before the first retry, doubled
+# before every next one.  A batch which still fails is written row by row
+WRITE_RETRIES = 3
+WRITE_RETRY_DELAY = 0.5
+
+# longest a WriteBehindHostDatabase's flush() waits for the queued writes
+DEFAULT_FLUSH_TIMEOUT = 60
+
+# schema: one row per host, one row per (host, port, protocol), one row
+# per WAF found in front of a (host, port).
+# ports_match covers list_matching_ports() entirely, so that query never
+# touches the table itself, however many port rows there are.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+    host_ip TEXT PRIMARY KEY,
+    host_name TEXT);
+CREATE TABLE IF NOT EXISTS ports (
+    host_ip TEXT NOT NULL,
+    port_number TEXT NOT NULL,
+    port_protocol TEXT NOT NULL,
+    service_name TEXT,
+    status TEXT,
+    UNIQUE (host_ip, port_number, port_protocol));
+CREATE INDEX IF NOT EXISTS ports_host ON ports (host_ip);
+CREATE INDEX IF NOT EXISTS ports_match ON ports (port_number, port_protocol, status, host_ip);
+CREATE TABLE IF NOT EXISTS wafs (
+    host_ip TEXT NOT NULL,
+    port_number TEXT NOT NULL,
+    waf_name TEXT NOT NULL,
+    reason TEXT,
+    UNIQUE (host_ip, port_number, waf_name));
+"""
+
+# statements are kept as constants so that sqlite3's statement cache
+# prepares each of them only once per connection
+INSERT_HOST = "INSERT OR REPLACE INTO hosts (host_ip, host_name) VALUES (?, ?)"
+INSERT_PORT = ("INSERT OR REPLACE INTO ports (host_ip, port_number, port_protocol, service_name, status) "
+               "VALUES (?, ?, ?, ?, ?)")
+SELECT_HOST_PORTS = ("SELECT port_number, port_protocol, service_name, status FROM ports "
+                     "WHERE host_ip = ? ORDER BY port_protocol, port_number")
+SELECT_MATCHING_PORTS = ("SELECT host_ip FROM ports "
+                         "WHERE port_number = ? AND port_protocol = ? AND status = ?")
+INSERT_WAF = "INSERT OR REPLACE INTO wafs (host_ip, port_number, waf_name, reason) VALUES (?, ?, ?, ?)"
+SELECT_HOST_WAFS = "SELECT port_number, waf_name, reason FROM wafs WHERE host_ip = ? ORDER BY port_number"
 
 class HostDatabase:
-    
-   def __init__(self):
+
+   def __init__(self, filename=DEFAULT_HOSTDB_FILENAME):
+       self.filename = filename
+       # the connection is shared by the interpreter and its job threads
+       self.lock = threading.Lock()
        self.db = self._create_database()
 
    def _create_database(self):
-       """Private method: create an empty database"""
-       pass
+       """Private method: open the database file, creating the tables and indexes if needed"""
+       import sqlite3 # imported on first use, to keep Bywaf's startup fast
+       db = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+
+       # write-ahead logging lets readers carry on while a batch is written
+       db.execute("PRAGMA journal_mode=WAL")
+       db.execute("PRAGMA synchronous=NORMAL")
+       db.executescript(SCHEMA)
+       db.commit()
+       return db
+
+   def close(self):
+       """Database API:  Close the database"""
+       with self.lock:
+           self.db.close()
 
    def add_host(self, host_ip, host_name):
        """Database API:  Add a host to the database, where:
            - host_ip: a string containing the host's Internet Protocol (IP) number
            - host_name: the name associated with this host"""
-       pass
-   
+       self.add_hosts([(host_ip, host_name)])
+
+   def add_hosts(self, hosts):
+       """Database API:  Add many hosts in a single transaction, where:
+           - hosts: an iterable of (host_ip, host_name) tuples"""
+       with self.lock:
+           with self.db:
+               self.db.executemany(INSERT_HOST, hosts)
+
    def add_port(self, host_ip, port_number, port_protocol, service_name, status):
        """Database API:  Add port information for a given host to the database, where:
            - host_ip:  a string containing the host's Internet Protocol (IP) number
@@ -22,22 +108,236 @@ class HostDatabase:
            - port_protocol: one of "tcp", "udp"
            - service_name: name of the service or program responding to queries on this port
            - status: can be "Open", "Closed", or "Filered". """
-       pass
-   
+       self.add_ports([(host_ip, port_number, port_protocol, service_name, status)])
+
+   def add_ports(self, ports):
+       """Database API:  Add port information for many hosts in a single transaction, where:
+           - ports: an iterable of (host_ip, port_number, port_protocol, service_name, status) tuples"""
+       with self.lock:
+           with self.db:
+               self.db.executemany(INSERT_PORT, ports)
+
    def get_host_portinfo(self, host_ip):
-       """Database API:  Return all port information for the specified host, where:
-           - host_ip: a string containing the host's Internet Protocol (IP) number           
+       """Database API:  Return all port information for the specified host, as a list of
+          (port_number, port_protocol, service_name, status) tuples, where:
+           - host_ip: a string containing the host's Internet Protocol (IP) number
            """
-       pass
-   
+       with self.lock:
+           return self.db.execute(SELECT_HOST_PORTS, (host_ip,)).fetchall()
+
+   def add_waf(self, host_ip, port_number, waf_name, reason=''):
+       """Database API:  Record a WAF found in front of a host's port, where:
+           - host_ip:  a string containing the host's Internet Protocol (IP) number
+           - port_number:  a string containing the port number
+           - waf_name: name of the WAF, e.g. as reported by wafw00f
+           - reason: optional.  Why the WAF is believed to be there"""
+       self.add_wafs([(host_ip, port_number, waf_name, reason)])
+
+   def add_wafs(self, wafs):
+       """Database API:  Record many WAF findings in a single transaction, where:
+           - wafs: an iterable of (host_ip, port_number, waf_name, reason) tuples"""
+       with self.lock:
+           with self.db:
+               self.db.executemany(INSERT_WAF, wafs)
+
+   def get_host_wafs(self, host_ip):
+       """Database API:  Return the WAFs found for a host, as a list of
+          (port_number, waf_name, reason) tuples"""
+       with self.lock:
+           return self.db.execute(SELECT_HOST_WAFS, (host_ip,)).fetchall()
+
    def list_matching_ports(self, port_number, port_protocol, status="Open"):
-       """Database API:  Return all hosts who have this port open, where:
+       """Database API:  Return a list of all hosts who have this port open, where:
            - port_number:  a string containing the port number
            - port_protocol: one of "tcp", "udp"
-           - service_name: name of the service or program responding to queries on this port
            - status: optional.  Can be "Open", "Closed", or "Filered". """
+       with self.lock:
+           rows = self.db.execute(SELECT_MATCHING_PORTS, (port_number, port_protocol, status)).fetchall()
+       return [row[0] for row in rows]
 
-           
-"""
-       pass
-   
+
+class WriteBehindHostDatabase:
+   """A HostDatabase front end for concurrent jobs.  add_*() calls only
+   enqueue their rows and return; a single writer thread drains the queue,
+   coalescing whatever has piled up into batched transactions.  Once
+   max_queued writes are waiting, add_*() calls block until the writer
+   catches up.  Reads flush the queue first, so they see every write made
+   before them.  Once closed, add_*() calls raise ValueError.
+
+   A batch which cannot be written is tried again, then written row by row,
+   so that only the rows which cannot be written at all are lost (and
+   reported on stderr).
+
+   Given a MetricsRegistry (see metrics.py), the writer records how long
+   each batch took to write and how many rows went to each table."""
+
+   def __init__(self, hostdb, max_queued=DEFAULT_MAX_QUEUED_WRITES, batch_size=DEFAULT_WRITE_BATCH_SIZE,
+                metrics=None):
+       self.hostdb = hostdb
+       self.batch_size = batch_size
+       self.queue = queue.Queue(max_queued)
+
+       # number of rows which could not be written
+       self.errors = 0
+       self.closed = False
+
+       self.write_seconds = self.rows_written = None
+       if metrics is not None:
+           self.write_seconds = metrics.histogram('bywaf_hostdb_write_seconds',
+                                                  'Seconds taken to write a batch of rows to the host database')
+           self.rows_written = metrics.counter('bywaf_hostdb_rows_written_total',
+                                               'Rows written to the host database, by table', ('table',))
+
+       self.writer = threading.Thread(target=self._write_loop, name='hostdb-writer')
+       self.writer.daemon = True
+       self.writer.start()
+
+       # flush on exit
+       atexit.register(self.close)
+
+   def add_host(self, host_ip, host_name):
+       """Database API:  Queue a host, see HostDatabase.add_host()"""
+       self._put(('hosts', (host_ip, host_name)))
+
+   def add_hosts(self, hosts):
+       """Database API:  Queue many hosts, see HostDatabase.add_hosts()"""
+       for host in hosts:
+           self._put(('hosts', tuple(host)))
+
+   def add_port(self, host_ip, port_number, port_protocol, service_name, status):
+       """Database API:  Queue port information, see HostDatabase.add_port()"""
+       self._put(('ports', (host_ip, port_number, port_protocol, service_name, status)))
+
+   def add_ports(self, ports):
+       """Database API:  Queue port information for many hosts, see HostDatabase.add_ports()"""
+       for port in ports:
+           self._put(('ports', tuple(port)))
+
+   def add_waf(self, host_ip, port_number, waf_name, reason=''):
+       """Database API:  Queue a WAF finding, see HostDatabase.add_waf()"""
+       self._put(('wafs', (host_ip, port_number, waf_name, reason)))
+
+   def add_wafs(self, wafs):
+       """Database API:  Queue many WAF findings, see HostDatabase.add_wafs()"""
+       for waf in wafs:
+           self._put(('wafs', tuple(waf)))
+
+   def get_host_portinfo(self, host_ip):
+       """Database API:  see HostDatabase.get_host_portinfo()"""
+       self.flush()
+       return self.hostdb.get_host_portinfo(host_ip)
+
+   def get_host_wafs(self, host_ip):
+       """Database API:  see HostDatabase.get_host_wafs()"""
+       self.flush()
+       return self.hostdb.get_host_wafs(host_ip)
+
+   def list_matching_ports(self, port_number, port_protocol, status="Open"):
+       """Database API:  see HostDatabase.list_matching_ports()"""
+       self.flush()
+       return self.hostdb.list_matching_ports(port_number, port_protocol, status)
+
+   def flush(self, timeout=DEFAULT_FLUSH_TIMEOUT):
+       """Database API:  Wait until every queued write has been written, for
+          timeout seconds at most.  Returns whether they all were"""
+       deadline = time.time() + timeout
+       with self.queue.all_tasks_done:
+           while self.queue.unfinished_tasks and self.writer.is_alive():
+               remaining = deadline - time.time()
+               if remaining <= 0:
+                   return False
+               self.queue.all_tasks_done.wait(remaining)
+           return not self.queue.unfinished_tasks
+
+   def close(self):
+       """Database API:  Flush the queue, stop the writer and close the database"""
+       self.closed = True
+       try:
+           if self.writer.is_alive():
+               self.queue.put(None)
+               self.writer.join()
+       finally:
+           self.hostdb.close()
+
+   def _put(self, item):
+       """Private method: queue a write, waiting while the queue is full"""
+       while True:
+           if self.closed or not self.writer.is_alive():
+               raise ValueError('the host database is closed')
+           try:
+               self.queue.put(item, timeout=0.5)
+               return
+           except queue.Full:
+               pass
+
+   def _write_loop(self):
+       """Private method: writer thread body"""
+       while True:
+           item = self.queue.get()
+           batch = [item]
+
+           # coalesce whatever else is already waiting into the same batch
+           while item is not None and len(batch) < self.batch_size:
+               try:
+                   item = self.queue.get_nowait()
+               except queue.Empty:
+                   break
+               batch.append(item)
+
+           rows = {'hosts': [], 'ports': [], 'wafs': []}
+           for item in batch:
+               if item is not None:
+                   rows[item[0]].append(item[1])
+
+           started = time.time()
+           written = self._write_rows(rows)
+           if self.write_seconds is not None and batch[0] is not None:
+               self.write_seconds.observe(time.time() - started)
+               for table in rows:
+                   if written[table]:
+                       self.rows_written.inc(written[table], table)
+
+           for item in batch:
+               self.queue.task_done()
+
+           # a None item asks the writer to stop, once the rows before it are written
+           if batch[-1] is None:
+               return
+
+   def _write_rows(self, rows):
+       """Private method: write a batch of rows, by table; return the number
+          of rows of each table written"""
+       import sqlite3
+       delay = WRITE_RETRY_DELAY
+       for attempt in range(WRITE_RETRIES):
+           try:
+               self._write_tables(rows)
+               return dict((table, len(rows[table])) for table in rows)
+           except sqlite3.OperationalError:
+               # e.g. the database is locked: wait for it
+               if attempt < WRITE_RETRIES - 1:
+                   time.sleep(delay)
+                   delay *= 2
+           except Exception:
+               break
+
+       # write what can be written, one row at a time
+       written = dict((table, 0) for table in rows)
+       for table in rows:
+           for row in rows[table]:
+               try:
+                   self._write_tables({table: [row]})
+                   written[table] += 1
+               except Exception as e:
+                   self.errors += 1
+                   sys.stderr.write('hostdb: could not write {} row {}: {}\n'.format(table, row, e))
+       return written
+
+   def _write_tables(self, rows):
+       """Private method: write rows, by table, a transaction per table"""
+       if rows.get('hosts'):
+           self.hostdb.add_hosts(rows['hosts'])
+       if rows.get('ports'):
+           self.hostdb.add_ports(rows['ports'])
+       if rows.get('wafs'):
+           self.hostdb.add_wafs(rows['wafs'])
@@ -0,0 +1,849 @@
+# ---------------------------------------------------
+# jobs.py:  registry of Bywaf's backgrounded jobs
+# ---------------------------------------------------
+
+import os
+import sys
+import time
+import heapq
+import threading
+from collections import OrderedDict, deque
+
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+
+# concurrent.futures, multiprocessing, pickle and tempfile are only imported
+# once a job needs them, so that they do not slow Bywaf's startup down
+
+# job states
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (RUNNING, DONE, FAILED)
+
+# job backends: jobs run on a worker thread, or in a child process of their own
+THREAD = 'thread'
+PROCESS = 'process'
+BACKENDS = (THREAD, PROCESS)
+
+# seconds between checks of a process-backed job's cancellation token
+PROCESS_POLL_INTERVAL = 0.1
+
+# bytes of a job's output kept in memory before they are spilled to a temporary
+# file, and most bytes of output kept per job (older output is dropped past it)
+DEFAULT_OUTPUT_MEMORY = 64*1024
+DEFAULT_OUTPUT_MAX_SIZE = 64*1024*1024
+
+# the cancellation token and output buffer of the job running in the current thread
+_current = threading.local()
+
+
+def current_token():
+    """return the cancellation token of the job running in this thread, None
+    outside of a backgrounded job"""
+    return getattr(_current, 'token', None)
+
+
+def job_context():
+    """return the context (cancellation token and output buffer) of the job
+    running in this thread, to be handed to threads the job starts"""
+    return getattr(_current, 'token', None), getattr(_current, 'output', None)
+
+
+def enter_job_context(context):
+    """make a thread started by a job part of it (see job_context())"""
+    _current.token, _current.output = context
+
+
+def route_output():
+    """replace sys.stdout and sys.stderr with OutputRouters, so that what
+    backgrounded jobs print goes to their own OutputBuffer"""
+    if not isinstance(sys.stdout, OutputRouter):
+        sys.stdout = OutputRouter(sys.stdout)
+    if not isinstance(sys.stderr, OutputRouter):
+        sys.stderr = OutputRouter(sys.stderr)
+
+
+class OutputRouter(object):
+    """A stand-in for a stream, writing to the output buffer of the job
+    running in the calling thread, or to the stream itself outside of jobs"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        output = getattr(_current, 'output', None)
+        if output is None:
+            self.stream.write(text)
+        else:
+            output.write(text)
+
+    def flush(self):
+        if getattr(_current, 'output', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class OutputBuffer(object):
+    """What a job prints.  The latest max_memory bytes are held in memory;
+    past that they are spilled to temporary files of max_size/2 bytes each.
+    Only the last two files are kept, so the oldest output is dropped once a
+    job printed more than max_size bytes.
+
+    Output is addressed by offset from the job's first byte, so readers page
+    through it with read() and follow it with wait() without loading it all."""
+
+    def __init__(self, max_memory=DEFAULT_OUTPUT_MEMORY, max_size=DEFAULT_OUTPUT_MAX_SIZE):
+        self.max_memory = max_memory
+        self.segment_size = max(max_size // 2, max_memory)
+
+        # spilled output, oldest first, as [offset, file, length] lists
+        self.segments = []
+        # output not spilled yet, and its offset
+        self.memory = bytearray()
+        self.memory_offset = 0
+
+        # bytes written so far, and whether the job is over
+        self.size = 0
+        self.closed = False
+        self.changed = threading.Condition()
+
+    def write(self, text):
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8', 'replace')
+        with self.changed:
+            self.memory += text
+            self.size += len(text)
+            if len(self.memory) > self.max_memory:
+                self._spill()
+            self.changed.notify_all()
+
+    def flush(self):
+        pass
+
+    def _spill(self):
+        if not self.segments or self.segments[-1][2] >= self.segment_size:
+            import tempfile
+            self.segments.append([self.memory_offset, tempfile.TemporaryFile(prefix='bywaf-output-'), 0])
+            if len(self.segments) > 2:
+                self.segments.pop(0)[1].close()
+        segment = self.segments[-1]
+        segment[1].seek(0, os.SEEK_END)
+        segment[1].write(self.memory)
+        segment[2] += len(self.memory)
+        self.memory_offset = self.size
+        self.memory = bytearray()
+
+    def first_offset(self):
+        """offset of the oldest output still kept"""
+        with self.changed:
+            if self.segments:
+                return self.segments[0][0]
+            return self.memory_offset
+
+    def read(self, offset, size):
+        """return (data, next offset): at most size bytes of output from offset
+        on.  Output which was dropped (see first_offset()) is skipped"""
+        with self.changed:
+            offset = max(offset, self.first_offset())
+            for start, f, length in self.segments:
+                if offset < start + length:
+                    f.seek(offset - start)
+                    data = f.read(min(size, start + length - offset))
+                    return data, offset + len(data)
+            position = offset - self.memory_offset
+            data = bytes(self.memory[position:position + size])
+            return data, offset + len(data)
+
+    def wait(self, offset, timeout=None):
+        """wait until there is output past offset or the job is over.
+        Returns False once the job is over and its output was all read"""
+        with self.changed:
+            if self.size <= offset and not self.closed:
+                self.changed.wait(timeout)
+            return self.size > offset or not self.closed
+
+    def close(self):
+        """mark the job as over, waking up readers"""
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+    def discard(self):
+        """free the memory and temporary files holding the output"""
+        with self.changed:
+            for segment in self.segments:
+                segment[1].close()
+            self.segments = []
+            self.memory = bytearray()
+            self.memory_offset = self.size
+            self.closed = True
+            self.changed.notify_all()
+
+
+class JobCancelled(Exception):
+    """raised by CancellationToken.check() once a job is killed or past its deadline"""
+
+
+class CancellationToken(object):
+    """Handed to a backgrounded command so that it can stop early.  Long-running
+    commands call check() between units of work (e.g. between requests); it
+    raises JobCancelled once the job has been killed or its deadline (a
+    time.time() value, None for no deadline) has passed."""
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.reason = None
+        self.event = threading.Event()
+
+    def cancel(self, reason='job was killed'):
+        if not self.event.is_set():
+            self.reason = reason
+            self.event.set()
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def cancelled(self):
+        if not self.event.is_set() and self.expired():
+            self.cancel('job ran past its deadline')
+        return self.event.is_set()
+
+    def check(self):
+        if self.cancelled():
+            raise JobCancelled(self.reason)
+
+    def sleep(self, seconds):
+        """sleep, waking up early to raise JobCancelled if the job is cancelled"""
+        if self.deadline is not None:
+            seconds = min(seconds, max(0, self.deadline - time.time()))
+        self.event.wait(seconds)
+        self.check()
+
+
+class Job(object):
+    """A backgrounded command.  While it runs it holds the Future it was
+    submitted as; once finished it holds the command's result (or the
+    exception it raised) and the Future is let go.  Offers the done(),
+    running(), cancel() and result() methods of a Future."""
+
+    def __init__(self, job_id, name, command_line, future):
+        self.job_id = job_id
+        self.name = name
+        self.command_line = command_line
+        self.future = future
+        self.token = getattr(future, 'token', None)
+        self.output = getattr(future, 'output', None)
+
+        # statistics of the probes the job sent through a probe scheduler
+        self.probe_stats = None
+
+        # backend the job ran on, once finished (see backend)
+        self._backend = None
+
+        # False if nobody is to be told when the job finishes
+        self.notify = True
+        self.state = RUNNING
+        self.submitted = time.time()
+        self.finished = None
+        self.exception = None
+
+        # size of the result held in memory, and where it went if it was spilled
+        self.result_size = 0
+        self.spill_filename = None
+        self._result = None
+
+    @property
+    def backend(self):
+        """the backend the job runs or ran on, None until it starts"""
+        if self.future is not None:
+            return getattr(self.future, 'backend', None)
+        return self._backend
+
+    def done(self):
+        return self.state != RUNNING
+
+    def running(self):
+        return self.state == RUNNING
+
+    def cancel(self):
+        return self.future is not None and self.future.cancel()
+
+    def result(self):
+        """return the command's result, re-raising the exception it raised"""
+        if self.state == RUNNING:
+            return self.future.result()
+        if self.exception is not None:
+            raise self.exception
+        if self.spill_filename:
+            pickle = _pickle()
+            with open(self.spill_filename, 'rb') as f:
+                return pickle.load(f)
+        return self._result
+
+
+class JobRegistry(object):
+    """Backgrounded jobs, indexed by job ID and by state.  Counters are kept
+    up to date as jobs change state, so nothing needs to walk the job list.
+
+    Finished jobs are subject to a retention policy:
+      - max_jobs:  most finished jobs kept; the oldest are forgotten
+      - max_age:  seconds a finished job is kept
+      - max_result_bytes:  most bytes of results held in memory; past it
+        the oldest results are spilled to disk, or forgotten if spill is False
+    A limit of None means no limit."""
+
+    def __init__(self, max_jobs=None, max_age=None, max_result_bytes=None, spill=True):
+        self.max_jobs = max_jobs
+        self.max_age = max_age
+        self.max_result_bytes = max_result_bytes
+        self.spill = spill
+
+        # running counter, increments with every job; used as Job ID
+        self.job_counter = 0
+
+        # every job by ID, in submission order, and the IDs of the jobs in each state
+        self.jobs = OrderedDict()
+        self.by_state = dict((state, OrderedDict()) for state in STATES)
+
+        # IDs of finished jobs whose result is still in memory, oldest first
+        self.in_memory = OrderedDict()
+        self.result_bytes = 0
+
+        # directory holding spilled results, created on first use
+        self.spill_dir = None
+
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __iter__(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return iter(jobs)
+
+    def add(self, name, command_line, future):
+        """register a newly submitted job and return it"""
+        with self.lock:
+            job = Job(self.job_counter, name, command_line, future)
+            self.job_counter += 1
+            self.jobs[job.job_id] = job
+            self.by_state[RUNNING][job.job_id] = job
+        return job
+
+    def get(self, job_id):
+        """return a job given its ID, None if there is no such job"""
+        return self.jobs.get(job_id)
+
+    def ids(self, state=None):
+        """return the IDs of all jobs, or of the jobs in the given state"""
+        with self.lock:
+            if state is None:
+                return list(self.jobs.keys())
+            return list(self.by_state[state].keys())
+
+    def count(self, state=None):
+        if state is None:
+            return len(self.jobs)
+        return len(self.by_state[state])
+
+    def remove(self, job_id):
+        """forget a finished job.  Returns False if it is still running"""
+        with self.lock:
+            job = self.jobs[job_id]
+            if job.running():
+                return False
+            self._forget(job)
+        return True
+
+    def finish(self, job):
+        """move a job whose Future completed to the done or failed state"""
+        future = job.future
+        exception = future.exception() if not future.cancelled() else None
+
+        with self.lock:
+            if job.job_id not in self.by_state[RUNNING]:
+                return
+            del self.by_state[RUNNING][job.job_id]
+
+            job.finished = time.time()
+            job._backend = getattr(future, 'backend', None)
+            job.future = None
+            job.token = None
+            if future.cancelled():
+                job.state = FAILED
+                job.exception = Exception('job was cancelled')
+            elif exception is not None:
+                job.state = FAILED
+                job.exception = exception
+            else:
+                job.state = DONE
+                job._result = future.result()
+                job.result_size = result_size(job._result)
+                self.in_memory[job.job_id] = job
+                self.result_bytes += job.result_size
+            self.by_state[job.state][job.job_id] = job
+
+            self.apply_retention()
+
+    def apply_retention(self):
+        """enforce the retention policy on finished jobs"""
+        with self.lock:
+            # forget the jobs which finished too long ago.  Finished jobs
+            # are kept in finishing order, so stop at the first recent one
+            if self.max_age is not None:
+                deadline = time.time() - self.max_age
+                for state in (DONE, FAILED):
+                    finished = self.by_state[state]
+                    while finished:
+                        job = next(iter(finished.values()))
+                        if job.finished >= deadline:
+                            break
+                        self._forget(job)
+
+            # forget the oldest finished jobs past the maximum count
+            if self.max_jobs is not None:
+                while self.count(DONE) + self.count(FAILED) > self.max_jobs:
+                    self._forget(self._oldest_finished())
+
+            # spill (or forget) the oldest results past the memory budget
+            if self.max_result_bytes is not None:
+                while self.result_bytes > self.max_result_bytes and self.in_memory:
+                    job = next(iter(self.in_memory.values()))
+                    if self.spill:
+                        self._spill(job)
+                    else:
+                        self._forget(job)
+
+    def _oldest_finished(self):
+        """return the job which finished first, of the done and failed ones"""
+        oldest = None
+        for state in (DONE, FAILED):
+            if self.by_state[state]:
+                job = next(iter(self.by_state[state].values()))
+                if oldest is None or job.finished < oldest.finished:
+                    oldest = job
+        return oldest
+
+    def _spill(self, job):
+        pickle = _pickle()
+        if self.spill_dir is None:
+            import tempfile
+            self.spill_dir = tempfile.mkdtemp(prefix='bywaf-jobs-')
+        filename = os.path.join(self.spill_dir, 'job-{}.pickle'.format(job.job_id))
+        try:
+            with open(filename, 'wb') as f:
+                pickle.dump(job._result, f, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # keep a textual copy of results which cannot be pickled
+            with open(filename, 'wb') as f:
+                pickle.dump(str(job._result), f, pickle.HIGHEST_PROTOCOL)
+        job.spill_filename = filename
+        job._result = None
+        self._release(job)
+
+    def _release(self, job):
+        if self.in_memory.pop(job.job_id, None) is not None:
+            self.result_bytes -= job.result_size
+            job.result_size = 0
+
+    def _forget(self, job):
+        self._release(job)
+        if job.output is not None:
+            job.output.discard()
+        if job.spill_filename:
+            try:
+                os.remove(job.spill_filename)
+            except OSError:
+                pass
+        del self.jobs[job.job_id]
+        del self.by_state[job.state][job.job_id]
+
+    def close(self):
+        """delete spilled results"""
+        if self.spill_dir:
+            import shutil
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+
+def _pickle():
+    try:
+        import cPickle as pickle
+    except ImportError: # python 3
+        import pickle
+    return pickle
+
+
+def _multiprocessing():
+    # process-backed jobs run in a child started by a fork server, or spawned
+    # where there is none.  Forking the interpreter itself would copy into the
+    # child the locks its other threads hold at that moment (the host
+    # database writer's, logging's, standard output's), and they would stay
+    # held there forever.  The child gets the job's function pickled: Bywaf
+    # sends the plugin, options and command line to run (see
+    # bywaf.ChildCommand).  Python 2 can only fork, so there the child
+    # inherits the function as it is, with that limitation
+    import multiprocessing
+    try:
+        methods = multiprocessing.get_all_start_methods()
+    except AttributeError: # python 2
+        return multiprocessing
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+# what result_size() measures by its length
+_TEXT = (str, bytes, type(u''))
+
+
+def result_size(result):
+    """approximate number of bytes a result holds: the length of a string,
+    else the memory of the object and of everything it contains (elements
+    of lists, tuples, sets and deques, keys and values of dicts, attributes
+    of objects), each object counted once"""
+    if isinstance(result, _TEXT):
+        return len(result)
+    size = 0
+    seen = set()
+    stack = [result]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, _TEXT):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+            stack.append(obj.__dict__)
+    return size
+
+
+class _Task(object):
+    """a job submitted to a JobExecutor: its Future, callable and token"""
+
+    def __init__(self, future, fn, args, kwargs, token, backend, output):
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.token = token
+        self.backend = backend
+        self.output = output
+        self.worker = None
+        self.lock = threading.Lock()
+        self.settled = False
+        self.submitted = time.time()
+
+    def settle(self, result=None, exception=None):
+        """complete the Future, unless the task was already settled (killed)"""
+        with self.lock:
+            if self.settled:
+                return False
+            self.settled = True
+        if self.output is not None:
+            self.output.close()
+        if exception is not None:
+            self.future.set_exception(exception)
+        else:
+            self.future.set_result(result)
+        return True
+
+
+class JobExecutor(object):
+    """Runs backgrounded jobs on at most max_workers threads, like a
+    ThreadPoolExecutor, but each job gets a CancellationToken and jobs can
+    be killed while they run.
+
+    Python cannot stop a thread, so killing a running job cancels its token,
+    fails its Future straight away and abandons the worker thread: a new
+    worker takes its place, and the abandoned one exits as soon as the job
+    returns (cooperative jobs return at their next token check).  Jobs past
+    their deadline are killed the same way by a reaper thread.
+
+    With the process backend, a worker runs its job in a child process
+    instead, so CPU-bound jobs are not held back by the GIL; the job's
+    function and arguments must then be picklable (except on python 2,
+    where the child is forked).  The job's result and output are sent back
+    to the worker, and a killed job's process is terminated.  Jobs are queued until a worker picks them up, so
+    resize() and set_backend() take effect at once and apply to every job
+    still pending.
+
+    Given a MetricsRegistry (see metrics.py), the executor records how long
+    jobs wait in its queue and how long they run, by backend."""
+
+    def __init__(self, max_workers, backend=THREAD, metrics=None):
+        self.max_workers = max_workers
+        self.backend = backend
+        self.queue_seconds = self.run_seconds = None
+        if metrics is not None:
+            self.queue_seconds = metrics.histogram('bywaf_job_queue_seconds',
+                                                   'Seconds jobs waited for a worker', ('backend',))
+            self.run_seconds = metrics.histogram('bywaf_job_run_seconds',
+                                                 'Seconds jobs ran, by backend and outcome', ('backend', 'outcome'))
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.shutting_down = False
+
+        # live, non-abandoned workers, and how many of them wait for a job
+        self.workers = set()
+        self.idle = 0
+
+        # running tasks by Future, and (deadline, id, task) entries for the reaper
+        self.running = {}
+        self.deadlines = []
+        self.reaper_wakeup = threading.Condition(self.lock)
+        self.reaper = None
+
+    def submit(self, fn, *args, **kwargs):
+        """schedule fn(*args, **kwargs) and return its Future.  The keyword
+        argument timeout (seconds, None for no deadline) sets the job's
+        deadline, counted from submission.  The Future's token attribute is
+        the job's CancellationToken.  The keyword argument backend runs this
+        job on the given backend instead of the executor's current one, and
+        output is an OutputBuffer capturing what the job prints (the Future's
+        output attribute).  A CancellationToken made beforehand may be given
+        as the keyword argument token.  Once the job starts, the Future's
+        backend attribute is the backend it runs on"""
+        timeout = kwargs.pop('timeout', None)
+        backend = kwargs.pop('backend', None)
+        output = kwargs.pop('output', None)
+        token = kwargs.pop('token', None) or CancellationToken()
+        if backend is not None and backend not in BACKENDS:
+            raise ValueError('unknown job backend {}'.format(backend))
+        deadline = time.time() + timeout if timeout else None
+        token.deadline = deadline
+        import concurrent.futures
+        future = concurrent.futures.Future()
+        future.token = token
+        future.output = output
+        task = _Task(future, fn, args, kwargs, future.token, backend, output)
+
+        with self.lock:
+            if self.shutting_down:
+                raise RuntimeError('cannot schedule new jobs after shutdown')
+            if deadline is not None:
+                heapq.heappush(self.deadlines, (deadline, id(task), task))
+                self._start_reaper()
+                self.reaper_wakeup.notify()
+            self.queue.put(task)
+            self._adjust_workers()
+        return future
+
+    def kill(self, future, reason='job was killed'):
+        """cancel a job.  A pending job never starts; a running job's token
+        is cancelled, its Future fails with JobCancelled and its worker is
+        replaced.  Returns False if the job had already finished"""
+        if future.cancel():
+            future.token.cancel(reason)
+            if future.output is not None:
+                future.output.close()
+            return True
+        with self.lock:
+            task = self.running.pop(future, None)
+            if task is None:
+                return False
+            self._abandon(task)
+        task.token.cancel(reason)
+        return task.settle(exception=JobCancelled(reason))
+
+    def resize(self, max_workers):
+        """change the most jobs run at once.  Extra workers start right away
+        if jobs are waiting; surplus workers leave once they are idle"""
+        if max_workers < 1:
+            raise ValueError('at least one worker is needed')
+        with self.lock:
+            self.max_workers = max_workers
+            for i in range(min(self.idle, len(self.workers) - max_workers)):
+                self.queue.put(None)
+            self._adjust_workers()
+
+    def set_backend(self, backend):
+        """run the jobs which have not started yet (and later ones) on backend"""
+        if backend not in BACKENDS:
+            raise ValueError('unknown job backend {}'.format(backend))
+        self.backend = backend
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            self.shutting_down = True
+            workers = list(self.workers)
+            for i in range(len(workers)):
+                self.queue.put(None)
+            self.reaper_wakeup.notify()
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _adjust_workers(self):
+        # called with the lock held: start workers while jobs wait for one
+        while self.idle < self.queue.qsize() and len(self.workers) < self.max_workers:
+            worker = threading.Thread(target=self._work, name='bywaf-job-worker')
+            worker.daemon = True
+            self.workers.add(worker)
+            self.idle += 1
+            worker.start()
+
+    def _abandon(self, task):
+        # called with the lock held: give up on the worker running the task
+        self.workers.discard(task.worker)
+        task.worker = None
+        self._adjust_workers()
+
+    def _work(self):
+        me = threading.current_thread()
+        while True:
+            task = self.queue.get()
+            with self.lock:
+                self.idle -= 1
+                # None asks surplus workers to leave (see resize() and shutdown())
+                if task is None:
+                    if self.shutting_down or len(self.workers) > self.max_workers:
+                        self.workers.discard(me)
+                        return
+                    self.idle += 1
+                    continue
+                if not task.future.set_running_or_notify_cancel():
+                    self.idle += 1
+                    continue
+                task.worker = me
+                self.running[task.future] = task
+                self._adjust_workers()
+
+            backend = task.backend or self.backend
+            task.future.backend = backend
+            started = time.time()
+            if self.queue_seconds is not None:
+                self.queue_seconds.observe(started - task.submitted, backend)
+
+            _current.token = task.token
+            _current.output = task.output
+            try:
+                if task.token.cancelled():
+                    result, exception = None, JobCancelled(task.token.reason)
+                elif backend == PROCESS:
+                    result, exception = self._run_in_process(task)
+                else:
+                    result, exception = task.fn(*task.args, **task.kwargs), None
+            except BaseException as e:
+                result, exception = None, e
+            finally:
+                _current.token = None
+                _current.output = None
+            task.settle(result, exception)
+            if self.run_seconds is not None:
+                self.run_seconds.observe(time.time() - started, backend, FAILED if exception is not None else DONE)
+
+            with self.lock:
+                # an abandoned worker has been replaced already, so it leaves
+                if task.worker is not me:
+                    return
+                self.running.pop(task.future, None)
+                task.worker = None
+                if len(self.workers) > self.max_workers:
+                    self.workers.discard(me)
+                    return
+                self.idle += 1
+
+    def _run_in_process(self, task):
+        # run a task in a child process, waiting for its reply while watching
+        # its token.  Returns (result, exception); the child's output is
+        # written to this thread's standard output as it comes
+        mp = _multiprocessing()
+        reader, writer = mp.Pipe(False)
+        process = mp.Process(target=_process_main,
+                              args=(writer, task.fn, task.args, task.kwargs, task.token.deadline))
+        process.daemon = True
+        try:
+            process.start()
+        except Exception:
+            # e.g. the function cannot be pickled
+            reader.close()
+            raise
+        finally:
+            writer.close()
+        try:
+            while True:
+                while not reader.poll(PROCESS_POLL_INTERVAL):
+                    if task.token.cancelled():
+                        process.terminate()
+                        return None, JobCancelled(task.token.reason)
+                message = reader.recv()
+                if message[0] == 'output':
+                    sys.stdout.write(message[1])
+                else:
+                    return message[1], message[2]
+        except EOFError:
+            return None, RuntimeError('job process exited with code {}'.format(process.exitcode))
+        finally:
+            reader.close()
+            process.join()
+
+    def _start_reaper(self):
+        # called with the lock held
+        if self.reaper is None:
+            self.reaper = threading.Thread(target=self._reap, name='bywaf-job-reaper')
+            self.reaper.daemon = True
+            self.reaper.start()
+
+    def _reap(self):
+        while True:
+            with self.lock:
+                if self.shutting_down:
+                    return
+                now = time.time()
+                expired = []
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    expired.append(heapq.heappop(self.deadlines)[2])
+                if not expired:
+                    timeout = self.deadlines[0][0] - now if self.deadlines else None
+                    self.reaper_wakeup.wait(timeout)
+                    continue
+            for task in expired:
+                if not task.future.done():
+                    self.kill(task.future, 'job ran past its deadline')
+
+
+class _PipeWriter(object):
+    """a process-backed job's standard output: sends what it prints through conn"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, text):
+        self.conn.send(('output', text))
+
+    def flush(self):
+        pass
+
+
+def _process_main(conn, fn, args, kwargs, deadline):
+    """body of a process-backed job's child: run fn, sending ('output', text)
+    messages as it prints, then ('done', result, exception) through conn"""
+    sys.stdout = sys.stderr = _PipeWriter(conn)
+    # the child's token only ever expires; kill terminates the child
+    _current.token = CancellationToken(deadline)
+    _current.output = None
+    try:
+        reply = ('done', fn(*args, **kwargs), None)
+    except BaseException as e:
+        reply = ('done', None, e)
+    try:
+        conn.send(reply)
+    except Exception:
+        # the result or exception could not be pickled: send its text instead
+        if reply[2] is not None:
+            conn.send(('done', None, Exception(repr(reply[2]))))
+        else:
+            conn.send(('done', str(reply[1]), None))
+    conn.close()
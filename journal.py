@@ -0,0 +1,308 @@
+# ---------------------------------------------------
+# journal.py:  crash-safe journal of Bywaf's backgrounded jobs
+# ---------------------------------------------------
+
+import os
+import json
+import stat
+import time
+import errno
+import binascii
+import tempfile
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError: # Windows: sessions cannot tell whether they share a journal
+    fcntl = None
+
+# default file name of the job journal
+DEFAULT_JOURNAL_FILENAME = "bywaf-journal.jsonl"
+
+# a job's checkpoints are written at most once every this many seconds;
+# a crash loses at most the progress made since
+DEFAULT_CHECKPOINT_INTERVAL = 1.0
+
+# finished jobs kept in the journal when it is compacted
+KEEP_FINISHED = 1000
+
+# longest result (in characters of JSON) written to the journal
+MAX_RESULT_LENGTH = 64*1024
+
+# record types
+START = 'start'
+CHECKPOINT = 'checkpoint'
+RESUME = 'resume'
+DONE = 'done'
+FAIL = 'fail'
+
+
+class JournalEntry(object):
+    """What the journal knows of a job: its command line, the plugin it was
+    run from and that plugin's option values, the state of its last
+    checkpoint, and whether it finished (status DONE or FAIL, None while it
+    has not)"""
+
+    def __init__(self, key, command_line, plugin_path, options, started):
+        self.key = key
+        self.command_line = command_line
+        self.plugin_path = plugin_path
+        self.options = options
+        self.started = started
+        self.checkpoint = None
+        self.checkpointed = None
+        self.status = None
+        self.records = []
+
+
+class Journal(object):
+    """An append-only file of JSON lines recording the jobs' lifecycle:
+    start (command line and options), checkpoint (progress), resume, and
+    done or fail (result or error).  Every line is flushed and fsync()ed
+    before the call returns, so whatever the journal says survives a crash
+    of the interpreter or of the machine.
+
+    Every session holds a shared lock on the journal while it has it open.
+    A session which opens it while no other one does reads it back (a line
+    torn by a crash is skipped) and compacts it: only unfinished jobs and
+    the last KEEP_FINISHED finished ones are kept.  Unfinished jobs of
+    earlier sessions are returned by unfinished(), to be resumed from their
+    last checkpoint.  A session which opens the journal while another one
+    uses it (shared is then set) leaves it as it is, and resumes nothing:
+    the jobs it would find unfinished may well be running there.  Once
+    closed, the journal writes nothing more, so jobs still running are
+    left unfinished in it."""
+
+    def __init__(self, filename=DEFAULT_JOURNAL_FILENAME, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+        # absolute, as plugins may change the current directory
+        self.filename = os.path.abspath(filename)
+        self.checkpoint_interval = checkpoint_interval
+
+        # unfinished jobs by key, oldest first
+        self.entries = OrderedDict()
+
+        # checkpoints held back by checkpoint_interval, by key
+        self.pending = {}
+
+        self.lock = threading.Lock()
+        self.file = None
+        self.closed = False
+        self.shared = False
+        self.pid = os.getpid()
+        self._open()
+
+    def start(self, command_line, plugin_path=None, options=None):
+        """record a job's start and return its JournalEntry"""
+        key = binascii.hexlify(os.urandom(6)).decode('ascii')
+        entry = JournalEntry(key, command_line, plugin_path, options or {}, time.time())
+        self._write(dict(type=START, key=entry.key, time=entry.started, command_line=command_line,
+                         plugin_path=plugin_path, options=entry.options))
+        with self._lock():
+            self.entries[entry.key] = entry
+        return entry
+
+    def resume(self, entry):
+        """record that an unfinished job is being run again"""
+        self._write(dict(type=RESUME, key=entry.key, time=time.time()))
+
+    def checkpoint(self, entry, state, force=False):
+        """record a job's progress.  state is anything JSON can encode.  Unless
+        force is set, a checkpoint closer than checkpoint_interval to the last
+        one written is held back until that interval is over"""
+        now = time.time()
+        entry.checkpoint = state
+        with self._lock():
+            if not force and entry.checkpointed and now - entry.checkpointed < self.checkpoint_interval:
+                if entry.key not in self.pending:
+                    timer = threading.Timer(entry.checkpointed + self.checkpoint_interval - now,
+                                            self._flush_checkpoint, (entry.key,))
+                    timer.daemon = True
+                    timer.start()
+                self.pending[entry.key] = state
+                return
+            self.pending.pop(entry.key, None)
+            entry.checkpointed = now
+        self._write(dict(type=CHECKPOINT, key=entry.key, time=now, state=state))
+
+    def finish(self, entry, result=None, error=None):
+        """record a job's end: its result, or the error it failed with"""
+        self._flush_checkpoint(entry.key)
+        if error is not None:
+            self._write(dict(type=FAIL, key=entry.key, time=time.time(), error=str(error)))
+        else:
+            self._write(dict(type=DONE, key=entry.key, time=time.time(), result=_journalable(result)))
+        with self._lock():
+            self.entries.pop(entry.key, None)
+
+    def unfinished(self):
+        """return the JournalEntries of the jobs which have not finished"""
+        with self._lock():
+            return list(self.entries.values())
+
+    def close(self):
+        """write the checkpoints held back and close the journal"""
+        for key in list(self.pending.keys()):
+            self._flush_checkpoint(key)
+        with self._lock():
+            self.closed = True
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _flush_checkpoint(self, key):
+        with self._lock():
+            state = self.pending.pop(key, None)
+            entry = self.entries.get(key)
+            if entry is None or state is None:
+                return
+            entry.checkpointed = time.time()
+        self._write(dict(type=CHECKPOINT, key=key, time=entry.checkpointed, state=state))
+
+    def _lock(self):
+        # a process-backed job's child must neither wait on a lock held by
+        # another thread of the parent when it forked, nor share its file
+        if self.pid != os.getpid():
+            self.lock = threading.Lock()
+            self.file = None
+            self.pid = os.getpid()
+        return self.lock
+
+    def _write(self, record):
+        line = json.dumps(record, sort_keys=True, default=str) + '\n'
+        with self._lock():
+            if self.closed:
+                return
+            if self.file is None:
+                self.file = self._reopen()
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def _open(self):
+        # open the journal for appending, under a shared lock held until it is
+        # closed.  Reading it back and compacting it needs an exclusive one
+        while True:
+            f = open(self.filename, 'a')
+            if fcntl is None:
+                self.file = f
+                self._load()
+                return
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                exclusive = True
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    f.close()
+                    raise
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+                exclusive = False
+            if self._replaced(f):
+                # compacted by another session while this one waited for the
+                # lock: what it holds is the old file
+                f.close()
+                continue
+            self.file = f
+            if exclusive:
+                self._load()
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_SH)
+            else:
+                self.shared = True
+            return
+
+    def _reopen(self):
+        # open the journal for appending again (in a forked child), under a
+        # shared lock as _open() takes it
+        while True:
+            f = open(self.filename, 'a')
+            if fcntl is None:
+                return f
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+            if not self._replaced(f):
+                return f
+            f.close()
+
+    def _replaced(self, f):
+        try:
+            return os.fstat(f.fileno()).st_ino != os.stat(self.filename).st_ino
+        except OSError:
+            return True
+
+    def _load(self):
+        # read the journal back, then rewrite it with only what is worth keeping
+        entries = OrderedDict()
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        key = record['key']
+                    except (ValueError, KeyError, TypeError):
+                        continue # torn or foreign line
+                    if record.get('type') == START:
+                        entries[key] = JournalEntry(key, record.get('command_line'), record.get('plugin_path'),
+                                                    record.get('options') or {}, record.get('time'))
+                    entry = entries.get(key)
+                    if entry is None:
+                        continue
+                    entry.records.append(record)
+                    if record.get('type') == CHECKPOINT:
+                        entry.checkpoint = record.get('state')
+                    elif record.get('type') in (DONE, FAIL):
+                        entry.status = record['type']
+        except IOError:
+            pass
+
+        finished = [entry for entry in entries.values() if entry.status]
+        keep = set(entry.key for entry in finished[-KEEP_FINISHED:])
+        for entry in entries.values():
+            if not entry.status:
+                keep.add(entry.key)
+                self.entries[entry.key] = entry
+        if entries:
+            self._compact(entries, keep)
+
+    def _compact(self, entries, keep):
+        # a job's start, last checkpoint and end, written to a new file of a
+        # name of its own, which then replaces the journal in one step.  The
+        # new file is locked before it replaces the journal, so that no other
+        # session can take it over in between
+        fd, tmp_filename = tempfile.mkstemp(prefix=os.path.basename(self.filename) + '.',
+                                            suffix='.tmp', dir=os.path.dirname(self.filename))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for entry in entries.values():
+                    if entry.key not in keep:
+                        continue
+                    checkpoints = [r for r in entry.records if r.get('type') == CHECKPOINT]
+                    for record in entry.records:
+                        if record.get('type') != CHECKPOINT or record is checkpoints[-1]:
+                            f.write(json.dumps(record, sort_keys=True) + '\n')
+                    entry.records = []
+                f.flush()
+                os.fsync(f.fileno())
+                os.chmod(tmp_filename, stat.S_IMODE(os.fstat(self.file.fileno()).st_mode))
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+                os.rename(tmp_filename, self.filename)
+                # appends go through a file opened for appending
+                new_file = open(self.filename, 'a')
+                if fcntl is not None:
+                    fcntl.flock(new_file.fileno(), fcntl.LOCK_SH)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.unlink(tmp_filename)
+            raise
+        self.file.close()
+        self.file = new_file
+
+
+def _journalable(result):
+    # a result as written to the journal: itself if JSON can encode it in at
+    # most MAX_RESULT_LENGTH characters, else (the start of) its text
+    try:
+        if len(json.dumps(result)) <= MAX_RESULT_LENGTH:
+            return result
+    except (TypeError, ValueError):
+        pass
+    return str(result)[:MAX_RESULT_LENGTH]
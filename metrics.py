@@ -0,0 +1,272 @@
+# ---------------------------------------------------
+# metrics.py:  counters and latency histograms of Bywaf's hot paths
+# ---------------------------------------------------
+
+import os
+import time
+import bisect
+import threading
+
+# upper bounds, in seconds, of the buckets of latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# most label value combinations kept per metric; later ones are all counted
+# under OVERFLOW_LABEL, so that e.g. a scan of a million targets cannot grow
+# the metrics without bound
+DEFAULT_MAX_SERIES = 10000
+OVERFLOW_LABEL = '_other'
+
+# seconds between two writes of the metrics file
+DEFAULT_WRITE_INTERVAL = 15
+
+
+# cpu_time(): CPU seconds used by the calling thread, or by the whole process
+# where the platform cannot tell threads apart
+try:
+    cpu_time = time.thread_time
+except AttributeError: # python < 3.7
+    try:
+        cpu_time = time.process_time
+    except AttributeError: # python 2
+        cpu_time = time.clock
+
+
+class _Metric(object):
+    """What counters and histograms share: a name, a help text, label names
+    and one series of values per combination of label values"""
+
+    kind = None
+
+    def __init__(self, name, help, labels=(), max_series=DEFAULT_MAX_SERIES):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.max_series = max_series
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def _series(self, labels):
+        # called with the lock held: the series of the given label values
+        series = self.series.get(labels)
+        if series is None:
+            if len(labels) != len(self.labels):
+                raise ValueError('{} takes the labels {}'.format(self.name, ', '.join(self.labels)))
+            if len(self.series) >= self.max_series:
+                labels = (OVERFLOW_LABEL,) * len(self.labels)
+                series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = self._new_series()
+        return series
+
+    def items(self):
+        """return (label values, copy of the series) pairs, sorted"""
+        with self.lock:
+            return sorted((labels, self._copy(series)) for labels, series in self.series.items())
+
+    def reset(self):
+        with self.lock:
+            self.series = {}
+
+
+class Counter(_Metric):
+    """A count which only goes up, e.g. of requests or bytes"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, *labels):
+        """add amount to the count of the given label values"""
+        with self.lock:
+            series = self._series(labels)
+            series[0] += amount
+
+    def _new_series(self):
+        return [0]
+
+    def _copy(self, series):
+        return series[0]
+
+    def value(self, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            return series[0] if series else 0
+
+    def exposition(self, labels, value):
+        return ['{}{} {}'.format(self.name, _labels(self.labels, labels), _number(value))]
+
+
+class Histogram(_Metric):
+    """Observed values (e.g. latencies) counted in buckets of fixed upper
+    bounds, with their count and sum.  Observing a value costs one binary
+    search and a few additions, whatever the number of values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, max_series=DEFAULT_MAX_SERIES):
+        _Metric.__init__(self, name, help, labels, max_series)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        """count a value under the given label values"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self._series(labels)
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labels):
+        """return a context manager observing the seconds its block takes"""
+        return _Timer(self, labels)
+
+    def _new_series(self):
+        # [per-bucket counts (the last one past every bound), sum, count]
+        return [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+    def _copy(self, series):
+        return [list(series[0]), series[1], series[2]]
+
+    def quantile(self, q, series):
+        """estimate the q-quantile (0 to 1) of a series as returned by
+        items(), interpolating within the bucket it falls in"""
+        counts, total, count = series
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for index, n in enumerate(counts):
+            if n and seen + n >= rank:
+                if index == len(self.buckets):
+                    # past the last bound: all that is known is that it is over it
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def exposition(self, labels, series):
+        counts, total, count = series
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            le = '+Inf' if bound == float('inf') else _number(bound)
+            lines.append('{}_bucket{} {}'.format(self.name, _labels(self.labels + ('le',), labels + (le,)),
+                                                 cumulative))
+        lines.append('{}_sum{} {}'.format(self.name, _labels(self.labels, labels), _number(total)))
+        lines.append('{}_count{} {}'.format(self.name, _labels(self.labels, labels), count))
+        return lines
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.started, *self.labels)
+
+
+class MetricsRegistry(object):
+    """The metrics of one Bywaf interpreter, by name.  Components register
+    theirs with counter() and histogram(), which return the metric already
+    registered under that name if there is one, so that a component can be
+    created again (e.g. a new job executor) and carry on counting"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets)
+
+    def _register(self, cls, name, help, labels, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels, *args)
+            elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+                raise ValueError('metric {} is already registered as another {}'.format(name, metric.kind))
+            return metric
+
+    def __iter__(self):
+        """iterate over the metrics, sorted by name"""
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        return iter([metric for name, metric in metrics])
+
+    def reset(self):
+        """zero every metric"""
+        for metric in self:
+            metric.reset()
+
+    def exposition(self):
+        """return the metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for labels, series in metric.items():
+                lines.extend(metric.exposition(labels, series))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """write the metrics to a file in the Prometheus text format (e.g. for
+        node_exporter's textfile collector).  The file is replaced in one
+        step, so that readers never see half of it"""
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write(self.exposition())
+        os.rename(tmp_filename, filename)
+
+
+class MetricsWriter(object):
+    """Writes a registry's metrics to a file every interval seconds, from a
+    thread of its own, and a last time when stopped.  A relative file name
+    is taken from the current directory when the writer is created"""
+
+    def __init__(self, registry, filename, interval=DEFAULT_WRITE_INTERVAL):
+        self.registry = registry
+        self.filename = os.path.abspath(filename)
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='bywaf-metrics-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            stopping = self.stopping.wait(self.interval)
+            try:
+                self.registry.write(self.filename)
+            except (IOError, OSError) as e:
+                import sys
+                sys.stderr.write('metrics: could not write {}: {}\n'.format(self.filename, e))
+            if stopping or self.stopping.is_set():
+                return
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,143 @@
+# ---------------------------------------------------
+# pipeline.py:  streaming pipelines between Bywaf commands
+# ---------------------------------------------------
+
+import threading
+
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+
+from jobs import job_context, enter_job_context
+
+# records buffered between two stages before the upstream stage waits
+DEFAULT_QUEUE_SIZE = 1000
+
+# seconds a stage blocked on a queue waits before it checks whether the
+# pipeline was stopped
+POLL_INTERVAL = 0.5
+
+# marks the end of a stage's records
+_END = object()
+
+
+class _Failure(object):
+    """passed downstream in place of a record when a stage raised"""
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def accepts_records(func):
+    """return True if a command function takes records from an upstream
+    stage, i.e. it can be called as func(line, records)"""
+    import inspect
+    try:
+        try:
+            spec = inspect.getfullargspec(func)
+        except AttributeError: # python 2
+            spec = inspect.getargspec(func)
+    except TypeError:
+        return False
+    args = len(spec.args)
+    if inspect.ismethod(func):
+        args -= 1
+    return args >= 2 or spec.varargs is not None
+
+
+def records_of(value):
+    """the records a command produced: the items of what it returned if it is a
+    generator or another iterable, else the value itself (nothing for None)"""
+    if value is None:
+        return ()
+    if isinstance(value, (str, bytes, dict)) or not hasattr(value, '__iter__'):
+        return (value,)
+    return value
+
+
+class Pipeline(object):
+    """Commands chained with '|'.  The first command is called as
+    func(line); every other one as func(line, records), where records
+    iterates over the previous command's records as they are produced.
+
+    Every stage but the last runs in a thread of its own, with a queue of
+    at most queue_size records between consecutive stages, so a pipeline
+    runs in constant memory whatever the number of records.  The first
+    exception raised by a stage ends the pipeline and is re-raised by run()."""
+
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE):
+        # (func, line) of every stage
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stopped = threading.Event()
+
+    def run(self, sink):
+        """run the pipeline, calling sink(record) for every record out of the
+        last stage.  Returns the number of records"""
+        context = job_context()
+        records = None
+        threads = []
+        try:
+            for func, line in self.stages[:-1]:
+                channel = queue.Queue(self.queue_size)
+                thread = threading.Thread(target=self._stage,
+                                          args=(context, func, line, records, channel))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+                records = self._reader(channel)
+
+            count = 0
+            for record in self._call(self.stages[-1][0], self.stages[-1][1], records):
+                sink(record)
+                count += 1
+            return count
+        finally:
+            # stop the upstream stages, should the last one be done early
+            self.stopped.set()
+            for thread in threads:
+                thread.join(POLL_INTERVAL)
+
+    def _call(self, func, line, records):
+        if records is None:
+            return records_of(func(line))
+        return records_of(func(line, records))
+
+    def _stage(self, context, func, line, records, channel):
+        # body of a stage's thread: move its records into the channel
+        enter_job_context(context)
+        try:
+            for record in self._call(func, line, records):
+                if not self._put(channel, record):
+                    return
+        except BaseException as e:
+            self._put(channel, _Failure(e))
+            return
+        self._put(channel, _END)
+
+    def _put(self, channel, item):
+        # returns False if the pipeline was stopped while the channel was full
+        while not self.stopped.is_set():
+            try:
+                channel.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _reader(self, channel):
+        # iterate over the records in a channel, re-raising an upstream failure
+        while True:
+            try:
+                item = channel.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                token = job_context()[0]
+                if token is not None:
+                    token.check()
+                continue
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
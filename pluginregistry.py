@@ -0,0 +1,74 @@
+# ---------------------------------------------------
+# pluginregistry.py:  resident cache of Bywaf's plugin modules
+# ---------------------------------------------------
+
+import os
+import sys
+import types
+import threading
+
+
+class PluginRegistry(object):
+    """Modules loaded from files, by path.  A module is compiled and
+    executed the first time it is loaded, then stays resident: loading it
+    again returns the very same module object (options and all) for the
+    price of a stat(), unless its file changed since, in which case it is
+    executed anew into a new module.
+
+    Compiled code objects are cached by path, modification time and size,
+    so loading one source file under several names compiles it once.  code
+    is the cache of another registry to share, so that registries holding
+    modules of their own (e.g. one per daemon client) compile a file once."""
+
+    def __init__(self, code=None):
+        # path : (stamp, module)
+        self.modules = {}
+
+        # path : (stamp, code object)
+        self.code = {} if code is None else code
+
+        # plugins load their own helper modules from job threads
+        self.lock = threading.RLock()
+
+    def load(self, filepath, name=None):
+        """return the module of the given file, named after the file unless
+        name is given.  Raises the exceptions of compiling or running it"""
+        path = os.path.abspath(filepath)
+        if name is None:
+            name = os.path.splitext(os.path.basename(path))[0]
+        stamp = self._stamp(path)
+        with self.lock:
+            resident = self.modules.get((path, name))
+            if resident is not None and resident[0] == stamp:
+                return resident[1]
+
+            if path.lower().endswith('.pyc'):
+                module = self._load_compiled(name, path)
+            else:
+                module = types.ModuleType(name)
+                module.__file__ = path
+                # as with imp.load_source(), the module can be imported by
+                # name, e.g. to unpickle the results of process-backed jobs
+                sys.modules[name] = module
+                exec(self._compile(path, stamp), module.__dict__)
+            self.modules[(path, name)] = stamp, module
+            return module
+
+    def _stamp(self, path):
+        # raises OSError if the file does not exist
+        st = os.stat(path)
+        return st.st_mtime, st.st_size
+
+    def _compile(self, path, stamp):
+        cached = self.code.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        with open(path, 'rb') as f:
+            code = compile(f.read(), path, 'exec')
+        self.code[path] = stamp, code
+        return code
+
+    def _load_compiled(self, name, path):
+        # precompiled modules are left to the interpreter's own loader
+        import imp
+        return imp.load_compiled(name, path)
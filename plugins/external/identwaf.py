@@ -12,6 +12,10 @@ options = {
    'VERBOSE': ('', '1', 'no', 'Specify verbosity (1-3)'),
    'FIND_ALL': ('', 'yes', 'yes', 'Continue identifying WAFs after finding the first one'),
    'DISABLE_REDIRECT': ('', 'yes', 'yes', 'Do not follow redirections given by 3xx responses'),
+   'PRIORITY': ('', 'interactive', 'no', 'Probe priority: interactive or bulk'),
+   'CACHE_FILE': ('', '', 'no', 'Keep responses in this cache file and answer repeated requests from it'),
+   'CACHE_TTL': ('', '86400', 'no', 'Seconds a cached response stays valid'),
+   'REFRESH': ('', 'no', 'no', 'Send every request even if it is cached, and update the cache'),
 
    # bywaf options 
    'USE_HOSTDB': ('', 'yes', 'yes', 'Use the HostDB to store information about hosts'),
@@ -30,9 +34,181 @@ options = {
 # if True, then plugin options will be simulated
 SIMULATE_USER_INPUT = True
         
+# number of hosts identified at once when identwaf reads targets from a pipeline
+PIPELINE_WORKERS = 10
+
+# response caches of the pipeline and worker commands, by (file, ttl), opened
+# once and kept across commands like wafw00f's connection pool
+import threading
+response_caches = {}
+response_caches_lock = threading.Lock()
+
+# load wafwoof and import it.  It stays loaded (with its connection pool)
+# across commands, and is reloaded only when its file changes
+def load_wafw00f():
+    import os.path
+    wafwoof_path = os.path.join(os.path.dirname(plugin_path), 'wafw00f.py')
+    return app.plugin_registry.load(wafwoof_path, 'wafw00f')
+
+# return the value of a plugin option, its default if it is unset
+def option_value(name):
+    return options[name][0] or options[name][1]
+
+# return the (absolute file name, ttl) of the response cache set by the CACHE_FILE
+# and CACHE_TTL options, None if there is none.  A relative file name is relative
+# to where Bywaf was started, as with wafw00f's --cache
+def cache_settings(wafw00f_module):
+    import os.path
+    filename = options['CACHE_FILE'][0]
+    if not filename:
+        return None
+    try:
+        ttl = int(option_value('CACHE_TTL'))
+    except ValueError:
+        raise ValueError('CACHE_TTL must be a number of seconds')
+    return os.path.join(wafw00f_module.currentDir, filename), ttl
+
+# return the response cache set by the CACHE_FILE and CACHE_TTL options, None if there is none
+def get_response_cache(wafw00f_module):
+    settings = cache_settings(wafw00f_module)
+    if settings is None:
+        return None
+    with response_caches_lock:
+        if settings not in response_caches:
+            filename, ttl = settings
+            response_caches[settings] = wafw00f_module.ResponseCache(filename, ttl=ttl)
+        return response_caches[settings]
+
+def do_targets(args):
+    """'targets load <FILE>' reads target urls from a file, one per line, for a pipeline (e.g. targets load hosts.txt | identwaf)"""
+    params = args.split()
+    if len(params) != 2 or params[0] != 'load':
+        print('usage: targets load <FILE>')
+        return
+    return read_targets(params[1])
+
+# hand out the lines of a target file one at a time, so that the file is never read in whole
+def read_targets(filename):
+    with open(filename) as targetfile:
+        for line in targetfile:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+def do_coordinate(args):
+    """'coordinate <FILE> [[HOST:]PORT]' hands the target urls of a file out to workers (bywaf.py --worker), recording the WAFs they find in the HostDB"""
+    import distributed
+    params = args.split()
+    if not 1 <= len(params) <= 2:
+        print('usage: coordinate <FILE> [[HOST:]PORT]')
+        return
+    try:
+        address = distributed.parse_address(params[1] if len(params) == 2 else distributed.DEFAULT_PORT)
+    except ValueError as e:
+        print(e)
+        return
+    # loading wafw00f changes the current directory
+    import os.path
+    filename = os.path.abspath(params[0])
+    if not os.path.isfile(filename):
+        print('no such file: {}'.format(params[0]))
+        return
+    wafw00f_module = load_wafw00f()
+    hostdb = app.hostdb
+
+    def merge(record):
+        store_record(wafw00f_module, hostdb, record)
+
+    # a host's targets go to one worker at a time, paced by its probe scheduler
+    def host_of(target):
+        parsed = parse_target(wafw00f_module, target)
+        return parsed[0] if parsed else target
+
+    coordinator = distributed.Coordinator(read_targets(filename), merge, address,
+                                          token=app.get_cancellation_token(), host_of=host_of)
+    print('coordinating on {}:{}'.format(*coordinator.address))
+    stats = coordinator.run()
+    print('{targets} targets, {reported} reported ({errors} errors), {abandoned} given up on; '
+          '{leases} leases to {workers} workers, {reclaimed} reclaimed'.format(**stats))
+    return stats
+
+def do_hostdb(args, records=None):
+    """'hostdb store' records the WAFs of the targets identified by a pipeline in the HostDB (e.g. targets load hosts.txt | identwaf | hostdb store)"""
+    if args.split() != ['store'] or records is None:
+        print('usage: ... | hostdb store')
+        return
+    wafw00f_module = load_wafw00f()
+    hostdb = app.hostdb
+    stats = {'records': 0, 'wafs': 0, 'skipped': 0}
+    for record in records:
+        stats['records'] += 1
+        stored = store_record(wafw00f_module, hostdb, record) if isinstance(record, dict) else None
+        if stored is None:
+            stats['skipped'] += 1
+        else:
+            stats['wafs'] += stored
+    hostdb.flush()
+    return stats
+
+# record the WAFs of a target identified by wafw00f (a record as returned by its
+# scantarget()) in the HostDB, by host and port.  Returns the number of WAFs
+# recorded, None for a record telling of no identification (e.g. an error)
+def store_record(wafw00f_module, hostdb, record):
+    knowledge = record.get('knowledge')
+    if not knowledge:
+        return None
+    parsed = parse_target(wafw00f_module, record['target'])
+    if parsed is None:
+        return None
+    host, port = parsed[0], str(parsed[1])
+    wafs = [(host, port, waf_name, '') for waf_name in knowledge.get('wafname', [])]
+    generic = knowledge.get('generic', {})
+    if generic.get('found'):
+        wafs.append((host, port, 'generic', generic.get('reason', '')))
+    hostdb.add_wafs(wafs)
+    return len(wafs)
+
+# return the (host, port, path, query, ssl) of a target url as wafw00f sees
+# it, None if it does not parse
+def parse_target(wafw00f_module, target):
+    try:
+        return wafw00f_module.oururlparse(wafw00f_module.fixurl(target))
+    except Exception:
+        return None
+
+def do_worker(args):
+    """'worker [HOST:]PORT' identifies the targets handed out by a coordinator (see coordinate) until there are no more"""
+    import distributed
+    try:
+        address = distributed.parse_address(args.strip() or distributed.DEFAULT_PORT)
+    except ValueError as e:
+        print(e)
+        return
+    wafw00f_module = load_wafw00f()
+    token = app.get_cancellation_token()
+    responsecache = get_response_cache(wafw00f_module)
+
+    def scan(targets):
+        return wafw00f_module.scantargets(targets, workers=PIPELINE_WORKERS,
+                                          findall=options['FIND_ALL'][0] == 'yes',
+                                          followredirect=options['DISABLE_REDIRECT'][0] != 'yes',
+                                          responsecache=responsecache,
+                                          refresh=option_value('REFRESH') == 'yes',
+                                          token=token, scheduler=app.scheduler, priority='bulk',
+                                          metrics=app.metrics)
+
+    stats = distributed.Worker(address, scan, token=token).run()
+    print('{records} targets identified in {leases} leases ({lost} lost)'.format(**stats))
+    return stats
+
+# commands sending probes run on a thread when backgrounded, paced by Bywaf's
+# probe scheduler along with every other job (see app.get_job_backend())
+do_worker.sends_probes = True
+
 # idea: be able to specify TARGET_HOST on the bywaf command line; i.e. "identwaf TARGET_HOST=... TARGET_PORT=..."
 # as well as through plugin options.  Options on the commandline override settings specified in the plugin options.
-def do_identwaf(args):
+def do_identwaf(args, records=None):
+    """identify the WAFs in front of TARGET_HOST, or of the targets read from a pipeline"""
     
     #params = args.split()
 
@@ -44,29 +220,96 @@ def do_identwaf(args):
         app.set_option('FIND_ALL', 'yes')
        
     # set up parameters for calling WafW00F
-    params = 'wafw00f ' + ' '.join([
-       '-' + 'v' * int(options['VERBOSE'][0]),  # interpret verbosity
-         '--findall=' + options['FIND_ALL'][0],
-         '--disableredict=' + options['DISABLE_REDIRECT'][0],
-         '--xmlrpc=no',
-         options['TARGET_HOST'][0],
-         ])
+    params = ['-' + 'v' * int(options['VERBOSE'][0])]  # interpret verbosity
+    if options['FIND_ALL'][0] == 'yes':
+        params.append('--findall')
+    if options['DISABLE_REDIRECT'][0] == 'yes':
+        params.append('--disableredirect')
+    params.extend(options['TARGET_HOST'][0].split())
+    priority = options['PRIORITY'][0] or options['PRIORITY'][1]
+
+    # in a pipeline, identify each target read and pass its record (a dictionary
+    # as returned by wafw00f's scantarget()) on to the next command
+    if records is not None:
+        return identify_records(records, priority)
 
     # run wafwoof
+    token = app.get_cancellation_token()
     try:
-        import os.path
-        import imp
-
-        # load wafwoof and import it
-        wafwoof_path = os.path.join(os.path.dirname(plugin_path), 'wafw00f.py')
-        wafw00f_module = imp.load_source('wafw00f', wafwoof_path)
-        print('executing {}'.format(params))
+        wafw00f_module = load_wafw00f()
+        try:
+            settings = cache_settings(wafw00f_module)
+        except ValueError as e:
+            print(e)
+            return
+        if settings is not None:
+            params[1:1] = ['--cache', settings[0], '--cachettl', str(settings[1])]
+            if option_value('REFRESH') == 'yes':
+                params.insert(1, '--refresh')
+        print('executing wafw00f {}'.format(' '.join(params)))
         
-        # call its main with the parameters we set above
-        wafw00f_module.main(params)
+        # call its main with the parameters we set above.  When backgrounded,
+        # the job's cancellation token lets "kill" stop wafw00f between requests.
+        # Requests are paced by Bywaf's probe scheduler and recorded in its metrics
+        wafw00f_module.main(params, token=token, scheduler=app.scheduler, priority=priority,
+                            metrics=app.metrics)
         
+    except SystemExit:
+        pass
     except Exception as e:
+        # let a killed job end as killed
+        if token is not None and token.cancelled():
+            raise
+
         import traceback as t
         exc_msg = t.format_exc()
         print('could not load wafw000f: {}'.format(exc_msg))
         return        
+
+do_identwaf.sends_probes = True
+
+def identify_records(records, priority):
+    import heapq
+    from collections import deque
+
+    # records are target urls, or records with a "target" key
+    targets = (r['target'] if isinstance(r, dict) else str(r) for r in records)
+    targets = (t.strip() for t in targets)
+    targets = (t for t in targets if t and not t.startswith('#'))
+
+    # when backgrounded, the job checkpoints how many targets are done (those
+    # before the first one still being identified), and skips them when resumed
+    checkpoint = app.get_checkpoint() or {}
+    progress = {'done': checkpoint.get('done', 0), 'read': 0}
+    positions = {}    # target : positions in the target list being identified
+    pending = []      # heap of the positions being identified
+    identified = set()
+
+    def numbered(targets):
+        for position, target in enumerate(targets):
+            progress['read'] = position + 1
+            if position < progress['done']:
+                continue
+            positions.setdefault(target, deque()).append(position)
+            heapq.heappush(pending, position)
+            yield target
+
+    wafw00f_module = load_wafw00f()
+    for record in wafw00f_module.scantargets(numbered(targets), workers=PIPELINE_WORKERS,
+                                             findall=options['FIND_ALL'][0] == 'yes',
+                                             followredirect=options['DISABLE_REDIRECT'][0] != 'yes',
+                                             responsecache=get_response_cache(wafw00f_module),
+                                             refresh=option_value('REFRESH') == 'yes',
+                                             token=app.get_cancellation_token(),
+                                             scheduler=app.scheduler, priority=priority,
+                                             metrics=app.metrics):
+        yield record
+
+        target_positions = positions[record['target']]
+        identified.add(target_positions.popleft())
+        if not target_positions:
+            del positions[record['target']]
+        while pending and pending[0] in identified:
+            identified.remove(heapq.heappop(pending))
+        progress['done'] = pending[0] if pending else progress['read']
+        app.checkpoint({'done': progress['done']})
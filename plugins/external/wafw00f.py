@@ -39,6 +39,20 @@ import logging
 import socket
 import sys
 import random
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import itertools
+import collections
+import copy
+import concurrent.futures
+from functools import wraps
+
+# default signature file, next to this module
+signaturefile = os.path.join(os.path.dirname(os.path.abspath(__file__)),'wafsignatures.json')
 
 currentDir = os.getcwd()
 scriptDir = os.path.dirname(sys.argv[0]) or '.'
@@ -48,6 +62,34 @@ from libs.evillib import *
 
 __version__ = '0.9.0'
 
+# number of probes kept in flight at once by a ProbeEngine
+DEFAULT_PROBE_WORKERS = 10
+
+# number of hosts identified at once in bulk mode
+DEFAULT_BULK_WORKERS = 10
+
+# number of idle keep-alive connections kept per (host, port, ssl)
+DEFAULT_POOL_SIZE = 10
+
+# seconds a response stays in a ResponseCache, and the cache's size in bytes
+DEFAULT_CACHE_TTL = 24*60*60
+DEFAULT_CACHE_SIZE = 64*1024*1024
+
+# seconds a ResponseCache remembers that a request got no response (0 to
+# send it again every time): a reset or a timeout is often transient
+DEFAULT_FAILURE_TTL = 60
+
+# WafW00F instances kept by the RPC interface, and the seconds each is kept
+DEFAULT_API_CACHE_SIZE = 10000
+DEFAULT_API_CACHE_TTL = 60*60
+
+# calls the RPC interface serves at once, urls it keeps queued across
+# batches, seconds it keeps a batch nobody polls, and the longest a poll waits
+DEFAULT_RPC_HANDLERS = 32
+DEFAULT_API_MAX_QUEUED = 100000
+DEFAULT_BATCH_TTL = 60*60
+MAX_POLL_WAIT = 60
+
 lackofart = """
                                  ^     ^
         _   __  _   ____ _   __  _    _   ____
@@ -63,6 +105,430 @@ lackofart = """
 """
 
 
+def sharedprobe(probe):
+    """
+    Decorator for WafW00F probes.  Called without arguments, a probe goes to
+    the network once per WafW00F instance and every detection reading it gets
+    the same response.  Called with arguments (e.g. usecache=False) it is
+    always sent.
+    """
+    @wraps(probe)
+    def sharedprobewrapper(self,*args,**kwargs):
+        if args or kwargs:
+            return self.sendprobe(probe,*args,**kwargs)
+        name = probe.__name__
+        if name not in self.responses:
+            self.responses[name] = self.sendprobe(probe)
+        return self.responses[name]
+    return sharedprobewrapper
+
+
+def signaturedetection(wafvendor):
+    """
+    build the detection method of a WAF described by signatures
+    """
+    def detection(self):
+        return self.matchsignatures(wafvendor)
+    return detection
+
+
+class SignatureSet:
+    """
+    WAF signatures expressed as data.  A signature names the WAF, the probe
+    whose response it reads and any of: a header regex ("header" and
+    "match"), a Set-Cookie regex ("cookie"), a status code, a reason phrase
+    and a protocol version.  Signatures looking at connection-level
+    behaviour are marked "fresh" so that their probe gets its own socket.
+    A signature matches when all of its conditions hold, and a WAF is
+    detected when any of its signatures matches.
+
+    The regexes of all signatures reading the same header of the same probe
+    are compiled into one pattern made of optional lookaheads, one named
+    group per signature, so that a single pass over the headers of a
+    response evaluates every vendor at once.
+    """
+
+    def __init__(self,aliases=None):
+        # probe names standing for several probes, e.g. "attacks"
+        self.aliases = aliases or dict()
+        self.signatures = list()
+        self.wafvendors = list()
+        # probe name -> (header name -> (pattern, signature indexes), indexes of headerless signatures)
+        self.compiled = dict()
+
+    def load(self,filename):
+        """
+        load signatures from a JSON file holding a list of signatures
+        """
+        f = open(filename)
+        try:
+            signatures = json.load(f)
+        finally:
+            f.close()
+        for signature in signatures:
+            self.add(signature)
+        self.compile()
+
+    def add(self,signature):
+        """
+        add one signature; compile() must be called before evaluating again
+        """
+        signature = dict(signature)
+        if 'waf' not in signature or 'probe' not in signature:
+            raise ValueError('a signature needs a "waf" and a "probe": %r' % (signature,))
+        if 'cookie' in signature:
+            signature['header'] = 'set-cookie'
+            signature['match'] = signature.pop('cookie')
+        if 'header' in signature:
+            signature['header'] = signature['header'].lower()
+        self.signatures.append(signature)
+        if signature['waf'] not in self.wafvendors:
+            self.wafvendors.append(signature['waf'])
+
+    def copy(self):
+        """
+        return a new set holding the same signatures, to add others to
+        """
+        signatures = SignatureSet(self.aliases)
+        signatures.signatures = list(self.signatures)
+        signatures.wafvendors = list(self.wafvendors)
+        signatures.compiled = self.compiled
+        return signatures
+
+    def probes(self,wafvendor):
+        """
+        return the names of the probes read by the signatures of a WAF
+        """
+        probenames = list()
+        for signature in self.signatures:
+            if signature['waf'] != wafvendor:
+                continue
+            for probename in self.aliases.get(signature['probe'],[signature['probe']]):
+                if probename not in probenames:
+                    probenames.append(probename)
+        return probenames
+
+    def freshprobes(self):
+        """
+        return the names of the probes read by signatures marked "fresh",
+        which look at connection-level behaviour
+        """
+        probenames = set()
+        for signature in self.signatures:
+            if signature.get('fresh'):
+                probenames.update(self.aliases.get(signature['probe'],[signature['probe']]))
+        return probenames
+
+    def compile(self):
+        compiled = dict()
+        patterns = dict()
+        for index,signature in enumerate(self.signatures):
+            for probename in self.aliases.get(signature['probe'],[signature['probe']]):
+                headers,headerless = compiled.setdefault(probename,(dict(),list()))
+                if 'header' in signature:
+                    patterns.setdefault((probename,signature['header']),list()).append(index)
+                else:
+                    headerless.append(index)
+        for (probename,header),indexes in patterns.items():
+            pattern = ''.join(['(?:(?=(?P<s%d>%s)))?' % (index,self.signatures[index]['match'])
+                               for index in indexes])
+            compiled[probename][0][header] = (re.compile(pattern,re.IGNORECASE),indexes)
+        self.compiled = compiled
+
+    def evaluate(self,probename,response):
+        """
+        return the set of WAFs whose signatures match a response to a probe
+        """
+        detected = set()
+        if probename not in self.compiled:
+            return detected
+        headers,headerless = self.compiled[probename]
+        candidates = list(headerless)
+        for header,value in response.getheaders():
+            header = header.lower()
+            if header not in headers:
+                continue
+            pattern,indexes = headers[header]
+            # set-cookie can have multiple headers, python gives it to us
+            # concatinated with a comma
+            if header == 'set-cookie':
+                values = value.split(', ')
+            else:
+                values = [value]
+            for value in values:
+                m = pattern.match(value)
+                for index in indexes:
+                    if m.group('s%d' % index) is not None:
+                        candidates.append(index)
+        for index in candidates:
+            signature = self.signatures[index]
+            if 'status' in signature and response.status != signature['status']:
+                continue
+            if 'reason' in signature and response.reason != signature['reason']:
+                continue
+            if 'version' in signature and response.version != signature['version']:
+                continue
+            detected.add(signature['waf'])
+        return detected
+
+
+class ConnectionPool:
+    """
+    Idle HTTP/1.1 keep-alive connections, kept per (host, port, ssl) so that
+    the requests of an identification reuse one handshake.  A connection is
+    handed to one request at a time; the pool is safe to share between
+    threads and WafW00F instances.
+    """
+
+    def __init__(self,maxidle=DEFAULT_POOL_SIZE):
+        self.maxidle = maxidle
+        self.idle = dict()
+        self.lock = threading.Lock()
+
+    def connect(self,host,port,ssl):
+        """
+        open a new connection, which does not come from the pool
+        """
+        if ssl:
+            return httplib.HTTPSConnection(host,port)
+        return httplib.HTTPConnection(host,port)
+
+    def get(self,host,port,ssl):
+        """
+        return (connection, reused), an idle connection being preferred
+        """
+        with self.lock:
+            idle = self.idle.get((host,port,ssl))
+            if idle:
+                return idle.pop(),True
+        return self.connect(host,port,ssl),False
+
+    def put(self,host,port,ssl,conn):
+        """
+        give back a connection whose response has been read completely
+        """
+        with self.lock:
+            idle = self.idle.setdefault((host,port,ssl),list())
+            if len(idle) < self.maxidle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = dict()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+# connections shared by every WafW00F instance which is not given a pool
+connectionpool = ConnectionPool()
+
+
+class CachedResponse:
+    """
+    A response read back from a ResponseCache.  Offers the parts of an
+    httplib response that the detections look at
+    """
+
+    def __init__(self,data):
+        self.status = data['status']
+        self.reason = data['reason']
+        self.version = data['version']
+        self.headers = [tuple(header) for header in data['headers']]
+        self.bodydigest = data['digest']
+        self.will_close = False
+
+    def getheader(self,name,default=None):
+        name = name.lower()
+        for header,value in self.headers:
+            if header.lower() == name:
+                return value
+        return default
+
+    def getheaders(self):
+        return list(self.headers)
+
+
+class ResponseCache:
+    """
+    Persistent cache of responses in an SQLite file, which any number of
+    processes can share.  For each request it keeps the status, reason,
+    protocol version, headers and a digest of the body of the response, or
+    the fact that no response came back, for ttl seconds (failurettl for
+    the latter).  Past maxsize bytes the oldest entries are evicted.
+    """
+
+    # how many stores go by between two evictions
+    evictevery = 100
+
+    def __init__(self,filename,ttl=DEFAULT_CACHE_TTL,maxsize=DEFAULT_CACHE_SIZE,failurettl=DEFAULT_FAILURE_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self.failurettl = min(failurettl,ttl)
+        self.maxsize = maxsize
+        self.stores = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename,timeout=30,check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses '
+                        '(key TEXT PRIMARY KEY, stored REAL, size INTEGER, response TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_stored ON responses (stored)')
+        self.db.commit()
+
+    def get(self,key):
+        """
+        return (found, r) where r is (response,responsebody), or None for a
+        request which got no response.  The body itself is not kept, so
+        responsebody is empty and response.bodydigest holds its SHA-1
+        """
+        with self.lock:
+            row = self.db.execute('SELECT stored,response FROM responses WHERE key=?',(key,)).fetchone()
+        if row is None or row[0] < time.time() - self.ttl:
+            return False,None
+        data = json.loads(row[1])
+        if data is None:
+            if row[0] < time.time() - self.failurettl:
+                return False,None
+            return True,None
+        return True,(CachedResponse(data),'')
+
+    def put(self,key,r):
+        if r is None:
+            if self.failurettl <= 0:
+                return
+            data = None
+        else:
+            response,responsebody = r
+            data = dict(status=response.status,reason=response.reason,
+                        version=response.version,headers=response.getheaders(),
+                        digest=hashlib.sha1(responsebody).hexdigest())
+        text = json.dumps(data)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?,?,?,?)',
+                            (key,time.time(),len(key)+len(text),text))
+            self.db.commit()
+            self.stores += 1
+            if self.stores % self.evictevery == 0:
+                self._evict()
+
+    def _evict(self):
+        self.db.execute('DELETE FROM responses WHERE stored < ?',(time.time() - self.ttl,))
+        total = self.db.execute('SELECT COALESCE(SUM(size),0) FROM responses').fetchone()[0]
+        if total > self.maxsize:
+            # drop the oldest entries until the cache fits again
+            cutoff = None
+            for stored,size in self.db.execute('SELECT stored,size FROM responses ORDER BY stored').fetchall():
+                total -= size
+                cutoff = stored
+                if total <= self.maxsize:
+                    break
+            self.db.execute('DELETE FROM responses WHERE stored <= ?',(cutoff,))
+        self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM responses')
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class ProbeEngine:
+    """
+    Sends wafw00f probes concurrently on a bounded pool of workers.
+    One engine can be shared by several WafW00F instances, so that probes
+    are kept in flight both for one target and across targets.
+    """
+
+    def __init__(self,maxworkers=DEFAULT_PROBE_WORKERS):
+        self.maxworkers = maxworkers
+        self.executor = concurrent.futures.ThreadPoolExecutor(maxworkers)
+        # probes currently in flight, indexed by (target instance, probe name)
+        self.inflight = dict()
+        self.lock = threading.RLock()
+
+    def submit(self,attacker,probe):
+        """
+        queue a probe method of attacker and return its Future.
+        A probe which is already in flight for the same instance is not sent twice.
+        """
+        key = (id(attacker),probe.__name__)
+        self.lock.acquire()
+        try:
+            future = self.inflight.get(key)
+            if future is None:
+                future = self.executor.submit(probe,attacker)
+                self.inflight[key] = future
+                future.add_done_callback(lambda f: self._forget(key))
+        finally:
+            self.lock.release()
+        return future
+
+    def _forget(self,key):
+        self.lock.acquire()
+        try:
+            self.inflight.pop(key,None)
+        finally:
+            self.lock.release()
+
+    def prefetch(self,attacker,probes):
+        """
+        send all probes at once and wait for them to come back.
+        Returns the list of (response,responsebody) tuples, None for failed probes
+        """
+        futures = [self.submit(attacker,probe) for probe in probes]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+# the probe engines of main(), by number of workers.  A plugin calling main()
+# again and again (see identwaf) reuses their threads instead of leaving a new
+# pool behind on every call
+sharedengines = {}
+sharedengineslock = threading.Lock()
+
+def sharedengine(maxworkers):
+    """
+    return the ProbeEngine of maxworkers workers shared by main() calls
+    """
+    with sharedengineslock:
+        engine = sharedengines.get(maxworkers)
+        if engine is None:
+            engine = sharedengines[maxworkers] = ProbeEngine(maxworkers)
+        return engine
+
+
+class Detections:
+    """
+    What a WafW00F detects and how: the WAFs in the order they are checked,
+    the method detecting each, the probes each one reads, the signatures and
+    the probes sent on fresh connections.  WafW00F.loadsignatures() returns
+    new Detections, which apply only to the WafW00F instances given them
+    """
+
+    def __init__(self,wafdetections,wafdetectionsprio,detectionprobes,signatures,freshprobes):
+        self.wafdetections = wafdetections
+        self.wafdetectionsprio = wafdetectionsprio
+        self.detectionprobes = detectionprobes
+        self.signatures = signatures
+        self.freshprobes = freshprobes
+
+    def apply(self,target):
+        """
+        set the detections on target, the WafW00F class or an instance
+        """
+        target.wafdetections = self.wafdetections
+        target.wafdetectionsprio = self.wafdetectionsprio
+        target.detectionprobes = self.detectionprobes
+        target.signatures = self.signatures
+        target.freshprobes = self.freshprobes
+
+
 class WafW00F(waftoolsengine):
     """
     WAF detection tool
@@ -75,62 +541,273 @@ class WafW00F(waftoolsengine):
     isaservermatch = 'Forbidden ( The server denied the specified Uniform Resource Locator (URL). Contact the server administrator.  )'
     
     def __init__(self,target='www.microsoft.com',port=80,ssl=False,
-                 debuglevel=0,path='/',followredirect=True):
+                 debuglevel=0,path='/',followredirect=True,engine=None,pool=None,
+                 responsecache=None,refresh=False,token=None,scheduler=None,
+                 priority='interactive',metrics=None,detections=None):
         """
         target: the hostname or ip of the target server
         port: defaults to 80
         ssl: defaults to false
+        engine: a ProbeEngine used to send probes concurrently, None sends them one at a time
+        pool: the ConnectionPool requests go through, defaults to the module's connectionpool
+        responsecache: a ResponseCache answering requests made before, None disables it
+        refresh: ignore what responsecache holds and store the new responses
+        token: a cancellation token, whose check() is called before every request
+        and raises once the scan should stop (e.g. a killed bywaf job)
+        scheduler: paces the requests sent, through its acquire(host,job,priority,token)
+        method (e.g. bywaf's ProbeScheduler).  The token identifies the job
+        priority: the scheduler's priority class for these requests, 'interactive' or 'bulk'
+        metrics: a registry (e.g. bywaf's MetricsRegistry) in which to record the
+        latency of each probe by target and probe, the bytes received and the
+        response cache's hits and misses
+        detections: the Detections to run (see loadsignatures), defaults to
+        the built-in ones
         """
         waftoolsengine.__init__(self,target,port,ssl,debuglevel,path,followredirect)
+        if detections is not None:
+            detections.apply(self)
         self.log = logging.getLogger('wafw00f')
         self.knowledge = dict(generic=dict(found=False,reason=''),wafname=list())
+        self.engine = engine
+        # responses of the shared probes sent so far, by probe name
+        self.responses = dict()
+        # WAFs whose signatures matched each probe, by probe name
+        self.signaturehits = dict()
+        self.pool = pool or connectionpool
+        # per-thread flag telling _send() to use a fresh connection
+        self.local = threading.local()
+        self.responsecache = responsecache
+        self.refresh = refresh
+        # requests answered by responsecache instead of the network
+        self.cachehits = 0
+        # requestnumber and cachehits are counted from the engine's workers
+        self.counterlock = threading.Lock()
+        self.token = token
+        self.scheduler = scheduler
+        self.priority = priority
+        self.probeseconds = None
+        if metrics is not None:
+            self.probeseconds = metrics.histogram('wafw00f_probe_seconds',
+                                                  'Seconds a probe took to be answered, by target and probe',
+                                                  ('target','probe'))
+            self.responsebytes = metrics.counter('wafw00f_response_bytes_total',
+                                                 'Bytes of response bodies received, by target',('target',))
+            self.cachelookups = metrics.counter('wafw00f_cache_lookups_total',
+                                                'Requests looked up in the response cache, by result',('result',))
+        # "host:port", the target label of the metrics
+        self.targetlabel = '%s:%s' % (target,port)
+
+    def cachekey(self,method,path,headers):
+        """
+        key of a request in the response cache: scheme, host, port, method,
+        path and the request headers
+        """
+        salient = list()
+        for name,value in sorted(headers.items()):
+            # the Host header sent by invalidhost() is random; all that matters
+            # is that it is not the target
+            if name.lower() == 'host' and value != self.target:
+                value = '*'
+            salient.append([name.lower(),value])
+        if self.ssl:
+            scheme = 'https'
+        else:
+            scheme = 'http'
+        return json.dumps([scheme,self.target,str(self.port),method,path,salient])
+
+    def _request(self,method,path,headers):
+        """
+        answer a request from the response cache if it is there, else send it
+        """
+        if self.token is not None:
+            self.token.check()
+        if headers is None:
+            headers = dict()
+        if self.responsecache is None:
+            return self._send(method,path,headers)
+        key = self.cachekey(method,path,headers)
+        if not self.refresh:
+            found,r = self.responsecache.get(key)
+            if found:
+                with self.counterlock:
+                    self.cachehits += 1
+                if self.probeseconds is not None:
+                    self.cachelookups.inc(1,'hit')
+                return r
+        if self.probeseconds is not None:
+            self.cachelookups.inc(1,'miss')
+        r = self._send(method,path,headers)
+        self.responsecache.put(key,r)
+        return r
+
+    def _send(self,method,path,headers):
+        """
+        send one request over a pooled keep-alive connection.  Requests sent
+        while a probe of freshprobes is running get a connection of their own,
+        closed afterwards, since those probes look at connection-level behaviour
+        """
+        if self.scheduler is not None:
+            self.scheduler.acquire(self.target,self.token,self.priority,self.token)
+        fresh = getattr(self.local,'fresh',False)
+        if fresh:
+            conn,reused = self.pool.connect(self.target,self.port,self.ssl),False
+        else:
+            conn,reused = self.pool.get(self.target,self.port,self.ssl)
+        started = time.time()
+        while True:
+            if 1 < self.debuglevel <= 10:
+                conn.set_debuglevel(self.debuglevel)
+            try:
+                self.log.info('Sending %s %s' % (method,path))
+                conn.request(method,path,headers=headers)
+                response = conn.getresponse()
+                responsebody = response.read()
+                break
+            except (socket.error,socket.timeout,httplib.HTTPException):
+                conn.close()
+                if not reused:
+                    self.log.warn('Hey.. they closed our connection!')
+                    return
+                # the server dropped an idle keep-alive connection, retry on a new one
+                conn,reused = self.pool.connect(self.target,self.port,self.ssl),False
+        with self.counterlock:
+            self.requestnumber += 1
+        if self.probeseconds is not None:
+            self.probeseconds.observe(time.time() - started,self.targetlabel,
+                                      getattr(self.local,'probe',None) or 'request')
+            self.responsebytes.inc(len(responsebody),self.targetlabel)
+        if fresh or response.will_close:
+            conn.close()
+        else:
+            self.pool.put(self.target,self.port,self.ssl,conn)
+        return response,responsebody
+
+    def sendprobe(self,probe,*args,**kwargs):
+        """
+        send a probe, on fresh connections if it is one of freshprobes.
+        Its requests are recorded in the metrics under the probe's name
+        """
+        self.local.probe = probe.__name__
+        self.local.fresh = probe.__name__ in self.freshprobes
+        try:
+            return probe(self,*args,**kwargs)
+        finally:
+            self.local.probe = None
+            self.local.fresh = False
         
+    @sharedprobe
     def normalrequest(self,usecache=True,cacheresponse=True,headers=None):
         return self.request(usecache=usecache,cacheresponse=cacheresponse,headers=headers)
     
+    @sharedprobe
     def normalnonexistentfile(self,usecache=True,cacheresponse=True):
         path = self.path + str(random.randrange(1000,9999)) + '.html'
         return self.request(path=path,usecache=usecache,cacheresponse=cacheresponse)
     
+    @sharedprobe
     def unknownmethod(self,usecache=True,cacheresponse=True):
         return self.request(method='OHYEA',usecache=usecache,cacheresponse=cacheresponse)
     
+    @sharedprobe
     def directorytraversal(self,usecache=True,cacheresponse=True):
         return self.request(path=self.path+self.dirtravstring,usecache=usecache,cacheresponse=cacheresponse)
         
+    @sharedprobe
     def invalidhost(self,usecache=True,cacheresponse=True):
         randomnumber = random.randrange(100000,999999)
         return self.request(headers={'Host':str(randomnumber)})
         
+    @sharedprobe
     def cleanhtmlencoded(self,usecache=True,cacheresponse=True):
         string = self.path + quote(self.cleanhtmlstring) + '.html'
         return self.request(path=string,usecache=usecache,cacheresponse=cacheresponse)
 
+    @sharedprobe
     def cleanhtml(self,usecache=True,cacheresponse=True):
         string = self.path + self.cleanhtmlstring + '.html'
         return self.request(path=string,usecache=usecache,cacheresponse=cacheresponse)
         
+    @sharedprobe
     def xssstandard(self,usecache=True,cacheresponse=True):
         xssstringa = self.path + self.xssstring + '.html'
         return self.request(path=xssstringa,usecache=usecache,cacheresponse=cacheresponse)
     
+    @sharedprobe
     def protectedfolder(self,usecache=True,cacheresponse=True):
         pfstring = self.path + self.AdminFolder
         return self.request(path=pfstring,usecache=usecache,cacheresponse=cacheresponse)
 
+    @sharedprobe
     def xssstandardencoded(self,usecache=True,cacheresponse=True):
         xssstringa = self.path + quote(self.xssstring) + '.html'
         return self.request(path=xssstringa,usecache=usecache,cacheresponse=cacheresponse)
     
+    @sharedprobe
     def cmddotexe(self,usecache=True,cacheresponse=True):
         # thanks j0e
         string = self.path + 'cmd.exe'
         return self.request(path=string,usecache=usecache,cacheresponse=cacheresponse)
     
+    @sharedprobe
+    def longtransferencoding(self,usecache=True,cacheresponse=True):
+        # credit goes to W3AF
+        headers = dict()
+        headers['Transfer-Encoding'] = 'z' * 1025
+        return self.request(headers=headers,usecache=usecache,cacheresponse=cacheresponse)
+
+    @sharedprobe
+    def urlscanheaders(self,usecache=True,cacheresponse=True):
+        testheaders = dict()
+        testheaders['Translate'] = 'z'*10
+        testheaders['If'] = 'z'*10
+        testheaders['Lock-Token'] = 'z'*10
+        testheaders['Transfer-Encoding'] = 'z'*10
+        return self.request(headers=testheaders,usecache=usecache,cacheresponse=cacheresponse)
+
+    @sharedprobe
+    def atsignquery(self,usecache=True,cacheresponse=True):
+        newpath = self.path + '?nx=@@'
+        return self.request(path=newpath,usecache=usecache,cacheresponse=cacheresponse)
+    
     attacks = [cmddotexe,directorytraversal,xssstandard,protectedfolder,xssstandardencoded]
+
+    # probes sent on a fresh connection instead of a pooled one: genericdetect()
+    # looks for scrambled connection headers in the attacks, and signatures
+    # marked "fresh" add the probes they read
+    freshprobes = set([probe.__name__ for probe in attacks])
+
+    # probes read by genericdetect() itself, before it replays the detections
+    genericprobes = [cleanhtml,xssstandard,cleanhtmlencoded,xssstandardencoded,normalrequest] + attacks
+
+    def planprobes(self,wafvendors):
+        """
+        compile the ordered union of the probes needed by the given detections
+        """
+        plan = list()
+        for wafvendor in wafvendors:
+            for probe in self.detectionprobes.get(wafvendor,[]):
+                if probe not in plan:
+                    plan.append(probe)
+        return plan
+
+    def runplan(self,plan):
+        """
+        issue each probe of a plan exactly once, concurrently when a probe
+        engine is set.  Detections then evaluate against the shared responses.
+        """
+        plan = [probe for probe in plan if probe.__name__ not in self.responses]
+        if self.engine is None:
+            for probe in plan:
+                probe(self)
+        else:
+            self.engine.prefetch(self,plan)
     
     def genericdetect(self,usecache=True,cacheresponse=True):        
         reason = ''
+        # the checks below stop at the first finding, so only send every probe
+        # ahead of time when they can go out concurrently
+        if self.engine is not None:
+            self.runplan(self.genericprobes + self.planprobes(self.wafdetectionsprio))
         reasons = ['Blocking is being done at connection/packet level.',
                    'The server header is different when an attack is detected.',
                    'The server returned a different response code when a string trigged the blacklist.',
@@ -217,76 +894,35 @@ class WafW00F(waftoolsengine):
                     return True
         return False
 
-    def matchheader(self,headermatch,attack=False,ignorecase=True):
-        import re
-        detected = False
-        header,match = headermatch
-        if attack:
-            requests = self.attacks
-        else:
-            requests = [self.normalrequest]
-        for request in requests:            
-            r = request(self)
-            if r is None:                
-                return
-            response,responsebody = r
-            headerval = response.getheader(header)
-            if headerval:
-                # set-cookie can have multiple headers, python gives it to us
-                # concatinated with a comma
-                if header == 'set-cookie':
-                    headervals = headerval.split(', ')
-                else:
-                    headervals = [headerval]
-                for headerval in headervals:
-                    if ignorecase:
-                        if re.match(match,headerval,re.IGNORECASE):
-                            detected = True
-                            break
-                    else:
-                        if re.match(match,headerval):
-                            detected = True
-                            break
-                if detected:
-                    break
-        return detected
-
-    def isbigip(self):
-        return self.matchheader(('X-Cnection','^close$'), attack=True)
-    
-    def iswebknight(self):
-        detected = False
-        for attack in self.attacks:
-            r = attack(self)
-            if r is None:                
-                return
-            response, responsebody = r
-            if response.status == 999:
-                detected = True
-                break
-        return detected
-        
-    def ismodsecurity(self):
-        detected = False
-        for attack in self.attacks:
-            r = attack(self)
-            if r is None:                
-                return
-            response, responsebody = r
-            if response.status == 501:
-                detected = True
-                break
-        return detected
-    
-    def isisaserver(self):
-        detected = False
-        r = self.invalidhost()
-        if r is None:
+    def matchsignatures(self,wafvendor):
+        """
+        evaluate the signatures of a WAF against the shared probe responses.
+        Returns None if a probe it reads got no response and nothing matched
+        """
+        noresponse = False
+        for probename in self.signatures.probes(wafvendor):
+            matched = self.signaturematches(probename)
+            if matched is None:
+                noresponse = True
+            elif wafvendor in matched:
+                return True
+        if noresponse:
             return
-        response,responsebody = r
-        if response.reason == self.isaservermatch:
-            detected = True
-        return detected
+        return False
+
+    def signaturematches(self,probename):
+        """
+        return the set of WAFs whose signatures match the response to a probe,
+        None if the probe got no response.  The response is evaluated once
+        """
+        if probename not in self.signaturehits:
+            r = getattr(self,probename)()
+            if r is None:
+                self.signaturehits[probename] = None
+            else:
+                response,responsebody = r
+                self.signaturehits[probename] = self.signatures.evaluate(probename,response)
+        return self.signaturehits[probename]
     
     def issecureiis(self):
         # credit goes to W3AF
@@ -297,9 +933,7 @@ class WafW00F(waftoolsengine):
         response,responsebody = r
         if response.status == 404:
             return
-        headers = dict()
-        headers['Transfer-Encoding'] = 'z' * 1025
-        r = self.normalrequest(headers=headers)
+        r = self.longtransferencoding()
         if r is None:
             return 
         response,responsebody = r         
@@ -307,37 +941,6 @@ class WafW00F(waftoolsengine):
             detected = True
         return detected
     
-    def matchcookie(self,match):
-        """
-        a convenience function which calls matchheader
-        """
-        return self.matchheader(('set-cookie',match))
-    
-    def isairlock(self):
-        # credit goes to W3AF
-        return self.matchcookie('^AL[_-]?(SESS|LB)=')
-    
-    def isbarracuda(self):
-        # credit goes to W3AF
-        return self.matchcookie('^barra_counter_session=')
-    
-    def isdenyall(self):
-        # credit goes to W3AF
-        if self.matchcookie('^sessioncookie='):
-            return True
-        # credit goes to Sebastien Gioria
-        #   Tested against a Rweb 3.8
-        # and modified by sandro gauci and someone else
-        for attack in self.attacks:
-            r = attack(self)
-            if r is None:
-                return
-            response, responsebody = r
-            if response.status == 200:
-                if response.reason == 'Condition Intercepted':
-                    return True
-        return False
-    
     def isbeeware(self):
         # disabled cause it was giving way too many false positives
         # credit goes to Sebastien Gioria
@@ -355,69 +958,14 @@ class WafW00F(waftoolsengine):
                 if response.reason == "Forbidden":
                     detected = True
         return detected
-        
-    def isf5asm(self):
-        # credit goes to W3AF
-        return self.matchcookie('^TS[a-zA-Z0-9]{3,6}=')
-    
-    def isf5trafficshield(self):
-        for hv in [['cookie','^ASINFO='],['server','F5-TrafficShield']]:            
-            r = self.matchheader(hv)
-            if r is None:
-                return
-            elif r:
-                return r
-        return False
-
-    def isteros(self):
-        # credit goes to W3AF
-        return self.matchcookie('^st8id=')
-    
-    def isnetcontinuum(self):
-        # credit goes to W3AF
-        return self.matchcookie('^NCI__SessionId=')
-    
-    def isbinarysec(self):
-        # credit goes to W3AF
-        return self.matchheader(('server','BinarySec'))
-    
-    def ishyperguard(self):
-        # credit goes to W3AF
-        return self.matchcookie('^WODSESSION=')
-    
-    def isprofense(self):
-        """
-        Checks for server headers containing "profense"
-        """
-        return self.matchheader(('server','profense'))
-        
-    def isnetscaler(self):
-        """
-        First checks if a cookie associated with Netscaler is present,
-        if not it will try to find if a "Cneonction" or "nnCoection" is returned
-        for any of the attacks sent
-        """
-        # NSC_ and citrix_ns_id come from David S. Langlands <dsl 'at' surfstar.com>
-        if self.matchcookie('^(ns_af=|citrix_ns_id|NSC_)'):
-            return True    
-        if self.matchheader(('Cneonction','close'),attack=True):
-            return True
-        if self.matchheader(('nnCoection','close'),attack=True):
-            return True
-        return False
     
     def isurlscan(self):
         detected = False
-        testheaders = dict()
-        testheaders['Translate'] = 'z'*10
-        testheaders['If'] = 'z'*10
-        testheaders['Lock-Token'] = 'z'*10
-        testheaders['Transfer-Encoding'] = 'z'*10
         r = self.normalrequest()
         if r is None:
             return
         response,_tmp = r
-        r = self.normalrequest(headers=testheaders)
+        r = self.urlscanheaders()
         if r is None:
             return 
         response2,_tmp = r
@@ -434,8 +982,7 @@ class WafW00F(waftoolsengine):
         response,responsebody=r
         if response.status == 403:
             return detected
-        newpath = self.path + '?nx=@@'
-        r = self.request(path=newpath)
+        r = self.atsignquery()
         if r is None:
             return 
         response,responsebody = r
@@ -443,22 +990,6 @@ class WafW00F(waftoolsengine):
             detected = True
         return detected
     
-    def isdotdefender(self):
-        # thanks to j0e
-        return self.matchheader(['X-dotDefender-denied', '^1$'],attack=True)
-
-    def isimperva(self):
-        # thanks to Mathieu Dessus <mathieu.dessus(a)verizonbusiness.com> for this
-        # might lead to false positives so please report back to sandro@enablesecurity.com
-        for attack in self.attacks:
-            r = attack(self)
-            if r is None:
-                return
-            response, responsebody = r
-            if response.version == 10:
-                return True
-        return False
-    
     def ismodsecuritypositive(self):
         import random
         detected = False
@@ -478,14 +1009,6 @@ class WafW00F(waftoolsengine):
         if response.status == 404:
             detected = True
         return detected
-    
-    def isibmdatapower(self):
-	# Added by Mathieu Dessus <mathieu.dessus(a)verizonbusiness.com> 
-	detected = False
-	if self.matchheader(('X-Backside-Transport', '^(OK|FAIL)')):
-		detected = True
-	return detected
-
 
     def isibm(self):
         detected = False
@@ -495,33 +1018,15 @@ class WafW00F(waftoolsengine):
         return detected
 
 
+    # detections which need more than a signature; the rest are loaded
+    # from the signature file by loadsignatures()
     wafdetections = dict()
-    # easy ones
     wafdetections['IBM Web Application Security'] = isibm
-    wafdetections['IBM DataPower'] = isibmdatapower
-    wafdetections['Profense'] = isprofense
-    wafdetections['ModSecurity'] = ismodsecurity
-    wafdetections['ISA Server'] = isisaserver
-    wafdetections['NetContinuum'] = isnetcontinuum
-    wafdetections['HyperGuard'] = ishyperguard
-    wafdetections['Barracuda'] = isbarracuda
-    wafdetections['Airlock'] = isairlock
-    wafdetections['BinarySec'] = isbinarysec
-    wafdetections['F5 Trafficshield'] = isf5trafficshield
-    wafdetections['F5 ASM'] = isf5asm
-    wafdetections['Teros'] = isteros
-    wafdetections['DenyALL'] = isdenyall
-    wafdetections['BIG-IP'] = isbigip
-    wafdetections['Citrix NetScaler'] = isnetscaler
-    # lil bit more complex
     wafdetections['webApp.secure'] = iswebscurity
-    wafdetections['WebKnight'] = iswebknight    
     wafdetections['URLScan'] = isurlscan
     wafdetections['SecureIIS'] = issecureiis
-    wafdetections['dotDefender'] = isdotdefender
     #wafdetections['BeeWare'] = isbeeware
     # wafdetections['ModSecurity (positive model)'] = ismodsecuritypositive removed for now
-    wafdetections['Imperva'] = isimperva
     wafdetectionsprio = ['Profense','NetContinuum',                         
                          'Barracuda','HyperGuard','BinarySec','Teros',
                          'F5 Trafficshield','F5 ASM','Airlock','Citrix NetScaler',
@@ -529,9 +1034,52 @@ class WafW00F(waftoolsengine):
                          'dotDefender','webApp.secure', # removed for now 'ModSecurity (positive model)',                         
                          'BIG-IP','URLScan','WebKnight',
                          'SecureIIS','Imperva','ISA Server']
+
+    # probes each detection reads; identwaf() sends the union of the probes
+    # of the selected detections once and evaluates them all against it
+    detectionprobes = dict()
+    detectionprobes['IBM Web Application Security'] = [protectedfolder]
+    detectionprobes['webApp.secure'] = [normalrequest,atsignquery]
+    detectionprobes['URLScan'] = [normalrequest,urlscanheaders]
+    detectionprobes['SecureIIS'] = [normalrequest,longtransferencoding]
+
+    # declarative signatures, "attacks" standing for every attack probe
+    signatures = SignatureSet(aliases=dict(attacks=[probe.__name__ for probe in attacks]))
+
+    def loadsignatures(cls,filename):
+        """
+        return the Detections of the class with the WAFs a signature file
+        describes added; the class itself is left as it is.  WAFs missing
+        from wafdetectionsprio are checked last, in file order.
+        Raises ValueError if a signature is malformed or reads a probe
+        which does not exist, IOError if the file cannot be read
+        """
+        signatures = cls.signatures.copy()
+        signatures.load(filename)
+        wafdetections = dict(cls.wafdetections)
+        wafdetectionsprio = list(cls.wafdetectionsprio)
+        detectionprobes = dict(cls.detectionprobes)
+        for wafvendor in signatures.wafvendors:
+            probes = list()
+            for probename in signatures.probes(wafvendor):
+                probe = cls.__dict__.get(probename)
+                if not callable(probe):
+                    raise ValueError('the signature of %s reads an unknown probe: %s' % (wafvendor,probename))
+                probes.append(probe)
+            wafdetections[wafvendor] = signaturedetection(wafvendor)
+            detectionprobes[wafvendor] = probes
+            if wafvendor not in wafdetectionsprio:
+                wafdetectionsprio.append(wafvendor)
+        return Detections(wafdetections,wafdetectionsprio,detectionprobes,signatures,
+                          cls.freshprobes | signatures.freshprobes())
+    loadsignatures = classmethod(loadsignatures)
     
     def identwaf(self,findall=False):
         detected = list()
+        # with findall every detection runs, so the whole plan is needed anyway;
+        # otherwise only send it ahead of time when it can go out concurrently
+        if findall or self.engine is not None:
+            self.runplan(self.planprobes(self.wafdetectionsprio))
         for wafvendor in self.wafdetectionsprio:
             self.log.info('Checking for %s' % wafvendor)
             if self.wafdetections[wafvendor](self):
@@ -541,6 +1089,8 @@ class WafW00F(waftoolsengine):
         self.knowledge['wafname'] = detected
         return detected
 
+WafW00F.loadsignatures(signaturefile).apply(WafW00F)
+
 def calclogginglevel(verbosity):
     default = 40 # errors are printed out
     level = default - (verbosity*10)
@@ -548,77 +1098,453 @@ def calclogginglevel(verbosity):
         level = 0
     return level
 
+class DetectorCache:
+    """
+    The WafW00F instances of the urls an RPC server was asked about, so that
+    asking again reuses what was learnt.  Holds at most maxsize urls, the
+    least recently used being evicted first, and forgets an instance ttl
+    seconds after it was created.  Every entry comes with a lock, held while
+    its instance is in use, as an instance is not meant to run two
+    identifications at once.
+    """
+
+    def __init__(self,maxsize=DEFAULT_API_CACHE_SIZE,ttl=DEFAULT_API_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # url -> (created, wafw00f, lock), least recently used first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self,url,create):
+        """
+        return (wafw00f, lock) for url, calling create() for a new instance
+        when there is none or it has expired.  create() may return None (e.g.
+        for an url which is not well formed), which is returned as is
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(url,None)
+            if entry is not None and entry[0] < now - self.ttl:
+                entry = None
+            if entry is None:
+                wafw00f = create()
+                if wafw00f is None:
+                    return None,None
+                entry = (now,wafw00f,threading.Lock())
+            self.entries[url] = entry
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return entry[1],entry[2]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class BatchCancelled(Exception):
+    pass
+
+
+class ScanBatch:
+    """
+    The urls of one submit() call to wafwoof_api, and their results as they
+    come in, until they are polled.  Doubles as the cancellation token of
+    the batch's WafW00F instances
+    """
+
+    def __init__(self,batchid,total):
+        self.batchid = batchid
+        self.total = total
+        self.finished = 0
+        # results not polled yet
+        self.results = collections.deque()
+        self.futures = list()
+        self.iscancelled = False
+        self.touched = time.time()
+        self.cond = threading.Condition()
+
+    def add(self,result):
+        with self.cond:
+            self.results.append(result)
+            self.finished += 1
+            self.cond.notify_all()
+
+    def complete(self):
+        return self.finished >= self.total
+
+    def take(self,wait,maxresults):
+        """
+        return up to maxresults results (0 for all of them), waiting up to
+        wait seconds for the first one if none is there
+        """
+        with self.cond:
+            self.touched = time.time()
+            deadline = time.time() + wait
+            while not self.results and not self.complete() and not self.iscancelled:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            count = len(self.results)
+            if maxresults > 0:
+                count = min(count,maxresults)
+            return [self.results.popleft() for i in range(count)]
+
+    def cancel(self):
+        with self.cond:
+            self.iscancelled = True
+            self.cond.notify_all()
+        for future in self.futures:
+            future.cancel()
+
+    def cancelled(self):
+        return self.iscancelled
+
+    def check(self):
+        if self.iscancelled:
+            raise BatchCancelled('batch %s was cancelled' % self.batchid)
+
+
 class wafwoof_api:
-    def __init__(self):
-        self.cache = dict()
-        
-    def vendordetect(self,url,findall=False):            
-        if self.cache.has_key(url):
-            wafw00f = self.cache[url]
-        else:
-            r = oururlparse(url)
-            if r is None:
-                return ['']
-            (hostname,port,path,query,ssl) = r
-            wafw00f = WafW00F(target=hostname,port=port,path=path,ssl=ssl)
-            self.cache[url] = wafw00f
-        return wafw00f.identwaf(findall=findall)
-    
-    def genericdetect(self,url):            
-        if self.cache.has_key(url):
-            wafw00f = self.cache[url]
-        else:
+    """
+    The calls offered by the XML-RPC interface.  vendordetect, genericdetect
+    and alltests look at one url and answer when done; submit queues any
+    number of urls for identification on a pool of workers and returns at
+    once, the results being collected with poll as they finish.
+    """
+
+    # the methods served over XML-RPC
+    rpcmethods = ('vendordetect','genericdetect','alltests','submit','poll','cancel','batches_pending')
+
+    def __init__(self,responsecache=None,workers=DEFAULT_BULK_WORKERS,
+                 concurrency=DEFAULT_PROBE_WORKERS,cachesize=DEFAULT_API_CACHE_SIZE,
+                 cachettl=DEFAULT_API_CACHE_TTL,maxqueued=DEFAULT_API_MAX_QUEUED,
+                 batchttl=DEFAULT_BATCH_TTL,detections=None):
+        """
+        workers: number of urls of submitted batches identified at once
+        concurrency: number of probes kept in flight at once, see ProbeEngine
+        cachesize, cachettl: bound the WafW00F instances kept, see DetectorCache
+        maxqueued: most urls waiting to be identified, across batches
+        batchttl: seconds after which a batch nobody polls is dropped
+        detections: the Detections to run, see WafW00F.loadsignatures
+        """
+        self.detections = detections
+        self.cache = DetectorCache(cachesize,cachettl)
+        self.engine = ProbeEngine(concurrency)
+        self.responsecache = responsecache
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.maxqueued = maxqueued
+        self.batchttl = batchttl
+        self.batches = dict()
+        self.batchids = itertools.count(1)
+        self.queued = 0
+        self.lock = threading.Lock()
+
+    def _detector(self,url):
+        def create():
             r = oururlparse(url)
             if r is None:
-                return {}
+                return None
             (hostname,port,path,query,ssl) = r
-            wafw00f = WafW00F(target=hostname,port=port,path=path,ssl=ssl)
-            self.cache[url] = wafw00f
-        wafw00f.genericdetect()
-        return wafw00f.knowledge['generic']
-        
+            return WafW00F(target=hostname,port=port,path=path,ssl=ssl,engine=self.engine,
+                           responsecache=self.responsecache,detections=self.detections)
+        return self.cache.get(url,create)
+
+    def vendordetect(self,url,findall=False):
+        wafw00f,lock = self._detector(url)
+        if wafw00f is None:
+            return ['']
+        with lock:
+            return wafw00f.identwaf(findall=findall)
+
+    def genericdetect(self,url):
+        wafw00f,lock = self._detector(url)
+        if wafw00f is None:
+            return {}
+        with lock:
+            wafw00f.genericdetect()
+            return wafw00f.knowledge['generic']
+
     def alltests(self,url,findall=False):
-        if self.cache.has_key(url):
-            wafw00f = self.cache[url]
-        else:
-            r = oururlparse(url)
-            if r is None:
-                return {}
-            (hostname,port,path,query,ssl)  = r
-            wafw00f = WafW00F(target=hostname,port=port,path=path,ssl=ssl)
-            self.cache[url] = wafw00f
+        wafw00f,lock = self._detector(url)
+        if wafw00f is None:
+            return {}
+        with lock:
+            return self._alltests(wafw00f,findall)
+
+    def _alltests(self,wafw00f,findall):
         wafw00f.identwaf(findall=findall)
         if (len(wafw00f.knowledge['wafname']) == 0) or (findall):
             wafw00f.genericdetect()
         return wafw00f.knowledge
 
+    def submit(self,urls,findall=False):
+        """
+        queue urls for identification and return the batch's id, to pass to
+        poll.  Raises ValueError if that would queue more than maxqueued urls
+        """
+        self._expire()
+        with self.lock:
+            if self.queued + len(urls) > self.maxqueued:
+                raise ValueError('%d urls are queued already, at most %d can be' % (self.queued,self.maxqueued))
+            self.queued += len(urls)
+            batch = ScanBatch(str(next(self.batchids)),len(urls))
+            self.batches[batch.batchid] = batch
+        for url in urls:
+            future = self.executor.submit(self._scan,batch,url,findall)
+            future.add_done_callback(self._done)
+            batch.futures.append(future)
+        return batch.batchid
+
+    def _scan(self,batch,url,findall):
+        # one url of a batch: its record, as scantarget() would make it
+        started = time.time()
+        record = dict(target=url)
+        try:
+            batch.check()
+            wafw00f,lock = self._detector(fixurl(url))
+            if wafw00f is None:
+                record['error'] = 'The url is not well formed'
+            else:
+                with lock:
+                    wafw00f.token = batch
+                    try:
+                        # a copy, which later calls on the same url cannot change
+                        record['knowledge'] = copy.deepcopy(self._alltests(wafw00f,findall))
+                    finally:
+                        wafw00f.token = None
+        except Exception as e:
+            record['error'] = str(e)
+        record['elapsed'] = round(time.time() - started,3)
+        batch.add(record)
 
+    def _done(self,future):
+        with self.lock:
+            self.queued -= 1
 
+    def poll(self,batchid,wait=0,maxresults=0):
+        """
+        return the results of a batch which came in since the last poll, as a
+        dict: results (the records, see scantarget), finished and total (the
+        number of urls done and submitted) and complete.  If there are none
+        yet, waits up to wait seconds (at most MAX_POLL_WAIT) for the first
+        one.  maxresults caps the results returned, 0 returns them all.
+        A batch is forgotten once its last result has been polled
+        """
+        batch = self._batch(batchid)
+        results = batch.take(min(max(wait,0),MAX_POLL_WAIT),maxresults)
+        with batch.cond:
+            complete = batch.complete() and not batch.results
+            answer = dict(batch=batchid,results=results,finished=batch.finished,
+                          total=batch.total,complete=complete)
+        if complete:
+            with self.lock:
+                self.batches.pop(batchid,None)
+        return answer
 
-def xmlrpc_interface(bindaddr=('localhost',8001)):
-    from SimpleXMLRPCServer import SimpleXMLRPCServer
-    from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
-    
-    class RequestHandler(SimpleXMLRPCRequestHandler):
-        rpc_paths = ('/RPC2',)
-    
-        
-    server = SimpleXMLRPCServer(bindaddr,
-                            requestHandler=RequestHandler)
-    server.register_introspection_functions()
-    server.register_instance(wafwoof_api())
+    def cancel(self,batchid):
+        """
+        stop a batch: urls not started are dropped and those being identified
+        stop at their next request.  Returns True
+        """
+        batch = self._batch(batchid)
+        batch.cancel()
+        with self.lock:
+            self.batches.pop(batchid,None)
+        return True
+
+    def batches_pending(self):
+        """
+        return the ids of the batches which have not been polled to the end
+        """
+        with self.lock:
+            return sorted(self.batches.keys())
+
+    def _batch(self,batchid):
+        with self.lock:
+            batch = self.batches.get(batchid)
+        if batch is None:
+            raise ValueError('no batch %s' % batchid)
+        return batch
+
+    def _expire(self):
+        # cancel the batches nobody has polled for batchttl seconds
+        cutoff = time.time() - self.batchttl
+        with self.lock:
+            expired = [batch for batch in self.batches.values() if batch.touched < cutoff]
+            for batch in expired:
+                del self.batches[batch.batchid]
+        for batch in expired:
+            batch.cancel()
+
+    def shutdown(self):
+        for batchid in self.batches_pending():
+            self.cancel(batchid)
+        self.executor.shutdown(wait=True)
+        self.engine.shutdown()
+
+
+def fixurl(target):
+    if not (target.startswith('http://') or target.startswith('https://')):
+        logging.getLogger('wafw00f').info('The url %s should start with http:// or https:// .. fixing (might make this unusable)' % target)
+        target = 'http://' + target
+    return target
+
+def scantarget(target,findall=False,**options):
+    """
+    run a complete identification of one url and return it as a record:
+    the url, wafw00f's knowledge, the number of requests sent and the time
+    it took, or an error.  Never raises, so that a bulk scan carries on,
+    unless the scan's cancellation token stops it.
+    options are passed on to WafW00F
+    """
+    started = time.time()
+    record = dict(target=target)
+    try:
+        pret = oururlparse(fixurl(target))
+        if pret is None:
+            record['error'] = 'The url is not well formed'
+        else:
+            (hostname,port,path,query,ssl) = pret
+            attacker = WafW00F(hostname,port=port,ssl=ssl,path=path,**options)
+            if attacker.normalrequest() is None:
+                record['error'] = 'Site appears to be down'
+            else:
+                waf = attacker.identwaf(findall)
+                if findall or len(waf) == 0:
+                    attacker.genericdetect()
+                record['knowledge'] = attacker.knowledge
+            record['requests'] = attacker.requestnumber
+    except Exception as e:
+        token = options.get('token')
+        if token is not None and token.cancelled():
+            raise
+        record['error'] = str(e)
+    record['elapsed'] = round(time.time() - started,3)
+    return record
+
+def scantargets(targets,workers=DEFAULT_BULK_WORKERS,**kwargs):
+    """
+    identify every url read from the targets iterable, workers hosts at a
+    time, yielding each host's record (see scantarget) as soon as it is done.
+    Targets are read lazily, so the list can be of any size.
+    Requests go out with the 'bulk' priority unless kwargs set another one
+    """
+    kwargs.setdefault('priority','bulk')
+    token = kwargs.get('token')
+    executor = concurrent.futures.ThreadPoolExecutor(workers)
+    pending = set()
+    try:
+        for target in targets:
+            if token is not None:
+                token.check()
+            target = target.strip()
+            if not target or target.startswith('#'):
+                continue
+            pending.add(executor.submit(scantarget,target,**kwargs))
+            if len(pending) >= workers * 2:
+                done,pending = concurrent.futures.wait(pending,return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=True)
+
+def bulkscan(targets,output,workers=DEFAULT_BULK_WORKERS,**kwargs):
+    """
+    identify every url read from the targets iterable (see scantargets),
+    writing each host's record to output as one JSON line as soon as it is
+    done.  Returns the number of hosts which could not be identified
+    """
+    failed = 0
+    for record in scantargets(targets,workers,**kwargs):
+        if 'error' in record:
+            failed += 1
+        output.write(json.dumps(record,sort_keys=True) + '\n')
+        output.flush()
+    return failed
+
+
+def xmlrpc_interface(bindaddr=('localhost',8001),handlers=DEFAULT_RPC_HANDLERS,**apioptions):
+    """
+    serve wafwoof_api over XML-RPC until interrupted.  Up to handlers calls
+    are served at once, each on a thread of a pool; further connections wait
+    to be accepted.  A poll waiting for results holds its thread, so that
+    handlers should exceed the number of clients polling at once.
+    apioptions are passed on to wafwoof_api
+    """
+    api = wafwoof_api(**apioptions)
+    server = rpcserver(bindaddr,api,handlers)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print "bye!"
-        return
+    finally:
+        server.server_close()
+        api.shutdown()
 
+def rpcserver(bindaddr,api,handlers=DEFAULT_RPC_HANDLERS):
+    """
+    return an XML-RPC server of api's calls bound to bindaddr, serving up to
+    handlers calls at once (see xmlrpc_interface), with system.multicall
+    """
+    from SimpleXMLRPCServer import SimpleXMLRPCServer
+    from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
 
+    class RequestHandler(SimpleXMLRPCRequestHandler):
+        rpc_paths = ('/RPC2',)
+        # answers go out in one write rather than one per header line
+        wbufsize = -1
 
+    class PooledXMLRPCServer(SimpleXMLRPCServer):
+        request_queue_size = 128
 
-def main():
-    print lackofart
-    parser = OptionParser(usage="""%prog url1 [url2 [url3 ... ]]\r\nexample: %prog http://www.victim.org/""")
+        def __init__(self,*args,**kwargs):
+            SimpleXMLRPCServer.__init__(self,*args,**kwargs)
+            self.executor = concurrent.futures.ThreadPoolExecutor(handlers)
+            # taken for each call being served, so that accept() waits
+            # while every handler is busy
+            self.slots = threading.BoundedSemaphore(handlers)
+
+        def process_request(self,request,client_address):
+            self.slots.acquire()
+            self.executor.submit(self.process_request_thread,request,client_address)
+
+        def process_request_thread(self,request,client_address):
+            try:
+                self.finish_request(request,client_address)
+            except Exception:
+                self.handle_error(request,client_address)
+            finally:
+                self.shutdown_request(request)
+                self.slots.release()
+
+        def server_close(self):
+            SimpleXMLRPCServer.server_close(self)
+            self.executor.shutdown(wait=False)
+
+    server = PooledXMLRPCServer(bindaddr,requestHandler=RequestHandler,
+                                logRequests=False,allow_none=True)
+    server.register_introspection_functions()
+    server.register_multicall_functions()
+    for name in api.rpcmethods:
+        server.register_function(getattr(api,name),name)
+    return server
+
+
+def main(argv=None,token=None,scheduler=None,priority='interactive',metrics=None):
+    """
+    argv: the command-line arguments, defaults to sys.argv[1:]
+    token: a cancellation token stopping the scan once cancelled, see WafW00F
+    scheduler, priority: pace the requests sent, see WafW00F.  Bulk scans
+    always use the 'bulk' priority
+    metrics: a registry recording the probes' latencies, see WafW00F
+    """
+    parser = OptionParser(usage="""%prog url1 [url2 [url3 ... ]]\r\nexample: %prog http://www.victim.org/\r\n       %prog --bulk targets.txt""")
     parser.add_option('-v','--verbose',action='count', dest='verbose', default=0,
                       help="enable verbosity - multiple -v options increase verbosity")
     parser.add_option('-a','--findall',action='store_true', dest='findall', default=False,
@@ -633,66 +1559,128 @@ def main():
                       default=False,help='Switch on the XML-RPC interface instead of CUI')
     parser.add_option('--xmlrpcport',dest='xmlrpcport', type='int',
                       default=8001,help='Specify an alternative port to listen on, default 8001')
+    parser.add_option('--xmlrpchandlers',dest='xmlrpchandlers', type='int',
+                      default=DEFAULT_RPC_HANDLERS,help='Number of XML-RPC calls served at once, default %d' % DEFAULT_RPC_HANDLERS)
+    parser.add_option('--signatures',dest='signatures',
+                      help='Load additional WAF signatures from a JSON signature file')
+    parser.add_option('-c','--concurrency',dest='concurrency', type='int',
+                      default=DEFAULT_PROBE_WORKERS,help='Number of probes kept in flight at once, 1 sends them one at a time')
+    parser.add_option('--cache',dest='cache',
+                      help='Keep responses in this cache file and answer repeated requests from it')
+    parser.add_option('--cachettl',dest='cachettl', type='int',
+                      default=DEFAULT_CACHE_TTL,help='Seconds a cached response stays valid, default %d' % DEFAULT_CACHE_TTL)
+    parser.add_option('--failurettl',dest='failurettl', type='int',
+                      default=DEFAULT_FAILURE_TTL,help='Seconds the cache remembers a request which got no response, 0 not to, default %d' % DEFAULT_FAILURE_TTL)
+    parser.add_option('--refresh',dest='refresh', action='store_true',
+                      default=False,help='Send every request even if it is cached, and update the cache')
+    parser.add_option('-b','--bulk',dest='bulk',
+                      help='Read urls from a file, one per line ("-" for standard input), and write one JSON line per host')
+    parser.add_option('-w','--workers',dest='workers', type='int',
+                      default=DEFAULT_BULK_WORKERS,help='Number of hosts identified at once in bulk mode and in XML-RPC batches')
     parser.add_option('--version','-V',dest='version', action='store_true',
                       default=False,help='Print out the version')
-    options,args = parser.parse_args()
+    options,args = parser.parse_args(argv)
+    if not options.bulk:
+        print lackofart
     logging.basicConfig(level=calclogginglevel(options.verbose))
     log = logging.getLogger()
+    detections = None
+    if options.signatures:
+        try:
+            detections = WafW00F.loadsignatures(os.path.join(currentDir,options.signatures))
+        except (IOError,ValueError) as e:
+            parser.error('cannot load the signatures of %s: %s' % (options.signatures,e))
     if options.list:
         print "Can test for these WAFs:\r\n"
-        attacker = WafW00F(None)        
+        attacker = WafW00F(None,detections=detections)
         print '\r\n'.join(attacker.wafdetectionsprio)
         return
     if options.version:
         print 'WAFW00F version %s' % __version__
         return
-    elif options.xmlrpc:
-        print "Starting XML-RPC interface"
-        xmlrpc_interface(bindaddr=('localhost',options.xmlrpcport))
-        return
-    if len(args) == 0:
-        parser.error("we need a target site")
-    targets = args
-    for target in targets:
-        if not (target.startswith('http://') or target.startswith('https://')):
-            log.info('The url %s should start with http:// or https:// .. fixing (might make this unusable)' % target)
-            target = 'http://' + target
-        print "Checking %s" % target
-        pret = oururlparse(target)
-        if pret is None:
-            log.critical('The url %s is not well formed' % target)
-            sys.exit(1)
-        (hostname,port,path,query,ssl) = pret
-        log.info('starting wafw00f on %s' % target)
-        attacker = WafW00F(hostname,port=port,ssl=ssl,
-                           debuglevel=options.verbose,path=path,
-                           followredirect=options.followredirect)
-        if attacker.normalrequest() is None:
-            log.error('Site %s appears to be down' % target)
-            sys.exit(1)
-        if options.test:
-            if attacker.wafdetections.has_key(options.test):
-                waf = attacker.wafdetections[options.test](attacker)
-                if waf:
-                    print "The site %s is behind a %s" % (target, options.test)
-                else:
-                    print "WAF %s was not detected on %s" % (options.test,target)
-            else:
-                print "WAF %s was not found in our list\r\nUse the --list option to see what is available" % options.test
+    engine = None
+    if options.concurrency > 1:
+        engine = sharedengine(options.concurrency)
+    responsecache = None
+    if options.cache:
+        responsecache = ResponseCache(os.path.join(currentDir,options.cache),ttl=options.cachettl,
+                                      failurettl=options.failurettl)
+    try:
+        if options.xmlrpc:
+            print "Starting XML-RPC interface"
+            xmlrpc_interface(bindaddr=('localhost',options.xmlrpcport),handlers=options.xmlrpchandlers,
+                             responsecache=responsecache,workers=options.workers,
+                             concurrency=options.concurrency,detections=detections)
             return
-        waf = attacker.identwaf(options.findall)
-        log.info('Ident WAF: %s' % waf)
-        if len(waf) > 0:
-            print 'The site %s is behind a %s' % (target, ' and/or '.join( waf))
-        if (options.findall) or len(waf) == 0:
-            print 'Generic Detection results:'          
-            if attacker.genericdetect():                
-                log.info('Generic Detection: %s' % attacker.knowledge['generic']['reason'])                    
-                print 'The site %s seems to be behind a WAF ' % target
-                print 'Reason: %s' % attacker.knowledge['generic']['reason']
+        if options.bulk:
+            if options.bulk == '-':
+                targetfile = sys.stdin
             else:
-                print 'No WAF detected by the generic detection'
-        print 'Number of requests: %s' % attacker.requestnumber
+                targetfile = open(os.path.join(currentDir,options.bulk))
+            failed = bulkscan(targetfile,sys.stdout,workers=options.workers,
+                              findall=options.findall,followredirect=options.followredirect,
+                              debuglevel=options.verbose,engine=engine,
+                              responsecache=responsecache,refresh=options.refresh,
+                              token=token,scheduler=scheduler,metrics=metrics,
+                              detections=detections)
+            if failed:
+                sys.exit(1)
+            return
+        if len(args) == 0:
+            parser.error("we need a target site")
+        targets = args
+        failed = False
+        for target in targets:
+            target = fixurl(target)
+            print "Checking %s" % target
+            pret = oururlparse(target)
+            if pret is None:
+                log.critical('The url %s is not well formed' % target)
+                failed = True
+                continue
+            (hostname,port,path,query,ssl) = pret
+            log.info('starting wafw00f on %s' % target)
+            attacker = WafW00F(hostname,port=port,ssl=ssl,
+                               debuglevel=options.verbose,path=path,
+                               followredirect=options.followredirect,engine=engine,
+                               responsecache=responsecache,refresh=options.refresh,
+                               token=token,scheduler=scheduler,priority=priority,
+                               metrics=metrics,detections=detections)
+            if attacker.normalrequest() is None:
+                log.error('Site %s appears to be down' % target)
+                failed = True
+                continue
+            if options.test:
+                if attacker.wafdetections.has_key(options.test):
+                    waf = attacker.wafdetections[options.test](attacker)
+                    if waf:
+                        print "The site %s is behind a %s" % (target, options.test)
+                    else:
+                        print "WAF %s was not detected on %s" % (options.test,target)
+                else:
+                    print "WAF %s was not found in our list\r\nUse the --list option to see what is available" % options.test
+                return
+            waf = attacker.identwaf(options.findall)
+            log.info('Ident WAF: %s' % waf)
+            if len(waf) > 0:
+                print 'The site %s is behind a %s' % (target, ' and/or '.join( waf))
+            if (options.findall) or len(waf) == 0:
+                print 'Generic Detection results:'          
+                if attacker.genericdetect():                
+                    log.info('Generic Detection: %s' % attacker.knowledge['generic']['reason'])                    
+                    print 'The site %s seems to be behind a WAF ' % target
+                    print 'Reason: %s' % attacker.knowledge['generic']['reason']
+                else:
+                    print 'No WAF detected by the generic detection'
+            print 'Number of requests: %s' % attacker.requestnumber
+            if responsecache is not None:
+                print 'Number of cached responses used: %s' % attacker.cachehits
+        if failed:
+            sys.exit(1)
+    finally:
+        if responsecache is not None:
+            responsecache.close()
+
 
 if __name__ == '__main__':
     if sys.hexversion < 0x2040000:
@@ -0,0 +1,145 @@
+# ---------------------------------------------------
+# profiling.py:  CPU and memory profiles of Bywaf commands
+# ---------------------------------------------------
+
+import time
+import threading
+
+try:
+    from StringIO import StringIO
+except ImportError: # python 3
+    from io import StringIO
+
+from metrics import cpu_time
+
+# default order of the hotspot report, and number of functions and of
+# allocation sites it lists
+DEFAULT_SORT = 'cumulative'
+DEFAULT_LINES = 30
+
+# one command is profiled at a time: tracemalloc traces the whole process,
+# and on recent Pythons so does cProfile
+_lock = threading.Lock()
+
+
+class ProfileReport(object):
+    """What profile_call() found out about a command: its wall-clock and CPU
+    time, its hotspots and, if its memory was traced, its peak allocation
+    and the allocation sites still holding memory when it returned.  Its
+    text is the report; the command's own return value is kept in result"""
+
+    def __init__(self, command_line):
+        self.command_line = command_line
+        self.result = None
+        self.error = None
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.hotspots = ''
+        self.memory = None
+
+    def __str__(self):
+        lines = ['profile of "{}":  {:.3f} s wall clock, {:.3f} s CPU'.format(self.command_line, self.wall, self.cpu)]
+        if self.error is not None:
+            lines.append('the command failed: {}'.format(self.error))
+        lines.append(self.hotspots.rstrip())
+        if self.memory is not None:
+            lines.append('')
+            lines.append(self.memory.rstrip())
+        if self.result is not None:
+            lines.append('')
+            lines.append('result: {}'.format(self.result))
+        return '\n'.join(lines)
+
+
+class ProfileError(Exception):
+    """raised by profile_call() when the profiled command raised; carries
+    the report of the run, which its text includes"""
+
+    def __init__(self, report):
+        Exception.__init__(self, str(report))
+        self.report = report
+
+
+def memory_tracing():
+    """return the tracemalloc module, None where it does not exist (python 2)"""
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    return tracemalloc
+
+
+def sort_keys():
+    """return the orders the hotspot report can be sorted in"""
+    import pstats
+    return sorted(pstats.Stats.sort_arg_dict_default.keys())
+
+
+def profile_call(func, command_line, memory=False, sort=DEFAULT_SORT, lines=DEFAULT_LINES):
+    """call func() under cProfile, and under tracemalloc too if memory is
+    set, and return its ProfileReport.  Only the calling thread is profiled,
+    while memory is traced in every thread.  Raises ValueError if another
+    command is being profiled or memory cannot be traced, and ProfileError
+    if func raised"""
+    import cProfile
+    import pstats
+    tracemalloc = memory_tracing() if memory else None
+    if memory and tracemalloc is None:
+        raise ValueError('tracing memory needs tracemalloc (Python 3.4 or later)')
+    if not _lock.acquire(False):
+        raise ValueError('another command is being profiled')
+    try:
+        report = ProfileReport(command_line)
+        profiler = cProfile.Profile()
+        # memory may be traced already, e.g. with PYTHONTRACEMALLOC set
+        traced = tracemalloc is not None and tracemalloc.is_tracing()
+        if tracemalloc is not None and not traced:
+            tracemalloc.start()
+        started, cpu_started = time.time(), cpu_time()
+        try:
+            report.result = profiler.runcall(func)
+        except Exception as e:
+            report.error = '{}: {}'.format(type(e).__name__, e)
+        report.wall = time.time() - started
+        report.cpu = cpu_time() - cpu_started
+        if tracemalloc is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            if not traced:
+                tracemalloc.stop()
+            report.memory = _memory_report(tracemalloc, snapshot, current, peak, lines)
+    finally:
+        _lock.release()
+
+    out = StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.strip_dirs().sort_stats(sort).print_stats(lines)
+    report.hotspots = out.getvalue()
+    if report.error is not None:
+        raise ProfileError(report)
+    return report
+
+
+def _memory_report(tracemalloc, snapshot, current, peak, lines):
+    # peak and remaining allocation, and where what remains was allocated
+    # (leaving out what profiling itself allocated)
+    import cProfile
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                       tracemalloc.Filter(False, cProfile.__file__),
+                                       tracemalloc.Filter(False, __file__),
+                                       tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')])
+    text = ['memory:  {} peak, {} still allocated when the command returned, by:'.format(
+        _size(peak), _size(current))]
+    for statistic in snapshot.statistics('lineno')[:lines]:
+        frame = statistic.traceback[0]
+        text.append('  {:>10}  {:>8} blocks  {}:{}'.format(_size(statistic.size), statistic.count,
+                                                          frame.filename, frame.lineno))
+    return '\n'.join(text)
+
+
+def _size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{} B'.format(size)
+        size /= 1024.0
+    return '{:.1f} GB'.format(size)
@@ -0,0 +1,327 @@
+# ---------------------------------------------------
+# scheduler.py:  pacing of the probes Bywaf's jobs send
+# ---------------------------------------------------
+
+import time
+import heapq
+import itertools
+import threading
+
+# priority classes: interactive probes are always served before bulk ones
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+PRIORITIES = (INTERACTIVE, BULK)
+_RANKS = dict((priority, rank) for rank, priority in enumerate(PRIORITIES))
+
+# default pacing: requests per second and burst size per target host, and
+# requests per second overall (0 means no cap)
+DEFAULT_HOST_RATE = 10
+DEFAULT_HOST_BURST = 10
+DEFAULT_GLOBAL_RATE = 200
+
+# longest a waiting probe sleeps before it looks at its cancellation token again
+MAX_WAIT_SLICE = 0.5
+
+# idle host buckets are pruned once there are this many of them
+MAX_IDLE_BUCKETS = 1024
+
+
+class TokenBucket(object):
+    """rate tokens per second, up to burst of them saved up.  A rate of 0
+    (or None) means no limit"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def ready(self, now):
+        self.refill(now)
+        return not self.rate or self.tokens >= 1
+
+    def delay(self, now):
+        """seconds until a token is available"""
+        self.refill(now)
+        if not self.rate or self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / float(self.rate)
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+
+    def full(self, now):
+        self.refill(now)
+        return not self.rate or self.tokens >= self.burst
+
+
+class ProbeStats(object):
+    """probes a job has waiting, probes it sent and the time they waited"""
+
+    def __init__(self):
+        self.waiting = 0
+        self.sent = 0
+        self.wait_total = 0.0
+
+    def average_wait(self):
+        if not self.sent:
+            return 0.0
+        return self.wait_total / self.sent
+
+
+class _Ticket(object):
+    def __init__(self, host, job, priority, turn, cond):
+        self.host = host
+        self.job = job
+        self.priority = priority
+        self.turn = turn
+        self.queued = time.time()
+        self.granted = False
+        self.cancelled = False
+        # the waiter's own condition: only the waiter granted is woken
+        self.cond = cond
+
+
+class ProbeScheduler(object):
+    """Paces the probes of every job.  A probe calls acquire() before it goes
+    out, which blocks until:
+      - the target host's token bucket (host_rate per second, host_burst at
+        once) and the global one (global_rate per second) both have a token
+      - no probe of a higher priority class could go out instead
+      - every other job with probes waiting in the same class had its turn:
+        jobs are served round-robin, so one big scan cannot crowd out others
+    A probe waiting on a busy host never holds up probes to other hosts.
+
+    Waiting probes are kept in heaps, so that granting one costs a few heap
+    operations however many are waiting: each host's probes in a heap
+    ordered by priority class, then turn; the hosts which have a token in a
+    heap of their first probe; the hosts which have none in a heap of the
+    time they get one.  A dispatcher thread grants probes as tokens come.
+
+    Jobs are identified by any hashable key, e.g. their cancellation token."""
+
+    def __init__(self, host_rate=DEFAULT_HOST_RATE, host_burst=DEFAULT_HOST_BURST,
+                 global_rate=DEFAULT_GLOBAL_RATE):
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.buckets = {}
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+
+        # waiting probes, by host: heaps of (rank, turn, arrival, ticket)
+        self.waiting = {}
+        # (rank, turn, arrival, host) of the first probe of hosts which had a
+        # token when last looked at; entries no longer first are skipped
+        self.ready = []
+        # (time, host) at which hosts without a token get one, and that
+        # time by host for the hosts in the heap
+        self.delayed = []
+        self.delayed_until = {}
+
+        # jobs take turns: a job's probe comes one turn after its previous
+        # one, or after the last probe granted if that is later
+        self.turns = {}
+        self.turn = 0
+        self.arrivals = itertools.count()
+
+        # statistics, overall and by job
+        self.total = ProbeStats()
+        self.stats = {}
+
+        self.lock = threading.Lock()
+        # wakes the dispatcher up when the next token may come sooner
+        self.wakeup = threading.Condition(self.lock)
+        self.dispatcher = None
+
+    def configure(self, host_rate=None, host_burst=None, global_rate=None):
+        """change the pacing; takes effect immediately"""
+        with self.lock:
+            if host_rate is not None:
+                self.host_rate = host_rate
+            if host_burst is not None:
+                self.host_burst = host_burst
+            if host_rate is not None or host_burst is not None:
+                for bucket in self.buckets.values():
+                    bucket.rate = self.host_rate
+                    bucket.burst = max(self.host_burst, 1)
+                # hosts waiting for a token may have one now
+                for host in list(self.delayed_until):
+                    del self.delayed_until[host]
+                    self._make_ready(host, time.time())
+            if global_rate is not None:
+                self.global_bucket.rate = global_rate
+                self.global_bucket.burst = max(global_rate, 1)
+            self._dispatch()
+            self.wakeup.notify()
+
+    def acquire(self, host, job=None, priority=INTERACTIVE, token=None):
+        """wait until a probe to host may be sent.  token is a cancellation
+        token, checked while waiting.  Returns the seconds waited"""
+        if token is not None:
+            token.check()
+        if priority not in _RANKS:
+            priority = INTERACTIVE
+        with self.lock:
+            turn = max(self.turns.get(job, self.turn), self.turn) + 1
+            self.turns[job] = turn
+            ticket = _Ticket(host, job, priority, turn, threading.Condition(self.lock))
+            self._job_stats(job).waiting += 1
+            self.total.waiting += 1
+            try:
+                self._enqueue((_RANKS[priority], turn, next(self.arrivals), ticket))
+                self._dispatch()
+                if not ticket.granted:
+                    self._start_dispatcher()
+                    self.wakeup.notify()
+                while not ticket.granted:
+                    if token is not None:
+                        token.check()
+                    ticket.cond.wait(MAX_WAIT_SLICE)
+                return time.time() - ticket.queued
+            finally:
+                if not ticket.granted:
+                    self._cancel(ticket)
+
+    def job_stats(self, job):
+        """return the ProbeStats of a job, None if it never sent a probe"""
+        with self.lock:
+            return self.stats.get(job)
+
+    def forget(self, job):
+        """drop and return the ProbeStats of a job which is over"""
+        with self.lock:
+            return self.stats.pop(job, None)
+
+    def _job_stats(self, job):
+        stats = self.stats.get(job)
+        if stats is None:
+            stats = self.stats[job] = ProbeStats()
+        return stats
+
+    def _bucket(self, host):
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            if len(self.buckets) >= MAX_IDLE_BUCKETS:
+                self._prune_buckets()
+            bucket = self.buckets[host] = TokenBucket(self.host_rate, self.host_burst)
+        return bucket
+
+    def _prune_buckets(self):
+        now = time.time()
+        for host in [host for host, bucket in self.buckets.items() if bucket.full(now)]:
+            del self.buckets[host]
+
+    def _start_dispatcher(self):
+        # called with the lock held
+        if self.dispatcher is None:
+            self.dispatcher = threading.Thread(target=self._dispatch_loop, name='bywaf-probe-dispatcher')
+            self.dispatcher.daemon = True
+            self.dispatcher.start()
+
+    def _dispatch_loop(self):
+        with self.lock:
+            while True:
+                self.wakeup.wait(self._dispatch())
+
+    def _enqueue(self, entry):
+        # queue a ticket on its host's heap, making the host ready if it has a
+        # token (or if the ticket goes before the first one of a ready host)
+        host = entry[3].host
+        tickets = self.waiting.get(host)
+        if tickets is None:
+            self.waiting[host] = [entry]
+            self._make_ready(host, time.time())
+            return
+        first = tickets[0]
+        heapq.heappush(tickets, entry)
+        if tickets[0] is not first and host not in self.delayed_until:
+            heapq.heappush(self.ready, entry[:3] + (host,))
+
+    def _make_ready(self, host, now):
+        # put a host with waiting tickets in the ready heap, or in the delayed
+        # one until its bucket has a token
+        tickets = self.waiting.get(host)
+        if not tickets:
+            return
+        delay = self._bucket(host).delay(now)
+        if delay:
+            self.delayed_until[host] = now + delay
+            heapq.heappush(self.delayed, (now + delay, host))
+        else:
+            heapq.heappush(self.ready, tickets[0][:3] + (host,))
+
+    def _cancel(self, ticket):
+        # a waiter gave up (its token was cancelled): drop its ticket
+        ticket.cancelled = True
+        self._dequeued(ticket)
+        tickets = self.waiting.get(ticket.host)
+        if tickets and tickets[0][3] is ticket:
+            self._drop_cancelled(ticket.host)
+            if ticket.host not in self.delayed_until:
+                self._make_ready(ticket.host, time.time())
+
+    def _drop_cancelled(self, host):
+        # pop the cancelled tickets off the top of a host's heap, and forget
+        # the host once it has none left
+        tickets = self.waiting[host]
+        while tickets and tickets[0][3].cancelled:
+            heapq.heappop(tickets)
+        if not tickets:
+            del self.waiting[host]
+            self.delayed_until.pop(host, None)
+
+    def _dequeued(self, ticket):
+        stats = self._job_stats(ticket.job)
+        stats.waiting -= 1
+        self.total.waiting -= 1
+        if not stats.waiting:
+            self.turns.pop(ticket.job, None)
+
+    def _dispatch(self):
+        # grant every ticket which may go now, waking up its waiter alone;
+        # return the seconds until another one might, None if none waits
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            until, host = heapq.heappop(self.delayed)
+            if self.delayed_until.get(host) == until:
+                del self.delayed_until[host]
+                self._make_ready(host, now)
+
+        while self.ready:
+            delay = self.global_bucket.delay(now)
+            if delay:
+                break
+            entry = heapq.heappop(self.ready)
+            host = entry[3]
+            tickets = self.waiting.get(host)
+            if host in self.delayed_until or not tickets or tickets[0][:3] != entry[:3]:
+                continue # no longer the host's first ticket
+            bucket = self._bucket(host)
+            if bucket.delay(now):
+                self._make_ready(host, now)
+                continue
+            ticket = heapq.heappop(tickets)[3]
+            self.global_bucket.take()
+            bucket.take()
+            self._dequeued(ticket)
+            self.turn = max(self.turn, ticket.turn)
+            waited = now - ticket.queued
+            for stats in (self._job_stats(ticket.job), self.total):
+                stats.sent += 1
+                stats.wait_total += waited
+            ticket.granted = True
+            ticket.cond.notify()
+            self._drop_cancelled(host)
+            self._make_ready(host, now)
+        else:
+            delay = None
+
+        if self.delayed:
+            until = max(self.delayed[0][0] - now, 0)
+            delay = until if delay is None else min(delay, until)
+        return delay